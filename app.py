@@ -1,20 +1,55 @@
 import asyncio
+import gzip
+import hashlib
 import json
+import logging
+import multiprocessing
 import os
-from collections import defaultdict
-from typing import Any, Optional
+import signal
+import stat
+import tempfile
+import time
+from typing import Any, NamedTuple, Optional
 
-from aiohttp import web
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from aiohttp import WSCloseCode, web
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
+from markupsafe import Markup, escape
 
+import executor
+import metrics
+import pubsub
 import storage
+from assets import ASSET_URL_PREFIX, Assets
+from assets import build as build_assets
+from cache import LRUCache, TopicCache, TopicView
+from executor import StorageBusy, StorageExecutor
+from fanout import PROTOCOL_V2, Codec, FanOut, codec_for
+from passwords import Hasher, HasherBusy
+
+log = logging.getLogger("branch")
 
 BASE_DIR = os.path.dirname(__file__)
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", "").strip()
+TEMPLATE_AUTO_RELOAD = os.getenv("TEMPLATE_AUTO_RELOAD", "0") == "1"
 TEMPLATES = Environment(
     loader=FileSystemLoader(os.path.join(BASE_DIR, "templates")),
     autoescape=select_autoescape(["html", "xml"]),
+    auto_reload=TEMPLATE_AUTO_RELOAD,
 )
 
+
+def template_cache() -> FileSystemBytecodeCache:
+    if not TEMPLATE_CACHE_DIR:
+        return FileSystemBytecodeCache()
+    os.makedirs(TEMPLATE_CACHE_DIR, mode=0o700, exist_ok=True)
+    info = os.lstat(TEMPLATE_CACHE_DIR)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError("TEMPLATE_CACHE_DIR must be a directory owned by the server user.")
+    if info.st_mode & 0o022:
+        raise RuntimeError("TEMPLATE_CACHE_DIR must not be writable by other users.")
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
 DOOR_PATH = os.getenv("DOOR_PATH", "").strip()
 if not DOOR_PATH:
     raise RuntimeError("Set DOOR_PATH env var to a long, unguessable path segment.")
@@ -29,8 +64,130 @@ ADMIN_USERS = {
 
 MAX_MESSAGE_LEN = int(os.getenv("MAX_MESSAGE_LEN", "2000"))
 MAX_TOPIC_TITLE = int(os.getenv("MAX_TOPIC_TITLE", "80"))
+LOBBY_PAGE_SIZE = int(os.getenv("LOBBY_PAGE_SIZE", "50"))
+ROOT_PAGE_SIZE = int(os.getenv("ROOT_PAGE_SIZE", "50"))
+REPLY_PAGE_SIZE = int(os.getenv("REPLY_PAGE_SIZE", "20"))
+THREAD_DEPTH = int(os.getenv("THREAD_DEPTH", "3"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "200"))
+MAX_THREAD_DEPTH = int(os.getenv("MAX_THREAD_DEPTH", "8"))
+MAX_THREAD_NODES = int(os.getenv("MAX_THREAD_NODES", "1000"))
+REPLAY_LIMIT = int(os.getenv("REPLAY_LIMIT", "500"))
+WS_COMPRESS = os.getenv("WS_COMPRESS", "1") == "1"
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+MAX_SEARCH_QUERY = int(os.getenv("MAX_SEARCH_QUERY", "200"))
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "60"))
+TOPIC_CACHE_BYTES = int(os.getenv("TOPIC_CACHE_BYTES", str(64 * 1024 * 1024)))
+TOPIC_CACHE_SETTLE = float(os.getenv("TOPIC_CACHE_SETTLE", "1.0"))
+LAST_SEEN_FLUSH_INTERVAL = float(os.getenv("LAST_SEEN_FLUSH_INTERVAL", "30"))
+REACTION_WINDOW = float(os.getenv("REACTION_WINDOW_MS", "50")) / 1000
+REACTION_RETRIES = int(os.getenv("REACTION_RETRIES", "3"))
+GC_INTERVAL = float(os.getenv("GC_INTERVAL", "3600"))
+MIGRATE_ON_START = os.getenv("MIGRATE_ON_START", "0") == "1"
+
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+FANOUT = FanOut()
+HASHER = Hasher()
+PUBSUB = pubsub.create_backend()
+SESSIONS = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+PENDING_LAST_SEEN: set[str] = set()
+PENDING_REACTIONS: dict[int, dict[int, int]] = {}
+REACTION_LOCK = asyncio.Lock()
+REACTION_FLUSH: Optional[asyncio.TimerHandle] = None
+REACTION_FAILURES = 0
+STORAGE = StorageExecutor()
+
+metrics.REGISTRY.gauge(
+    "branch_db_queue_depth", "Storage calls queued or running per lane.", STORAGE.stats, ("lane",)
+)
+metrics.REGISTRY.gauge(
+    "branch_db_rejected_total",
+    "Storage calls rejected with 503 because a lane was full.",
+    lambda: {(lane.name,): lane.rejected for lane in (STORAGE.read, STORAGE.write)},
+    ("lane",),
+    kind="counter",
+)
+REACTION_BATCH = metrics.REGISTRY.histogram(
+    "branch_reaction_batch_size",
+    "Reactions written per coalesced flush.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+REACTIONS_DROPPED = metrics.REGISTRY.counter(
+    "branch_reactions_dropped_total", "Reactions dropped after repeated failed flushes."
+)
+GC_DELETED = metrics.REGISTRY.counter(
+    "branch_gc_deleted_total", "Expired rows deleted by the maintenance task.", ("table",)
+)
+GC_SECONDS = metrics.REGISTRY.histogram(
+    "branch_gc_seconds", "Duration of one maintenance pass.", buckets=(0.01, 0.1, 1, 10, 60, 600)
+)
+HTTP_SECONDS = metrics.REGISTRY.histogram(
+    "branch_http_request_seconds",
+    "HTTP handler time by route, method and status.",
+    ("route", "method", "status"),
+)
+metrics.REGISTRY.gauge(
+    "branch_ws_rooms", "Topics with at least one WebSocket subscriber.", lambda: {(): len(FANOUT.rooms)}
+)
+metrics.REGISTRY.gauge(
+    "branch_ws_subscribers",
+    "WebSocket subscribers across all rooms.",
+    lambda: {(): sum(len(room.subscribers) for room in FANOUT.rooms.values())},
+)
+metrics.REGISTRY.gauge(
+    "branch_ws_room_size_max",
+    "Subscribers in the largest room.",
+    lambda: {(): max((len(room.subscribers) for room in FANOUT.rooms.values()), default=0)},
+)
+metrics.REGISTRY.gauge(
+    "branch_ws_queue_depth",
+    "Frames waiting in per-socket send queues.",
+    lambda: {
+        (): sum(sub.queue.qsize() for room in FANOUT.rooms.values() for sub in room.subscribers.values())
+    },
+)
+metrics.REGISTRY.gauge(
+    "branch_session_cache_requests_total",
+    "Session cache lookups by result.",
+    lambda: {("hit",): SESSIONS.hits, ("miss",): SESSIONS.misses},
+    ("result",),
+    kind="counter",
+)
+metrics.REGISTRY.gauge(
+    "branch_topic_cache_requests_total",
+    "Topic page cache lookups by result.",
+    lambda: {("hit",): TOPICS.hits, ("miss",): TOPICS.misses},
+    ("result",),
+    kind="counter",
+)
+metrics.REGISTRY.gauge(
+    "branch_topic_cache_updates_total",
+    "Broadcast events written through to cached topic pages.",
+    lambda: {(): TOPICS.updates},
+    kind="counter",
+)
+metrics.REGISTRY.gauge(
+    "branch_topic_cache_bytes", "Serialized size of cached topic pages.", lambda: {(): TOPICS.bytes}
+)
+metrics.REGISTRY.gauge(
+    "branch_archive_cache_requests_total",
+    "Decompressed archived body cache lookups by result.",
+    lambda: {("hit",): storage.ARCHIVED_BODIES.hits, ("miss",): storage.ARCHIVED_BODIES.misses},
+    ("result",),
+    kind="counter",
+)
+metrics.REGISTRY.gauge(
+    "branch_password_hashes_inflight", "Password hashes queued or running.", lambda: {(): HASHER.inflight}
+)
 
-ROOMS: dict[int, set[web.WebSocketResponse]] = defaultdict(set)
+
+def highlight(snippet: str) -> Markup:
+    return escape(snippet).replace("\x02", Markup("<mark>")).replace("\x03", Markup("</mark>"))
+
+
+TEMPLATES.filters["highlight"] = highlight
 
 
 def render(template: str, **context: Any) -> web.Response:
@@ -38,12 +195,154 @@ def render(template: str, **context: Any) -> web.Response:
     return web.Response(text=tpl.render(**context), content_type="text/html")
 
 
+class CachedPage(NamedTuple):
+    body: bytes
+    gzipped: bytes
+    etag: str
+    content_type: str
+    status: int
+
+
+PAGES: dict[str, CachedPage] = {}
+ASSETS = Assets()
+TEMPLATES.globals["asset_url"] = ASSETS.url
+
+
+def cache_page(name: str, text: str, content_type: str = "text/html", status: int = 200) -> None:
+    body = text.encode("utf-8")
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    PAGES[name] = CachedPage(body, gzip.compress(body, 9), etag, content_type, status)
+
+
+def build_pages() -> None:
+    cache_page(
+        "index",
+        TEMPLATES.get_template("index.html").render(door_url=DOOR_PATH, user=None, is_admin=False),
+    )
+    cache_page(
+        "login",
+        TEMPLATES.get_template("login.html").render(error=None, user=None, is_admin=False),
+    )
+    cache_page(
+        "not_found",
+        TEMPLATES.get_template("not_found.html").render(user=None, is_admin=False),
+        status=404,
+    )
+    cache_page("robots", "User-agent: *\nDisallow: /\n", content_type="text/plain")
+
+
+def cached_page(request: web.Request, name: str) -> web.Response:
+    page = PAGES[name]
+    headers = {"Vary": "Accept-Encoding"}
+    if page.status == 200:
+        headers["ETag"] = page.etag
+        headers["Cache-Control"] = "no-cache"
+        if page.etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+    body = page.body
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = page.gzipped
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(
+        body=body,
+        status=page.status,
+        content_type=page.content_type,
+        charset="utf-8",
+        headers=headers,
+    )
+
+
+def busy(template: str) -> web.Response:
+    resp = render(template, error="Too many attempts right now, try again shortly.", user=None, is_admin=False)
+    resp.set_status(503)
+    resp.headers["Retry-After"] = "5"
+    return resp
+
+
 def safe_json(data: Any) -> str:
     return json.dumps(data, ensure_ascii=False).replace("<", "\\u003c")
 
 
-async def db_call(fn, *args):
-    return await asyncio.to_thread(fn, *args)
+TOPICS = TopicCache(TOPIC_CACHE_BYTES, safe_json, TOPIC_CACHE_SETTLE)
+
+
+async def db_call(fn, *args, priority: int = executor.NORMAL):
+    return await STORAGE.call(fn, *args, priority=priority)
+
+
+async def db_write(fn, *args, priority: int = executor.NORMAL):
+    return await STORAGE.call_write(fn, *args, priority=priority)
+
+
+@web.middleware
+async def storage_busy_middleware(request: web.Request, handler) -> web.StreamResponse:
+    try:
+        return await handler(request)
+    except StorageBusy:
+        return web.Response(
+            status=503, text="Server busy, try again shortly.", headers={"Retry-After": "1"}
+        )
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler) -> web.StreamResponse:
+    started_at = time.perf_counter()
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    response = None
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        if not isinstance(response, web.WebSocketResponse):
+            HTTP_SECONDS.observe(time.perf_counter() - started_at, route, request.method, str(status))
+
+
+def encode_cursor(cursor: Optional[storage.Cursor]) -> Optional[str]:
+    if cursor is None:
+        return None
+    return f"{cursor[0]}|{cursor[1]}"
+
+
+def decode_cursor(value: Optional[str]) -> Optional[storage.Cursor]:
+    if not value:
+        return None
+    created_at, _, message_id = value.rpartition("|")
+    try:
+        return created_at, int(message_id)
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+
+def encode_search_cursor(cursor: Optional[storage.SearchCursor]) -> Optional[str]:
+    if cursor is None:
+        return None
+    return "|".join(str(part) for part in cursor)
+
+
+def decode_search_cursor(value: Optional[str]) -> Optional[storage.SearchCursor]:
+    if not value:
+        return None
+    try:
+        newest, floor, offset = (int(part) for part in value.split("|"))
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if min(newest, floor, offset) < 0 or offset > storage.SEARCH_RANK_WINDOW:
+        raise web.HTTPBadRequest()
+    return newest, floor, offset
+
+
+def _int_param(request: web.Request, name: str, default: int, upper: int) -> int:
+    try:
+        value = int(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest()
+    return max(1, min(value, upper))
 
 
 def _cookie_secure(request: web.Request) -> bool:
@@ -54,10 +353,174 @@ async def get_user(request: web.Request) -> Optional[dict[str, Any]]:
     token = request.cookies.get("sid")
     if not token:
         return None
-    row = await db_call(storage.get_user_by_session, token)
-    if not row:
-        return None
-    return {"id": row["id"], "username": row["username"]}
+    user = SESSIONS.get(token)
+    if user is None:
+        row = await db_call(storage.get_user_by_session, token, False)
+        if not row:
+            return None
+        user = {"id": row["id"], "username": row["username"]}
+        SESSIONS.set(token, user)
+    PENDING_LAST_SEEN.add(token)
+    return user
+
+
+async def flush_last_seen() -> None:
+    if not PENDING_LAST_SEEN:
+        return
+    tokens = list(PENDING_LAST_SEEN)
+    PENDING_LAST_SEEN.clear()
+    try:
+        await db_write(storage.touch_sessions, tokens, priority=executor.BACKGROUND)
+    except BaseException:
+        PENDING_LAST_SEEN.update(tokens)
+        raise
+
+
+async def _last_seen_loop() -> None:
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        try:
+            await flush_last_seen()
+        except Exception:
+            log.exception("Failed to flush last_seen updates")
+
+
+async def last_seen_flusher(app: web.Application):
+    task = asyncio.create_task(_last_seen_loop())
+    yield
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await flush_last_seen()
+
+
+async def collect_garbage() -> dict[str, int]:
+    await flush_last_seen()
+    deleted = {}
+    sweeps = (
+        ("sessions", storage.expire_sessions, storage.SESSION_IDLE_DAYS),
+        ("invites", storage.expire_invites, storage.INVITE_RETAIN_DAYS),
+        ("changes", storage.expire_changes, storage.CHANGES_RETAIN_DAYS),
+    )
+    for table, sweep, days in sweeps:
+        if days <= 0:
+            continue
+        cutoff = storage.days_ago(days)
+        deleted[table] = 0
+        while True:
+            count = await db_write(sweep, cutoff, storage.GC_BATCH, priority=executor.BACKGROUND)
+            deleted[table] += count
+            GC_DELETED.inc(table, amount=count)
+            if count < storage.GC_BATCH:
+                break
+    if storage.CHANGES_RETAIN_DAYS > 0:
+        oldest = await db_call(storage.oldest_seq, priority=executor.BACKGROUND)
+        deleted["topic views"] = TOPICS.expire(oldest)
+    await db_write(storage.optimize, priority=executor.BACKGROUND)
+    deleted["pages"] = await db_write(
+        storage.incremental_vacuum, storage.GC_VACUUM_PAGES, priority=executor.BACKGROUND
+    )
+    return deleted
+
+
+async def _gc_loop() -> None:
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        started = time.perf_counter()
+        try:
+            deleted = await collect_garbage()
+        except StorageBusy:
+            log.warning("Storage busy, maintenance pass skipped")
+            continue
+        except Exception:
+            log.exception("Maintenance pass failed")
+            continue
+        GC_SECONDS.observe(time.perf_counter() - started)
+        if any(deleted.values()):
+            log.info("Maintenance pass freed %s", deleted)
+
+
+async def gc_scheduler(app: web.Application):
+    task = asyncio.create_task(_gc_loop()) if GC_INTERVAL > 0 else None
+    yield
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def queue_reaction(message_id: int, user_id: int, value: int) -> None:
+    global REACTION_FLUSH
+    PENDING_REACTIONS.setdefault(message_id, {})[user_id] = value
+    if REACTION_FLUSH is None:
+        loop = asyncio.get_running_loop()
+        REACTION_FLUSH = loop.call_later(REACTION_WINDOW, _start_reaction_flush)
+
+
+def _start_reaction_flush() -> None:
+    task = asyncio.create_task(flush_reactions())
+    task.add_done_callback(_reaction_flush_done)
+
+
+def _reaction_flush_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Failed to flush reactions", exc_info=task.exception())
+
+
+def _requeue_reactions(batch: list[tuple[int, int, int]]) -> None:
+    global REACTION_FLUSH
+    for message_id, user_id, value in batch:
+        PENDING_REACTIONS.setdefault(message_id, {}).setdefault(user_id, value)
+    if REACTION_FLUSH is None:
+        REACTION_FLUSH = asyncio.get_running_loop().call_later(REACTION_WINDOW, _start_reaction_flush)
+
+
+async def flush_reactions() -> None:
+    global REACTION_FLUSH, REACTION_FAILURES
+    async with REACTION_LOCK:
+        if REACTION_FLUSH is not None:
+            REACTION_FLUSH.cancel()
+            REACTION_FLUSH = None
+        if not PENDING_REACTIONS:
+            return
+        batch = [
+            (message_id, user_id, value)
+            for message_id, votes in PENDING_REACTIONS.items()
+            for user_id, value in votes.items()
+        ]
+        PENDING_REACTIONS.clear()
+        try:
+            rows = await db_write(storage.set_reactions, batch, priority=executor.INTERACTIVE)
+        except StorageBusy:
+            _requeue_reactions(batch)
+            return
+        except Exception:
+            REACTION_FAILURES += 1
+            if REACTION_FAILURES <= REACTION_RETRIES:
+                log.warning(
+                    "Reaction flush failed (%d of %d retries), requeued %d reactions",
+                    REACTION_FAILURES, REACTION_RETRIES, len(batch), exc_info=True,
+                )
+                _requeue_reactions(batch)
+                return
+            REACTION_FAILURES = 0
+            REACTIONS_DROPPED.inc(amount=len(batch))
+            log.exception("Dropped %d reactions after %d failed flushes", len(batch), REACTION_RETRIES + 1)
+            return
+        REACTION_FAILURES = 0
+        if metrics.METRICS_ENABLED:
+            REACTION_BATCH.observe(len(batch))
+        for row in rows:
+            await broadcast(row["topic_id"], {"type": "reaction", "message": dict(row)})
+
+
+async def reaction_flusher(app: web.Application):
+    yield
+    await flush_reactions()
 
 
 def is_admin(user: Optional[dict[str, Any]]) -> bool:
@@ -67,17 +530,15 @@ def is_admin(user: Optional[dict[str, Any]]) -> bool:
 
 
 async def index(request: web.Request) -> web.Response:
-    return render("index.html", door_url=DOOR_PATH, user=None, is_admin=False)
+    return cached_page(request, "index")
 
 
 async def robots(request: web.Request) -> web.Response:
-    return web.Response(
-        text="User-agent: *\nDisallow: /\n", content_type="text/plain"
-    )
+    return cached_page(request, "robots")
 
 
 async def login_form(request: web.Request) -> web.Response:
-    return render("login.html", error=None, user=None, is_admin=False)
+    return cached_page(request, "login")
 
 
 async def login_submit(request: web.Request) -> web.Response:
@@ -86,10 +547,21 @@ async def login_submit(request: web.Request) -> web.Response:
     password = data.get("password") or ""
     if not username or not password:
         return render("login.html", error="Missing credentials.", user=None, is_admin=False)
-    user = await db_call(storage.verify_user, username, password)
-    if not user:
+    user = await db_call(storage.get_credentials, username)
+    try:
+        ok, needs_rehash = (False, False)
+        if user:
+            ok, needs_rehash = await HASHER.verify(
+                password, user["password_hash"], user["password_salt"]
+            )
+        if ok and needs_rehash:
+            await db_write(storage.set_password_hash, user["id"], await HASHER.hash(password))
+    except HasherBusy:
+        if not ok:
+            return busy("login.html")
+    if not ok:
         return render("login.html", error="Wrong username or password.", user=None, is_admin=False)
-    token = await db_call(storage.create_session, user["id"])
+    token = await db_write(storage.create_session, user["id"])
     resp = web.HTTPFound("/lobby")
     resp.set_cookie(
         "sid",
@@ -123,7 +595,11 @@ async def invite_submit(request: web.Request) -> web.Response:
         return render("signup.html", error="Passwords do not match.", user=None, is_admin=False)
     if len(username) > 32:
         return render("signup.html", error="Username too long.", user=None, is_admin=False)
-    user_id = await db_call(storage.create_user_with_invite, token, username, password)
+    try:
+        pwd_hash = await HASHER.hash(password)
+    except HasherBusy:
+        return busy("signup.html")
+    user_id = await db_write(storage.create_user_with_invite, token, username, pwd_hash)
     if not user_id:
         return render("signup.html", error="Invite is invalid or username taken.", user=None, is_admin=False)
     resp = web.HTTPFound(DOOR_PATH)
@@ -134,14 +610,23 @@ async def admin_invite_page(request: web.Request) -> web.Response:
     user = await get_user(request)
     if not is_admin(user):
         raise web.HTTPNotFound()
-    return render("admin.html", user=user, is_admin=True)
+    return render("admin.html", rooms=FANOUT.stats(), user=user, is_admin=True)
+
+
+async def metrics_page(request: web.Request) -> web.Response:
+    user = await get_user(request)
+    if not metrics.METRICS_ENABLED or not is_admin(user):
+        raise web.HTTPNotFound()
+    return web.Response(
+        text=metrics.REGISTRY.render(), headers={"Content-Type": metrics.CONTENT_TYPE}
+    )
 
 
 async def admin_create_invite(request: web.Request) -> web.Response:
     user = await get_user(request)
     if not is_admin(user):
         raise web.HTTPNotFound()
-    token = await db_call(storage.create_invite)
+    token = await db_write(storage.create_invite)
     link = f"{request.scheme}://{request.host}/invite/{token}"
     return render("invite.html", link=link, user=user, is_admin=True)
 
@@ -149,7 +634,9 @@ async def admin_create_invite(request: web.Request) -> web.Response:
 async def logout(request: web.Request) -> web.Response:
     token = request.cookies.get("sid")
     if token:
-        await db_call(storage.delete_session, token)
+        PENDING_LAST_SEEN.discard(token)
+        await db_write(storage.delete_session, token)
+        PUBSUB.publish("session", {"token": token})
     resp = web.HTTPFound("/")
     resp.del_cookie("sid", path="/")
     raise resp
@@ -159,8 +646,55 @@ async def lobby(request: web.Request) -> web.Response:
     user = await get_user(request)
     if not user:
         raise web.HTTPNotFound()
-    topics = await db_call(storage.list_topics)
-    return render("lobby.html", topics=topics, user=user, is_admin=is_admin(user))
+    before = decode_cursor(request.query.get("before"))
+    topics, cursor = await db_call(storage.list_topics, before, LOBBY_PAGE_SIZE)
+    return render(
+        "lobby.html",
+        topics=topics,
+        next_cursor=encode_cursor(cursor),
+        user=user,
+        is_admin=is_admin(user),
+    )
+
+
+async def search(request: web.Request) -> web.Response:
+    user = await get_user(request)
+    if not user:
+        raise web.HTTPNotFound()
+    query = request.query.get("q", "").strip()[:MAX_SEARCH_QUERY]
+    topic = None
+    if request.query.get("topic"):
+        try:
+            topic_id = int(request.query["topic"])
+        except ValueError:
+            raise web.HTTPBadRequest()
+        topic = await db_call(storage.get_topic, topic_id)
+        if not topic:
+            raise web.HTTPNotFound()
+    after = decode_search_cursor(request.query.get("after"))
+    results, cursor, truncated = [], None, False
+    if query:
+        try:
+            results, cursor, truncated = await db_call(
+                storage.search_messages,
+                query,
+                topic["id"] if topic else None,
+                after,
+                SEARCH_PAGE_SIZE,
+            )
+        except ValueError:
+            raise web.HTTPBadRequest()
+    return render(
+        "search.html",
+        query=query,
+        topic=topic,
+        results=results,
+        truncated=truncated,
+        window=storage.SEARCH_RANK_WINDOW,
+        next_cursor=encode_search_cursor(cursor),
+        user=user,
+        is_admin=is_admin(user),
+    )
 
 
 async def create_topic(request: web.Request) -> web.Response:
@@ -172,10 +706,27 @@ async def create_topic(request: web.Request) -> web.Response:
     if not title:
         return web.HTTPFound("/lobby")
     title = title[:MAX_TOPIC_TITLE]
-    topic_id = await db_call(storage.create_topic, title, user["id"])
+    topic_id = await db_write(storage.create_topic, title, user["id"])
     raise web.HTTPFound(f"/topic/{topic_id}")
 
 
+async def load_topic_view(topic_id: int) -> tuple[str, Optional[storage.Cursor], int]:
+    filling = TOPICS.begin(topic_id)
+    try:
+        rows, cursor, seq = await db_call(
+            storage.topic_snapshot, topic_id, ROOT_PAGE_SIZE, THREAD_DEPTH, MAX_THREAD_NODES
+        )
+    except BaseException:
+        if filling:
+            TOPICS.abandon(topic_id)
+        raise
+    messages = [dict(row) for row in rows]
+    if not filling:
+        return safe_json(messages), cursor, seq
+    view = TopicView(messages, cursor, seq, ROOT_PAGE_SIZE, THREAD_DEPTH, MAX_THREAD_NODES)
+    return TOPICS.fill(topic_id, view), view.cursor, view.seq
+
+
 async def topic_page(request: web.Request) -> web.Response:
     user = await get_user(request)
     if not user:
@@ -184,19 +735,119 @@ async def topic_page(request: web.Request) -> web.Response:
     topic = await db_call(storage.get_topic, topic_id)
     if not topic:
         raise web.HTTPNotFound()
-    messages = await db_call(storage.list_messages, topic_id)
-    messages_json = safe_json([dict(row) for row in messages])
+    cached = TOPICS.get(topic_id)
+    if cached is not None:
+        messages_json, cursor, seq = cached
+    else:
+        messages_json, cursor, seq = await load_topic_view(topic_id)
     user_json = safe_json(user)
+    thread_json = safe_json(
+        {
+            "rootCursor": encode_cursor(cursor),
+            "rootPageSize": ROOT_PAGE_SIZE,
+            "replyPageSize": REPLY_PAGE_SIZE,
+            "depth": THREAD_DEPTH,
+            "seq": seq,
+        }
+    )
     return render(
         "topic.html",
         topic=topic,
         messages_json=messages_json,
         user_json=user_json,
+        thread_json=thread_json,
+        user=user,
+        is_admin=is_admin(user),
+    )
+
+
+async def branch_page(request: web.Request) -> web.Response:
+    user = await get_user(request)
+    if not user:
+        raise web.HTTPNotFound()
+    topic_id = int(request.match_info["topic_id"])
+    message_id = int(request.match_info["message_id"])
+    ancestors = await db_call(storage.get_ancestors, message_id)
+    if not ancestors or ancestors[-1]["topic_id"] != topic_id:
+        raise web.HTTPNotFound()
+    topic = await db_call(storage.get_topic, topic_id)
+    seq = await db_call(storage.latest_seq)
+    messages = await db_call(storage.get_subtree, message_id, MAX_THREAD_NODES)
+    descendants = await db_call(storage.count_descendants, message_id)
+    thread_json = safe_json(
+        {
+            "rootCursor": None,
+            "rootPageSize": ROOT_PAGE_SIZE,
+            "replyPageSize": REPLY_PAGE_SIZE,
+            "depth": THREAD_DEPTH,
+            "seq": seq,
+            "branch": message_id,
+        }
+    )
+    return render(
+        "topic.html",
+        topic=topic,
+        ancestors=ancestors[:-1],
+        descendants=descendants,
+        messages_json=safe_json([dict(row) for row in messages]),
+        user_json=safe_json(user),
+        thread_json=thread_json,
         user=user,
         is_admin=is_admin(user),
     )
 
 
+async def topic_messages(request: web.Request) -> web.Response:
+    user = await get_user(request)
+    if not user:
+        raise web.HTTPNotFound()
+    topic_id = int(request.match_info["topic_id"])
+    parent_id = request.query.get("parent_id")
+    if parent_id is not None:
+        try:
+            parent_id = int(parent_id)
+        except ValueError:
+            raise web.HTTPBadRequest()
+    cursor = decode_cursor(request.query.get("cursor"))
+    default_limit = ROOT_PAGE_SIZE if parent_id is None else REPLY_PAGE_SIZE
+    limit = _int_param(request, "limit", default_limit, MAX_PAGE_SIZE)
+    depth = _int_param(request, "depth", THREAD_DEPTH, MAX_THREAD_DEPTH)
+    messages, next_cursor = await db_call(
+        storage.load_thread, topic_id, parent_id, cursor, limit, depth, MAX_THREAD_NODES
+    )
+    return web.json_response(
+        {"messages": [dict(row) for row in messages], "next_cursor": encode_cursor(next_cursor)}
+    )
+
+
+async def message_context(request: web.Request) -> web.Response:
+    user = await get_user(request)
+    if not user:
+        raise web.HTTPNotFound()
+    topic_id = int(request.match_info["topic_id"])
+    message_id = int(request.match_info["message_id"])
+    rows = await db_call(storage.get_ancestors, message_id)
+    if not rows or rows[-1]["topic_id"] != topic_id:
+        raise web.HTTPNotFound()
+    return web.json_response({"messages": [dict(row) for row in rows]})
+
+
+async def replay(ws: web.WebSocketResponse, codec: Codec, topic_id: int, since: int) -> None:
+    changed = await db_call(
+        storage.changes_since, topic_id, since, REPLAY_LIMIT, priority=executor.INTERACTIVE
+    )
+    if changed is None:
+        TOPICS.discard(topic_id, since)
+        await ws.send_str(codec.encode([{"type": "resync"}]))
+        return
+    events = [
+        {"type": "message" if created else "edit", "message": dict(row)}
+        for row, created in changed
+    ]
+    if events:
+        await ws.send_str(codec.encode(events))
+
+
 async def ws_topic(request: web.Request) -> web.WebSocketResponse:
     user = await get_user(request)
     if not user:
@@ -206,11 +857,19 @@ async def ws_topic(request: web.Request) -> web.WebSocketResponse:
     if not topic:
         raise web.HTTPNotFound()
 
-    ws = web.WebSocketResponse(heartbeat=30)
+    try:
+        since = int(request.query.get("since", -1))
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    ws = web.WebSocketResponse(heartbeat=30, protocols=(PROTOCOL_V2,), compress=WS_COMPRESS)
     await ws.prepare(request)
-    ROOMS[topic_id].add(ws)
+    codec = codec_for(ws.ws_protocol)
+    FANOUT.subscribe(topic_id, ws, codec)
 
     try:
+        if since >= 0:
+            await replay(ws, codec, topic_id, since)
         async for msg in ws:
             if msg.type != web.WSMsgType.TEXT:
                 continue
@@ -230,12 +889,13 @@ async def ws_topic(request: web.Request) -> web.WebSocketResponse:
                         parent_id = int(parent_id)
                     except ValueError:
                         parent_id = None
-                row = await db_call(
+                row = await db_write(
                     storage.create_message,
                     topic_id,
                     parent_id,
                     user["id"],
                     body,
+                    priority=executor.INTERACTIVE,
                 )
                 payload = {"type": "message", "message": dict(row)}
                 await broadcast(topic_id, payload)
@@ -249,9 +909,7 @@ async def ws_topic(request: web.Request) -> web.WebSocketResponse:
                     message_id = int(message_id)
                 except ValueError:
                     continue
-                row = await db_call(storage.set_reaction, message_id, user["id"], value)
-                payload = {"type": "reaction", "message": dict(row)}
-                await broadcast(topic_id, payload)
+                queue_reaction(message_id, user["id"], value)
             elif data.get("type") == "edit_message":
                 message_id = data.get("message_id")
                 body = (data.get("body") or "").strip()
@@ -262,36 +920,83 @@ async def ws_topic(request: web.Request) -> web.WebSocketResponse:
                     message_id = int(message_id)
                 except ValueError:
                     continue
-                row = await db_call(storage.update_message, message_id, user["id"], body)
+                row = await db_write(
+                    storage.update_message, message_id, user["id"], body, priority=executor.INTERACTIVE
+                )
                 if not row:
                     continue
                 payload = {"type": "edit", "message": dict(row)}
                 await broadcast(topic_id, payload)
+    except StorageBusy:
+        await ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"server busy")
     finally:
-        ROOMS[topic_id].discard(ws)
+        FANOUT.unsubscribe(topic_id, ws)
     return ws
 
 
 async def broadcast(topic_id: int, payload: dict[str, Any]) -> None:
-    dead = []
-    for ws in ROOMS[topic_id]:
-        try:
-            await ws.send_json(payload)
-        except Exception:
-            dead.append(ws)
-    for ws in dead:
-        ROOMS[topic_id].discard(ws)
+    PUBSUB.publish("room", {"topic_id": topic_id, "payload": payload})
+
+
+def deliver(channel: str, data: dict[str, Any]) -> None:
+    if channel == "room":
+        payload = data["payload"]
+        TOPICS.apply(data["topic_id"], payload["type"], payload["message"])
+        FANOUT.publish(data["topic_id"], payload)
+    elif channel == "session":
+        SESSIONS.pop(data["token"])
+
+
+async def pubsub_ctx(app: web.Application):
+    await PUBSUB.start(deliver)
+    yield
+    await PUBSUB.stop()
+
+
+async def close_websockets(app: web.Application) -> None:
+    await FANOUT.close()
 
 
 async def not_found(request: web.Request) -> web.Response:
-    resp = render("not_found.html", user=None, is_admin=False)
-    resp.set_status(404)
-    return resp
+    return cached_page(request, "not_found")
+
+
+async def close_storage(app: web.Application) -> None:
+    await asyncio.to_thread(HASHER.shutdown)
+    await asyncio.to_thread(STORAGE.shutdown)
+    await asyncio.to_thread(storage.shutdown)
+
+
+def check_schema() -> None:
+    pending = storage.pending_migrations()
+    if not pending:
+        return
+    if not MIGRATE_ON_START:
+        names = ", ".join(f"{migration.version} ({migration.name})" for migration in pending)
+        raise RuntimeError(
+            f"Database schema needs migrations {names}. Run python manage.py migrate "
+            "or set MIGRATE_ON_START=1."
+        )
+    for migration, rows in storage.migrate():
+        log.info("Migration %s (%s): %s rows", migration.version, migration.name, rows)
 
 
 def create_app() -> web.Application:
     storage.init_db()
-    app = web.Application()
+    check_schema()
+    TEMPLATES.bytecode_cache = template_cache()
+    ASSETS.load()
+    build_pages()
+    middlewares = [storage_busy_middleware]
+    if metrics.METRICS_ENABLED:
+        middlewares.insert(0, metrics_middleware)
+    app = web.Application(middlewares=middlewares)
+    app.on_shutdown.append(close_websockets)
+    app.on_cleanup.append(close_storage)
+    app.cleanup_ctx.append(last_seen_flusher)
+    app.cleanup_ctx.append(reaction_flusher)
+    app.cleanup_ctx.append(gc_scheduler)
+    app.cleanup_ctx.append(pubsub_ctx)
     app.router.add_get("/", index)
     app.router.add_get("/robots.txt", robots)
     app.router.add_get(DOOR_PATH, login_form)
@@ -300,18 +1005,73 @@ def create_app() -> web.Application:
     app.router.add_post("/invite/{token}", invite_submit)
     app.router.add_get("/admin", admin_invite_page)
     app.router.add_post("/admin/invite", admin_create_invite)
+    app.router.add_get("/metrics", metrics_page)
     app.router.add_get("/logout", logout)
     app.router.add_get("/lobby", lobby)
     app.router.add_post("/topic/create", create_topic)
     app.router.add_get("/topic/{topic_id}", topic_page)
+    app.router.add_get("/topic/{topic_id}/branch/{message_id}", branch_page)
+    app.router.add_get("/topic/{topic_id}/messages", topic_messages)
+    app.router.add_get("/topic/{topic_id}/messages/{message_id}/context", message_context)
+    app.router.add_get("/search", search)
     app.router.add_get("/ws/topic/{topic_id}", ws_topic)
+    app.router.add_get(ASSET_URL_PREFIX + "{name}", ASSETS.handle)
     app.router.add_static("/static", os.path.join(BASE_DIR, "static"))
     app.router.add_route("*", "/{tail:.*}", not_found)
     return app
 
 
+def run_worker(port: int) -> None:
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), host="0.0.0.0", port=port, reuse_port=True, print=None)
+
+
+async def launch_workers(port: int, count: int, socket_path: str) -> None:
+    hub = await pubsub.start_hub(socket_path)
+    context = multiprocessing.get_context("spawn")
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    def spawn() -> multiprocessing.Process:
+        process = context.Process(target=run_worker, args=(port,), name="branch-worker")
+        process.start()
+        return process
+
+    workers = [spawn() for _ in range(count)]
+    print(f"======== Running {count} workers on http://0.0.0.0:{port} ========")
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=1)
+        except asyncio.TimeoutError:
+            pass
+        for index, process in enumerate(workers):
+            if not process.is_alive() and not stopping.is_set():
+                log.warning("worker %s exited with %s, restarting", process.pid, process.exitcode)
+                workers[index] = spawn()
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        await asyncio.to_thread(process.join)
+    hub.close()
+    await hub.wait_closed()
+    os.unlink(socket_path)
+
+
 def main() -> None:
     port = int(os.getenv("PORT", "8080"))
+    if WORKERS > 1:
+        socket_path = pubsub.PUBSUB_SOCKET or os.path.join(
+            tempfile.gettempdir(), f"branch-pubsub-{os.getpid()}.sock"
+        )
+        os.environ["PUBSUB_BACKEND"] = "unix"
+        os.environ["PUBSUB_SOCKET"] = socket_path
+        storage.init_db()
+        check_schema()
+        build_assets()
+        asyncio.run(launch_workers(port, WORKERS, socket_path))
+        return
     app = create_app()
     web.run_app(app, host="0.0.0.0", port=port)
 
@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import stat
+import tempfile
+from typing import NamedTuple, Optional
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(__file__)
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+ASSET_BUILD_DIR = os.getenv("ASSET_BUILD_DIR", "").strip() or os.path.join(
+    tempfile.gettempdir(), f"branch-assets-{os.getuid()}"
+)
+ASSET_URL_PREFIX = "/static/dist/"
+IMMUTABLE = "public, max-age=31536000, immutable"
+COMPRESSIBLE = {".js", ".css", ".svg", ".html", ".json", ".txt"}
+
+
+class Asset(NamedTuple):
+    content_type: str
+    charset: Optional[str]
+    variants: dict[str, bytes]
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+
+def _fingerprint(name: str, data: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _target_dir(target: str) -> None:
+    os.makedirs(target, mode=0o700, exist_ok=True)
+    info = os.lstat(target)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError("ASSET_BUILD_DIR must be a directory owned by the server user.")
+    if info.st_mode & 0o022:
+        raise RuntimeError("ASSET_BUILD_DIR must not be writable by other users.")
+
+
+def build(source: str = STATIC_DIR, target: str = ASSET_BUILD_DIR) -> dict[str, str]:
+    _target_dir(target)
+    manifest = {}
+    for name in sorted(os.listdir(source)):
+        path = os.path.join(source, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as fh:
+            data = fh.read()
+        hashed = _fingerprint(name, data)
+        manifest[name] = hashed
+        out = os.path.join(target, hashed)
+        if not os.path.exists(out):
+            _write_atomic(out, data)
+        if os.path.splitext(name)[1] not in COMPRESSIBLE:
+            continue
+        if not os.path.exists(out + ".gz"):
+            _write_atomic(out + ".gz", gzip.compress(data, 9, mtime=0))
+        if brotli is not None and not os.path.exists(out + ".br"):
+            _write_atomic(out + ".br", brotli.compress(data))
+    _write_atomic(os.path.join(target, "manifest.json"), json.dumps(manifest, indent=2).encode())
+    _prune(target, manifest)
+    return manifest
+
+
+def _prune(target: str, manifest: dict[str, str]) -> None:
+    keep = {"manifest.json"}
+    for hashed in manifest.values():
+        keep.update((hashed, hashed + ".gz", hashed + ".br"))
+    for name in os.listdir(target):
+        path = os.path.join(target, name)
+        if name in keep or name.endswith(".tmp") or not os.path.isfile(path):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Assets:
+    def __init__(self) -> None:
+        self.manifest: dict[str, str] = {}
+        self.files: dict[str, Asset] = {}
+
+    def load(self, target: str = ASSET_BUILD_DIR) -> None:
+        self.manifest = build(target=target)
+        self.files = {}
+        for hashed in self.manifest.values():
+            path = os.path.join(target, hashed)
+            content_type = mimetypes.guess_type(hashed)[0] or "application/octet-stream"
+            textual = content_type.startswith("text/") or content_type.endswith(("javascript", "+xml"))
+            variants = {}
+            for encoding, suffix in (("identity", ""), ("gzip", ".gz"), ("br", ".br")):
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, "rb") as fh:
+                        variants[encoding] = fh.read()
+            self.files[hashed] = Asset(content_type, "utf-8" if textual else None, variants)
+
+    def url(self, name: str) -> str:
+        hashed = self.manifest.get(name)
+        if hashed is None:
+            return f"/static/{name}"
+        return ASSET_URL_PREFIX + hashed
+
+    def _encoding(self, asset: Asset, accept: str) -> str:
+        accepted = {part.split(";")[0].strip() for part in accept.split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in asset.variants:
+                return encoding
+        return "identity"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        asset: Optional[Asset] = self.files.get(request.match_info["name"])
+        if asset is None:
+            raise web.HTTPNotFound()
+        encoding = self._encoding(asset, request.headers.get("Accept-Encoding", ""))
+        headers = {"Cache-Control": IMMUTABLE, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(
+            body=asset.variants[encoding],
+            content_type=asset.content_type,
+            charset=asset.charset,
+            headers=headers,
+        )
@@ -0,0 +1,909 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import secrets
+import signal
+import socket
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Optional
+
+import zlib
+
+import aiohttp
+
+import storage
+from fanout import CompactCodec, JsonCodec
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DOOR = "bench-door"
+
+
+def _utcnow() -> str:
+    return datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
+
+
+def _open_db(path: str) -> None:
+    storage.shutdown()
+    storage.DB_PATH = path
+    storage.init_db()
+    for _ in storage.migrate():
+        pass
+
+
+def _fresh_db(directory: str, name: str) -> tuple[int, int]:
+    _open_db(os.path.join(directory, name))
+    storage.create_user("bench", "bench")
+    user = storage.verify_user("bench", "bench")
+    topic_id = storage.create_topic("bench", user["id"])
+    return user["id"], topic_id
+
+
+def bench_messages(directory: str, pool_size: int, count: int, threads: int) -> float:
+    storage.DB_POOL_SIZE = pool_size
+    user_id, topic_id = _fresh_db(directory, f"messages-{pool_size}.db")
+
+    def post(i: int) -> None:
+        storage.create_message(topic_id, None, user_id, f"message {i}")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(post, range(count)))
+    elapsed = time.perf_counter() - started
+    storage.shutdown()
+    return count / elapsed
+
+
+async def _hammer(client, path: str, count: int, concurrency: int) -> float:
+    remaining = count
+
+    async def worker() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            async with client.get(path) as resp:
+                await resp.read()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return count / (time.perf_counter() - started)
+
+
+async def bench_http(directory: str, count: int, concurrency: int, topics: int) -> dict[str, float]:
+    os.environ.setdefault("DOOR_PATH", "bench-door")
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import app
+
+    user_id, _ = _fresh_db(directory, "http.db")
+    for i in range(topics):
+        storage.create_topic(f"topic {i}", user_id)
+    token = storage.create_session(user_id)
+    results = {}
+    async with TestClient(TestServer(app.create_app()), cookies={"sid": token}) as client:
+        for label, path in (("404", "/wp-login.php"), ("lobby", "/lobby")):
+            results[label] = await _hammer(client, path, count, concurrency)
+    return results
+
+
+def _percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def seed_search_corpus(path: str, count: int, topics: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    vocabulary = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10))) for _ in range(20000)
+    ]
+    if os.path.exists(path):
+        _open_db(path)
+        return vocabulary
+    user_id, topic_id = _fresh_db(os.path.dirname(path), os.path.basename(path))
+    topic_ids = [topic_id] + [storage.create_topic(f"topic {i}", user_id) for i in range(topics - 1)]
+    storage.shutdown()
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    conn = sqlite3.connect(path)
+    start = datetime.datetime(2024, 1, 1)
+    started = time.perf_counter()
+    for offset in range(0, count, 10000):
+        rows = [
+            (
+                rng.choice(topic_ids),
+                user_id,
+                " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(5, 40))),
+                (start + datetime.timedelta(seconds=offset + i)).isoformat() + "Z",
+            )
+            for i in range(min(10000, count - offset))
+        ]
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (topic_id, parent_id, user_id, body, created_at)"
+                " VALUES (?, NULL, ?, ?, ?)",
+                rows,
+            )
+        print(f"seeded {offset + len(rows)} messages", end="\r", flush=True)
+    conn.close()
+    print(f"\nseeded {count} messages in {time.perf_counter() - started:.1f}s")
+    return vocabulary
+
+
+def bench_search(vocabulary: list[str], repeat: int) -> dict[str, tuple[int, float, float]]:
+    queries = {
+        "common": (vocabulary[0], None),
+        "medium": (vocabulary[100], None),
+        "rare": (vocabulary[10000], None),
+        "two terms": (f"{vocabulary[5]} {vocabulary[50]}", None),
+        "prefix": (vocabulary[20][:3] + "*", None),
+        "common, one topic": (vocabulary[0], 1),
+    }
+    results = {}
+    for label, (query, topic_id) in queries.items():
+        samples = []
+        hits = 0
+        for _ in range(repeat):
+            started = time.perf_counter()
+            rows, cursor, _ = storage.search_messages(query, topic_id, None, 20)
+            if cursor is not None:
+                storage.search_messages(query, topic_id, cursor, 20)
+            samples.append(1000 * (time.perf_counter() - started))
+            hits = len(rows)
+        results[label] = (hits, _percentile(samples, 0.5), _percentile(samples, 0.99))
+    return results
+
+
+def seed_forum(
+    path: str, users: int, topics: int, messages: int, shape: str, seed: int = 1
+) -> dict[str, Any]:
+    rng = random.Random(seed)
+    _open_db(path)
+    storage.create_user("bench0", "bench")
+    template = storage.get_credentials("bench0")
+    conn = sqlite3.connect(path)
+    start = datetime.datetime(2024, 1, 1)
+    clock = itertools.count()
+
+    def stamp() -> str:
+        return (start + datetime.timedelta(seconds=next(clock))).isoformat() + "Z"
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (username, password_hash, password_salt, created_at)"
+            " VALUES (?, ?, ?, ?)",
+            (
+                (f"bench{i}", template["password_hash"], template["password_salt"], stamp())
+                for i in range(1, users)
+            ),
+        )
+        user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+        tokens = [secrets.token_urlsafe(32) for _ in user_ids]
+        now = _utcnow()
+        conn.executemany(
+            "INSERT INTO sessions (token, user_id, created_at, last_seen) VALUES (?, ?, ?, ?)",
+            ((token, user_id, now, now) for token, user_id in zip(tokens, user_ids)),
+        )
+    topic_ids = []
+    for t in range(topics):
+        with conn:
+            topic_id = conn.execute(
+                "INSERT INTO topics (title, created_by, created_at, last_activity_at)"
+                " VALUES (?, ?, ?, ?)",
+                (f"topic {t}", rng.choice(user_ids), stamp(), stamp()),
+            ).lastrowid
+            topic_ids.append(topic_id)
+            ids: list[int] = []
+            for i in range(messages):
+                if not ids or (shape == "wide" and i % 1000 == 0):
+                    parent = None
+                elif shape == "deep":
+                    parent = ids[-1]
+                elif shape == "wide":
+                    parent = ids[0] if len(ids) < 1000 else ids[-(i % 1000) - 1]
+                else:
+                    parent = rng.choice(ids) if rng.random() < 0.8 else None
+                cursor = conn.execute(
+                    "INSERT INTO messages (topic_id, parent_id, user_id, body, created_at)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (topic_id, parent, rng.choice(user_ids), f"seed message {i}", stamp()),
+                )
+                ids.append(cursor.lastrowid)
+        print(f"seeded topic {t + 1}/{topics}", end="\r", file=sys.stderr, flush=True)
+    conn.close()
+    print(file=sys.stderr)
+    return {"tokens": tokens, "topic_ids": topic_ids}
+
+
+def load_forum(path: str) -> dict[str, Any]:
+    _open_db(path)
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            conn.execute("UPDATE sessions SET last_seen = ?", (_utcnow(),))
+        tokens = [row[0] for row in conn.execute("SELECT token FROM sessions ORDER BY user_id")]
+        topic_ids = [row[0] for row in conn.execute("SELECT id FROM topics ORDER BY id")]
+    finally:
+        conn.close()
+    return {"tokens": tokens, "topic_ids": topic_ids}
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    def record(self, label: str, seconds: float, ok: bool = True) -> None:
+        if ok:
+            self.samples[label].append(seconds)
+        else:
+            self.errors[label] += 1
+
+    def summary(self, elapsed: float) -> dict[str, dict[str, float]]:
+        results = {}
+        for label in sorted(set(self.samples) | set(self.errors)):
+            samples = self.samples.get(label, [])
+            results[label] = {
+                "count": len(samples),
+                "errors": self.errors.get(label, 0),
+                "per_second": len(samples) / elapsed,
+                "p50_ms": 1000 * _percentile(samples, 0.5) if samples else 0.0,
+                "p99_ms": 1000 * _percentile(samples, 0.99) if samples else 0.0,
+                "max_ms": 1000 * max(samples, default=0.0),
+            }
+        return results
+
+
+async def http_client(
+    session: aiohttp.ClientSession,
+    base: str,
+    token: str,
+    topic_ids: list[int],
+    recorder: Recorder,
+    deadline: float,
+    rng: random.Random,
+) -> None:
+    headers = {"Cookie": f"sid={token}"}
+    while time.perf_counter() < deadline:
+        if rng.random() < 0.5:
+            label, path = "http lobby", "/lobby"
+        else:
+            label, path = "http topic", f"/topic/{rng.choice(topic_ids)}"
+        started = time.perf_counter()
+        try:
+            async with session.get(base + path, headers=headers) as resp:
+                await resp.read()
+                ok = resp.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        recorder.record(label, time.perf_counter() - started, ok)
+
+
+async def ws_client(
+    session: aiohttp.ClientSession,
+    base: str,
+    client_id: int,
+    token: str,
+    topic_id: int,
+    recorder: Recorder,
+    deadline: float,
+    rng: random.Random,
+    interval: Optional[float],
+) -> None:
+    headers = {"Cookie": f"sid={token}"}
+    sent: dict[str, float] = {}
+    reacted: dict[int, float] = {}
+    seen: list[int] = []
+    own: list[int] = []
+
+    async def receive(ws: aiohttp.ClientWebSocketResponse) -> None:
+        async for frame in ws:
+            if frame.type != aiohttp.WSMsgType.TEXT:
+                continue
+            now = time.perf_counter()
+            data = json.loads(frame.data)
+            for event in data["events"] if data.get("type") == "batch" else [data]:
+                message = event.get("message")
+                if not message:
+                    continue
+                parts = message["body"].split()
+                if event["type"] != "reaction" and parts[:1] == ["bench"] and len(parts) >= 4:
+                    recorder.record("ws broadcast lag", now - float(parts[3]))
+                    key = f"{parts[1]} {parts[2]}"
+                    if key in sent:
+                        label = "ws edit" if len(parts) > 4 else "ws post"
+                        recorder.record(label, now - sent.pop(key))
+                        if label == "ws post":
+                            own.append(message["id"])
+                if event["type"] == "reaction" and message["id"] in reacted:
+                    recorder.record("ws react", now - reacted.pop(message["id"]))
+                if event["type"] == "message":
+                    seen.append(message["id"])
+                    del seen[:-100]
+
+    try:
+        ws = await session.ws_connect(f"{base}/ws/topic/{topic_id}", headers=headers)
+    except aiohttp.ClientError:
+        recorder.record("ws connect", 0.0, ok=False)
+        return
+    reader = asyncio.create_task(receive(ws))
+    try:
+        counter = itertools.count()
+        while time.perf_counter() < deadline:
+            if interval is None:
+                await asyncio.sleep(deadline - time.perf_counter())
+                break
+            await asyncio.sleep(rng.expovariate(1 / interval))
+            n = next(counter)
+            now = time.perf_counter()
+            roll = rng.random()
+            if roll < 0.3 and seen:
+                message_id = rng.choice(seen)
+                reacted[message_id] = now
+                await ws.send_json({"type": "react", "message_id": message_id, "value": rng.choice((1, -1))})
+            elif roll < 0.4 and own:
+                sent[f"{client_id} {n}"] = now
+                body = f"bench {client_id} {n} {now:.6f} edited"
+                await ws.send_json({"type": "edit_message", "message_id": rng.choice(own), "body": body})
+            else:
+                sent[f"{client_id} {n}"] = now
+                parent = rng.choice(seen) if seen and rng.random() < 0.7 else None
+                body = f"bench {client_id} {n} {now:.6f}"
+                await ws.send_json({"type": "new_message", "body": body, "parent_id": parent})
+        await asyncio.sleep(0.5)
+    finally:
+        await ws.close()
+        reader.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await reader
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.asynccontextmanager
+async def serve(target: str, db_path: str, workers: int) -> AsyncIterator[str]:
+    port = _free_port()
+    if target == "inprocess":
+        os.environ.setdefault("DOOR_PATH", BENCH_DOOR)
+        from aiohttp.test_utils import TestServer
+
+        import app
+
+        storage.DB_PATH = db_path
+        server = TestServer(app.create_app(), host="127.0.0.1", port=port)
+        await server.start_server()
+        try:
+            yield f"http://127.0.0.1:{port}"
+        finally:
+            await server.close()
+        return
+    env = {**os.environ, "DB_PATH": db_path, "PORT": str(port), "WORKERS": str(workers)}
+    env.setdefault("DOOR_PATH", BENCH_DOOR)
+    proc = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "app.py")], env=env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        async with aiohttp.ClientSession() as session:
+            for _ in range(300):
+                with contextlib.suppress(aiohttp.ClientError):
+                    async with session.get(base + "/") as resp:
+                        if resp.status == 200:
+                            break
+                if proc.poll() is not None:
+                    raise RuntimeError("app.py exited during startup")
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("app.py did not start listening")
+        yield base
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=30)
+
+
+async def run_load(args: argparse.Namespace, db_path: str, seeded: dict[str, Any]) -> dict[str, Any]:
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    tokens, topic_ids = seeded["tokens"], seeded["topic_ids"]
+    interval = 1 / args.ws_rate if args.ws_rate > 0 else None
+    connector = aiohttp.TCPConnector(limit=0)
+    async with serve(args.target, db_path, args.workers) as base:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            started = time.perf_counter()
+            deadline = started + args.duration
+            ws_base = "ws" + base[len("http"):]
+            tasks = [
+                http_client(
+                    session, base, tokens[i % len(tokens)], topic_ids, recorder, deadline,
+                    random.Random(rng.random()),
+                )
+                for i in range(args.http_clients)
+            ]
+            tasks += [
+                ws_client(
+                    session,
+                    ws_base,
+                    i,
+                    tokens[i % len(tokens)],
+                    topic_ids[i % min(len(topic_ids), args.ws_topics)],
+                    recorder,
+                    deadline,
+                    random.Random(rng.random()),
+                    interval if i < args.ws_writers else None,
+                )
+                for i in range(args.ws_clients)
+            ]
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+    return recorder.summary(elapsed)
+
+
+async def _page_writer(
+    session: aiohttp.ClientSession, base: str, token: str, topic_id: int, rate: float
+) -> None:
+    headers = {"Cookie": f"sid={token}"}
+    rng = random.Random(topic_id)
+    ids: list[int] = []
+    async with session.ws_connect(f"{base}/ws/topic/{topic_id}", headers=headers) as ws:
+        while True:
+            if ids and rng.random() < 0.7:
+                await ws.send_json(
+                    {"type": "react", "message_id": rng.choice(ids), "value": rng.choice((1, -1))}
+                )
+            else:
+                await ws.send_json({"type": "new_message", "parent_id": None, "body": "bench page"})
+            event = await ws.receive_json()
+            if event["type"] == "message":
+                ids.append(event["message"]["id"])
+            await asyncio.sleep(1 / rate)
+
+
+async def bench_page(
+    db_path: str, token: str, topic_id: int, cache_bytes: int, args: argparse.Namespace
+) -> dict[str, float]:
+    os.environ["TOPIC_CACHE_BYTES"] = str(cache_bytes)
+    recorder = Recorder()
+    headers = {"Cookie": f"sid={token}"}
+    url = f"/topic/{topic_id}"
+    async with serve("subprocess", db_path, 1) as base:
+        async with aiohttp.ClientSession() as session:
+            remaining = iter(range(args.count))
+
+            async def client() -> None:
+                for _ in remaining:
+                    started = time.perf_counter()
+                    async with session.get(base + url, headers=headers) as resp:
+                        await resp.read()
+                        ok = resp.status == 200
+                    recorder.record("page", time.perf_counter() - started, ok)
+
+            started = time.perf_counter()
+            writer = None
+            if args.writes > 0:
+                writer = asyncio.create_task(
+                    _page_writer(session, base, token, topic_id, args.writes)
+                )
+            await asyncio.gather(*(client() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+            if writer is not None:
+                writer.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await writer
+            async with session.get(base + "/metrics", headers=headers) as resp:
+                exposition = await resp.text() if resp.status == 200 else ""
+    result = recorder.summary(elapsed)["page"]
+    for line in exposition.splitlines():
+        if line.startswith("branch_topic_cache_requests_total"):
+            result[line.split('"')[1]] = float(line.split()[-1])
+    return result
+
+
+async def bench_reactions(
+    db_path: str, tokens: list[str], topic_id: int, message_id: int, args: argparse.Namespace
+) -> dict[str, Any]:
+    recorder = Recorder()
+    received: list[int] = []
+    async with serve("subprocess", db_path, 1) as base:
+        ws_base = "ws" + base[len("http"):]
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            deadline = time.perf_counter() + args.duration
+
+            async def client(token: str, rng: random.Random) -> None:
+                headers = {"Cookie": f"sid={token}"}
+                waiting: list[float] = []
+                events = 0
+                async with session.ws_connect(
+                    f"{ws_base}/ws/topic/{topic_id}", headers=headers
+                ) as ws:
+
+                    async def receive() -> None:
+                        nonlocal events
+                        async for frame in ws:
+                            now = time.perf_counter()
+                            data = json.loads(frame.data)
+                            for event in data["events"] if data.get("type") == "batch" else [data]:
+                                events += 1
+                                if event["type"] == "reaction" and waiting:
+                                    for sent_at in waiting:
+                                        recorder.record("react", now - sent_at)
+                                    waiting.clear()
+
+                    reader = asyncio.create_task(receive())
+                    while time.perf_counter() < deadline:
+                        await asyncio.sleep(rng.expovariate(args.rate))
+                        waiting.append(time.perf_counter())
+                        await ws.send_json(
+                            {"type": "react", "message_id": message_id, "value": rng.choice((1, -1))}
+                        )
+                    await asyncio.sleep(0.5)
+                    reader.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await reader
+                received.append(events)
+
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(client(tokens[i % len(tokens)], random.Random(i)) for i in range(args.clients))
+            )
+            elapsed = time.perf_counter() - started
+            async with session.get(base + "/metrics", headers={"Cookie": f"sid={tokens[0]}"}) as resp:
+                exposition = await resp.text() if resp.status == 200 else ""
+    result = recorder.summary(elapsed)["react"]
+    result["events_per_client_s"] = sum(received) / len(received) / elapsed
+    result["write_calls"] = sum(
+        float(line.split()[-1])
+        for line in exposition.splitlines()
+        if line.startswith('branch_db_calls_total{lane="write"') and 'outcome="ok"' in line
+    )
+    return result
+
+
+def _open_latency(topic_ids: list[int], repeat: int, cold: bool) -> tuple[float, float]:
+    samples = []
+    for _ in range(repeat):
+        for topic_id in topic_ids:
+            if cold:
+                storage.ARCHIVED_BODIES.clear()
+            started = time.perf_counter()
+            storage.topic_snapshot(topic_id, 50, 3, 1000)
+            samples.append(time.perf_counter() - started)
+    return 1000 * _percentile(samples, 0.5), 1000 * _percentile(samples, 0.99)
+
+
+def bench_archive(path: str, args: argparse.Namespace) -> dict[str, Any]:
+    seeded = seed_forum(path, 50, args.topics, args.messages, "random")
+    conn = sqlite3.connect(path)
+    rng = random.Random(1)
+    words = "the forum thread reply message topic branch quick brown fox lazy dog".split()
+    with conn:
+        conn.executemany(
+            "UPDATE messages SET body = ? WHERE id = ?",
+            (
+                (" ".join(rng.choice(words) for _ in range(rng.randint(5, 120))), message_id)
+                for (message_id,) in conn.execute("SELECT id FROM messages").fetchall()
+            ),
+        )
+    conn.close()
+    topic_ids = seeded["topic_ids"]
+    results: dict[str, Any] = {"hot": _open_latency(topic_ids, args.repeat, False)}
+    size_before, _ = storage.database_size()
+    raw = stored = 0
+    for topic_id in topic_ids:
+        for _, raw_bytes, stored_bytes in storage.archive_topic(topic_id):
+            raw += raw_bytes
+            stored += stored_bytes
+    storage.vacuum()
+    size_after, _ = storage.database_size()
+    results["archived, cold LRU"] = _open_latency(topic_ids, args.repeat, True)
+    results["archived, warm LRU"] = _open_latency(topic_ids, args.repeat, False)
+    results["bodies"] = (raw, stored)
+    results["file"] = (size_before, size_after)
+    return results
+
+
+def ws_event_stream(path: str, count: int, seed: int = 1) -> list[list[dict[str, Any]]]:
+    seeded = seed_forum(path, 50, 1, count, "random", seed)
+    rows = [dict(row) for row in storage.list_messages(seeded["topic_ids"][0])]
+    storage.shutdown()
+    rng = random.Random(seed)
+    seq = itertools.count(1)
+    posted: list[dict[str, Any]] = []
+    frames = []
+    for row in rows:
+        if len(frames) >= count:
+            break
+        events = []
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            roll = rng.random()
+            if not posted or roll < 0.3:
+                message = {**row, "replies": 0, "seq": next(seq)}
+                posted.append(message)
+                events.append({"type": "message", "message": message})
+                continue
+            message = rng.choice(posted)
+            message = {**message, "seq": next(seq)}
+            if roll < 0.9:
+                message["likes"] += 1
+                events.append({"type": "reaction", "message": message})
+            else:
+                message["body"] += " (edited)"
+                events.append({"type": "edit", "message": message})
+        frames.append(events)
+    return frames
+
+
+def bench_ws(frames: list[list[dict[str, Any]]], subscribers: int) -> dict[str, dict[str, float]]:
+    results = {}
+    events = sum(len(batch) for batch in frames)
+    for name, codec_type in (("json", JsonCodec), ("branch.v2", CompactCodec)):
+        for wbits in (0, 15, 10):
+            codecs = [codec_type() for _ in range(subscribers)]
+            compressors = [
+                zlib.compressobj(zlib.Z_BEST_SPEED, zlib.DEFLATED, -wbits) if wbits else None
+                for _ in range(subscribers)
+            ]
+            sent = 0
+            started = time.process_time()
+            for batch in frames:
+                shared: dict[str, Any] = {}
+                for codec, compressor in zip(codecs, compressors):
+                    data = codec.encode(batch, shared).encode("utf-8")
+                    if compressor is not None:
+                        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                        data = data[:-4]
+                    sent += len(data) + (2 if len(data) < 126 else 4)
+            cpu = time.process_time() - started
+            label = f"{name} deflate={wbits}" if wbits else f"{name} plain"
+            results[label] = {
+                "bytes_per_event": sent / subscribers / events,
+                "cpu_us_per_event": 1e6 * cpu / subscribers / events,
+            }
+    return results
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict[str, Any], candidate: dict[str, Any]) -> None:
+    print(f"{'metric':<18} {'p50 ms':>17} {'p99 ms':>17} {'per second':>21}")
+    for label, new in candidate["results"].items():
+        old = baseline["results"].get(label)
+        if old is None:
+            continue
+        cells = []
+        for key in ("p50_ms", "p99_ms", "per_second"):
+            change = (new[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            cells.append(f"{new[key]:9.1f} {change:+6.1f}%")
+        print(f"{label:<18} {cells[0]:>17} {cells[1]:>17} {cells[2]:>21}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    messages = sub.add_parser("messages", help="Messages per second through storage")
+    messages.add_argument("--count", type=int, default=2000)
+    messages.add_argument("--threads", type=int, default=8)
+    messages.add_argument("--wal", action="store_true", help="Use WAL mode with the single writer")
+    messages.add_argument(
+        "--pool-sizes",
+        default="0,8",
+        help="Comma separated pool sizes; 0 opens a connection per call",
+    )
+
+    http = sub.add_parser("http", help="Requests per second on the 404 and lobby paths")
+    http.add_argument("--count", type=int, default=5000)
+    http.add_argument("--concurrency", type=int, default=32)
+    http.add_argument("--topics", type=int, default=50)
+
+    search = sub.add_parser("search", help="Full-text search latency on a synthetic corpus")
+    search.add_argument("--count", type=int, default=1_000_000)
+    search.add_argument("--topics", type=int, default=1000)
+    search.add_argument("--repeat", type=int, default=20)
+    search.add_argument("--db", help="Reuse (or create) the corpus at this path")
+
+    load = sub.add_parser("load", help="Drive HTTP and WebSocket clients against a seeded app")
+    load.add_argument("--target", choices=("inprocess", "subprocess"), default="subprocess")
+    load.add_argument("--workers", type=int, default=1, help="WORKERS for the subprocess target")
+    load.add_argument("--db", help="Reuse (or create) the seeded database at this path")
+    load.add_argument("--users", type=int, default=200)
+    load.add_argument("--topics", type=int, default=20)
+    load.add_argument("--messages", type=int, default=500, help="Messages per topic")
+    load.add_argument("--shape", choices=("random", "deep", "wide"), default="random")
+    load.add_argument("--duration", type=float, default=10.0)
+    load.add_argument("--http-clients", type=int, default=16)
+    load.add_argument("--ws-clients", type=int, default=100)
+    load.add_argument("--ws-writers", type=int, default=20, help="WebSocket clients that write")
+    load.add_argument("--ws-rate", type=float, default=2.0, help="Actions per second per writer")
+    load.add_argument("--ws-topics", type=int, default=5, help="Topics the WebSocket clients join")
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--output", help="Write results as JSON to this file")
+
+    page = sub.add_parser("page", help="Topic page latency with and without the topic cache")
+    page.add_argument("--messages", type=int, default=10_000)
+    page.add_argument("--count", type=int, default=500)
+    page.add_argument("--concurrency", type=int, default=4)
+    page.add_argument("--writes", type=float, default=5.0, help="WebSocket writes per second meanwhile")
+    page.add_argument("--cache-bytes", type=int, default=64 * 1024 * 1024)
+
+    react = sub.add_parser("reactions", help="Many clients reacting to one hot message")
+    react.add_argument("--clients", type=int, default=100)
+    react.add_argument("--rate", type=float, default=5.0, help="Reactions per second per client")
+    react.add_argument("--duration", type=float, default=10.0)
+
+    cold = sub.add_parser("archive", help="Topic open latency before and after archiving bodies")
+    cold.add_argument("--topics", type=int, default=20)
+    cold.add_argument("--messages", type=int, default=2000, help="Messages per topic")
+    cold.add_argument("--repeat", type=int, default=10)
+
+    ws = sub.add_parser("ws", help="WebSocket bytes and CPU per event for each protocol")
+    ws.add_argument("--events", type=int, default=5000, help="Frames to replay")
+    ws.add_argument("--subscribers", type=int, default=50)
+
+    diff = sub.add_parser("compare", help="Compare two JSON results from bench.py load")
+    diff.add_argument("baseline")
+    diff.add_argument("candidate")
+
+    args = parser.parse_args()
+
+    if args.command == "messages":
+        storage.DB_WAL = args.wal
+        with tempfile.TemporaryDirectory() as directory:
+            for size in (int(value) for value in args.pool_sizes.split(",")):
+                rate = bench_messages(directory, size, args.count, args.threads)
+                print(f"pool_size={size:<3} {rate:10.1f} messages/s")
+        return 0
+
+    if args.command == "http":
+        with tempfile.TemporaryDirectory() as directory:
+            results = asyncio.run(bench_http(directory, args.count, args.concurrency, args.topics))
+        for label, rate in results.items():
+            print(f"{label:<6} {rate:10.1f} requests/s")
+        return 0
+
+    if args.command == "load":
+        with tempfile.TemporaryDirectory() as directory:
+            path = args.db or os.path.join(directory, "load.db")
+            if os.path.exists(path):
+                seeded = load_forum(path)
+            else:
+                seeded = seed_forum(path, args.users, args.topics, args.messages, args.shape, args.seed)
+            results = asyncio.run(run_load(args, path, seeded))
+            storage.shutdown()
+        report = {
+            "config": vars(args),
+            "revision": _revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "created_at": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "results": results,
+        }
+        print(f"{'metric':<18} {'count':>7} {'errors':>6} {'per s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for label, row in results.items():
+            print(
+                f"{label:<18} {row['count']:>7} {row['errors']:>6} {row['per_second']:>8.1f}"
+                f" {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f}"
+            )
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as fh:
+                json.dump(report, fh, indent=2)
+        return 0
+
+    if args.command == "page":
+        os.environ["METRICS_ENABLED"] = "1"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "page.db")
+            seeded = seed_forum(path, 2, 1, args.messages, "random")
+            storage.shutdown()
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.execute("UPDATE users SET username = 'admin' WHERE id = 1")
+            conn.close()
+            os.environ["ADMIN_USERS"] = "admin"
+            token, topic_id = seeded["tokens"][0], seeded["topic_ids"][0]
+            results = {
+                label: asyncio.run(bench_page(path, token, topic_id, cache_bytes, args))
+                for label, cache_bytes in (("uncached", 0), ("cached", args.cache_bytes))
+            }
+        print(f"{'':<10} {'p50 ms':>8} {'p99 ms':>8} {'per s':>8} {'hits':>6} {'misses':>6}")
+        for label, row in results.items():
+            print(
+                f"{label:<10} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} {row['per_second']:>8.1f}"
+                f" {row.get('hit', 0):>6.0f} {row.get('miss', 0):>6.0f}"
+            )
+        return 0
+
+    if args.command == "reactions":
+        os.environ["METRICS_ENABLED"] = "1"
+        os.environ["ADMIN_USERS"] = "bench0"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "reactions.db")
+            seeded = seed_forum(path, args.clients, 1, 1, "random")
+            storage.shutdown()
+            topic_id = seeded["topic_ids"][0]
+            conn = sqlite3.connect(path)
+            message_id = conn.execute("SELECT id FROM messages").fetchone()[0]
+            conn.close()
+            row = asyncio.run(bench_reactions(path, seeded["tokens"], topic_id, message_id, args))
+        print(f"reactions/s      {row['per_second']:10.1f}")
+        print(f"react p50 ms     {row['p50_ms']:10.2f}")
+        print(f"react p99 ms     {row['p99_ms']:10.2f}")
+        print(f"events/client/s  {row['events_per_client_s']:10.1f}")
+        print(f"write calls      {row['write_calls']:10.0f}")
+        return 0
+
+    if args.command == "archive":
+        with tempfile.TemporaryDirectory() as directory:
+            results = bench_archive(os.path.join(directory, "archive.db"), args)
+            storage.shutdown()
+        print(f"codec {storage.ARCHIVE_CODEC}, level {storage.ARCHIVE_LEVEL}")
+        print(f"{'topic open':<20} {'p50 ms':>8} {'p99 ms':>8}")
+        for label in ("hot", "archived, cold LRU", "archived, warm LRU"):
+            p50, p99 = results[label]
+            print(f"{label:<20} {p50:>8.2f} {p99:>8.2f}")
+        raw, stored = results["bodies"]
+        before, after = results["file"]
+        print(f"bodies {raw / 1e6:.1f} MB -> {stored / 1e6:.1f} MB")
+        print(f"file   {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB (after VACUUM)")
+        return 0
+
+    if args.command == "ws":
+        with tempfile.TemporaryDirectory() as directory:
+            frames = ws_event_stream(os.path.join(directory, "ws.db"), args.events)
+        results = bench_ws(frames, args.subscribers)
+        baseline = results["json deflate=15"]
+        print(f"{'protocol':<22} {'bytes/event':>12} {'cpu us/event':>13}  (per subscriber)")
+        for label, row in results.items():
+            print(
+                f"{label:<22} {row['bytes_per_event']:>12.1f} {row['cpu_us_per_event']:>13.2f}"
+                f"  {row['bytes_per_event'] / baseline['bytes_per_event'] - 1:+7.1%}"
+                f" {row['cpu_us_per_event'] / baseline['cpu_us_per_event'] - 1:+7.1%}"
+            )
+        return 0
+
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        with open(args.candidate, encoding="utf-8") as fh:
+            candidate = json.load(fh)
+        compare(baseline, candidate)
+        return 0
+
+    if args.command == "search":
+        with tempfile.TemporaryDirectory() as directory:
+            path = args.db or os.path.join(directory, "search.db")
+            vocabulary = seed_search_corpus(path, args.count, args.topics)
+            results = bench_search(vocabulary, args.repeat)
+            storage.shutdown()
+        print("query               hits   p50 ms   p99 ms  (first two pages)")
+        for label, (hits, p50, p99) in results.items():
+            print(f"{label:<18} {hits:>5} {p50:8.2f} {p99:8.2f}")
+        return 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TopicView:
+    def __init__(
+        self,
+        rows: list[dict[str, Any]],
+        cursor: Optional[tuple[str, int]],
+        seq: int,
+        root_limit: int,
+        depth: int,
+        max_nodes: int,
+    ) -> None:
+        self.cursor = cursor
+        self.seq = seq
+        self.root_limit = root_limit
+        self.depth = depth
+        self.max_nodes = max_nodes
+        self.rows: dict[int, dict[str, Any]] = {}
+        self.children: dict[Optional[int], list[int]] = {None: []}
+        self.settling: deque[tuple[float, str, dict[str, Any]]] = deque()
+        self.json: Optional[str] = None
+        self.size = 0
+        for row in rows:
+            self._add(row)
+
+    def _add(self, row: dict[str, Any]) -> None:
+        self.rows[row["id"]] = row
+        self.children.setdefault(row["parent_id"], []).append(row["id"])
+        self.children[row["id"]] = []
+
+    def _drop(self, message_id: int) -> None:
+        for child_id in self.children.pop(message_id, []):
+            self._drop(child_id)
+        del self.rows[message_id]
+
+    def _trim_roots(self) -> None:
+        roots = self.children[None]
+        while len(roots) > self.root_limit:
+            self._drop(roots.pop(0))
+            oldest = self.rows[roots[0]]
+            self.cursor = (oldest["created_at"], oldest["id"])
+
+    def apply(self, kind: str, message: dict[str, Any], now: float) -> None:
+        if (message.get("seq") or 0) <= self.seq:
+            return
+        self.settling.append((now, kind, message))
+
+    def _apply(self, kind: str, message: dict[str, Any]) -> None:
+        seq = message.get("seq") or 0
+        existing = self.rows.get(message["id"])
+        if existing is not None:
+            if (existing.get("seq") or 0) <= seq:
+                existing.update(message)
+            return
+        if kind != "message":
+            return
+        parent_id = message["parent_id"]
+        if parent_id is None:
+            self._add(dict(message))
+            self._trim_roots()
+            return
+        parent = self.rows.get(parent_id)
+        if parent is None:
+            return
+        loaded = len(self.children[parent_id])
+        complete = loaded >= (parent["replies"] or 0)
+        parent["replies"] = (parent["replies"] or 0) + 1
+        if (
+            complete
+            and parent["depth"] < self.depth - 1
+            and loaded < self.root_limit
+            and len(self.rows) < self.max_nodes
+        ):
+            self._add(dict(message))
+
+    def settled_seq(self, now: float, window: float) -> int:
+        ready = []
+        while self.settling and now - self.settling[0][0] >= window:
+            ready.append(self.settling.popleft())
+        for _, kind, message in sorted(ready, key=lambda event: event[2].get("seq") or 0):
+            self._apply(kind, message)
+            self.seq = max(self.seq, message.get("seq") or 0)
+        if ready:
+            self.json = None
+        return self.seq
+
+
+class TopicCache:
+    def __init__(
+        self,
+        max_bytes: int,
+        serialize: Callable[[list[dict[str, Any]]], str],
+        settle: float = 1.0,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.serialize = serialize
+        self.settle = settle
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self._views: OrderedDict[int, TopicView] = OrderedDict()
+        self._building: dict[int, list[tuple[str, dict[str, Any]]]] = {}
+
+    def get(self, topic_id: int) -> Optional[tuple[str, Optional[tuple[str, int]], int]]:
+        view = self._views.get(topic_id)
+        if view is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._views.move_to_end(topic_id)
+        seq = view.settled_seq(time.monotonic(), self.settle)
+        if view.json is None:
+            view.json = self.serialize(list(view.rows.values()))
+            self._resize(topic_id, view, len(view.json))
+        return view.json, view.cursor, seq
+
+    def begin(self, topic_id: int) -> bool:
+        if self.max_bytes <= 0 or topic_id in self._building:
+            return False
+        self._building[topic_id] = []
+        return True
+
+    def fill(self, topic_id: int, view: TopicView) -> str:
+        buffered = self._building.pop(topic_id, [])
+        now = time.monotonic()
+        for kind, message in buffered:
+            view.apply(kind, message, now)
+        view.json = self.serialize(list(view.rows.values()))
+        old = self._views.pop(topic_id, None)
+        if old is not None:
+            self.bytes -= old.size
+        self._views[topic_id] = view
+        self._resize(topic_id, view, len(view.json))
+        return view.json
+
+    def abandon(self, topic_id: int) -> None:
+        self._building.pop(topic_id, None)
+
+    def discard(self, topic_id: int, seq: int) -> None:
+        view = self._views.get(topic_id)
+        if view is not None and view.seq <= seq:
+            del self._views[topic_id]
+            self.bytes -= view.size
+
+    def expire(self, oldest_seq: int) -> int:
+        stale = [topic_id for topic_id, view in self._views.items() if view.seq < oldest_seq - 1]
+        for topic_id in stale:
+            self.bytes -= self._views.pop(topic_id).size
+        return len(stale)
+
+    def apply(self, topic_id: int, kind: str, message: dict[str, Any]) -> None:
+        buffered = self._building.get(topic_id)
+        if buffered is not None:
+            buffered.append((kind, message))
+        view = self._views.get(topic_id)
+        if view is None:
+            return
+        self.updates += 1
+        view.apply(kind, message, time.monotonic())
+
+    def _resize(self, topic_id: int, view: TopicView, size: int) -> None:
+        self.bytes += size - view.size
+        view.size = size
+        while self.bytes > self.max_bytes and self._views:
+            _, evicted = self._views.popitem(last=False)
+            self.bytes -= evicted.size
+
+    def __len__(self) -> int:
+        return len(self._views)
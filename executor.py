@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import metrics
+import storage
+
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+
+STORAGE_READ_WORKERS = int(os.getenv("STORAGE_READ_WORKERS", "4"))
+STORAGE_WRITE_WORKERS = int(os.getenv("STORAGE_WRITE_WORKERS", "4" if storage.DB_WAL else "1"))
+STORAGE_QUEUE_LIMIT = int(os.getenv("STORAGE_QUEUE_LIMIT", "256"))
+
+WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "branch_db_wait_seconds", "Time a storage call waited for a lane worker.", ("lane", "function")
+)
+RUN_SECONDS = metrics.REGISTRY.histogram(
+    "branch_db_run_seconds", "Time a storage call ran on its lane worker.", ("lane", "function")
+)
+CALLS = metrics.REGISTRY.counter(
+    "branch_db_calls_total", "Storage calls by lane, function and outcome.", ("lane", "function", "outcome")
+)
+
+
+class StorageBusy(Exception):
+    pass
+
+
+class Lane:
+    def __init__(self, name: str, workers: int, queue_limit: int) -> None:
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_limit = max(1, queue_limit)
+        self.pending = 0
+        self.rejected = 0
+        self._jobs: queue.PriorityQueue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"storage-{self.name}-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn: Callable[..., Any], args: tuple, priority: int) -> asyncio.Future:
+        limit = self.queue_limit * 2 if priority == INTERACTIVE else self.queue_limit
+        if self.pending >= limit:
+            self.rejected += 1
+            CALLS.inc(self.name, fn.__name__, "rejected")
+            raise StorageBusy()
+        if not self._threads:
+            self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending += 1
+        self._jobs.put((priority, next(self._order), future, loop, fn, args, time.perf_counter()))
+        return future
+
+    def _finish(self, future: asyncio.Future, result: Any, exc: Optional[BaseException]) -> None:
+        self.pending -= 1
+        _resolve(future, result, exc)
+
+    def _run(self) -> None:
+        storage.pin_connection()
+        try:
+            while True:
+                job = self._jobs.get()
+                if job[2] is None:
+                    break
+                _, _, future, loop, fn, args, queued_at = job
+                if future.cancelled():
+                    loop.call_soon_threadsafe(self._finish, future, None, None)
+                    continue
+                started_at = time.perf_counter()
+                try:
+                    result = fn(*args)
+                except BaseException as exc:
+                    outcome = "error"
+                    loop.call_soon_threadsafe(self._finish, future, None, exc)
+                else:
+                    outcome = "ok"
+                    loop.call_soon_threadsafe(self._finish, future, result, None)
+                if metrics.METRICS_ENABLED:
+                    name = fn.__name__
+                    CALLS.inc(self.name, name, outcome)
+                    WAIT_SECONDS.observe(started_at - queued_at, self.name, name)
+                    RUN_SECONDS.observe(time.perf_counter() - started_at, self.name, name)
+        finally:
+            storage.unpin_connection()
+
+    def stop(self) -> None:
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._jobs.put((BACKGROUND + 1, next(self._order), None, None, None, None, 0.0))
+        for thread in threads:
+            thread.join()
+
+
+def _resolve(future: asyncio.Future, result: Any, exc: Optional[BaseException]) -> None:
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+
+class StorageExecutor:
+    def __init__(
+        self,
+        read_workers: int = STORAGE_READ_WORKERS,
+        write_workers: int = STORAGE_WRITE_WORKERS,
+        queue_limit: int = STORAGE_QUEUE_LIMIT,
+    ) -> None:
+        self.read = Lane("read", read_workers, queue_limit)
+        self.write = Lane("write", write_workers, queue_limit)
+
+    async def call(self, fn: Callable[..., Any], *args: Any, priority: int = NORMAL) -> Any:
+        return await self.read.submit(fn, args, priority)
+
+    async def call_write(self, fn: Callable[..., Any], *args: Any, priority: int = NORMAL) -> Any:
+        return await self.write.submit(fn, args, priority)
+
+    def stats(self) -> dict[tuple[str], float]:
+        return {(lane.name,): lane.pending for lane in (self.read, self.write)}
+
+    def shutdown(self) -> None:
+        self.read.stop()
+        self.write.stop()
@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, Optional
+
+from aiohttp import WSCloseCode, web
+
+import metrics
+
+FANOUT_QUEUE_SIZE = int(os.getenv("FANOUT_QUEUE_SIZE", "256"))
+FANOUT_FLUSH_INTERVAL = float(os.getenv("FANOUT_FLUSH_MS", "10")) / 1000
+FANOUT_SLOW_POLICY = os.getenv("FANOUT_SLOW_POLICY", "disconnect")
+FANOUT_USERNAMES = int(os.getenv("FANOUT_USERNAMES", "1024"))
+
+if FANOUT_SLOW_POLICY not in {"drop", "disconnect"}:
+    raise RuntimeError("FANOUT_SLOW_POLICY must be 'drop' or 'disconnect'.")
+
+FLUSH_SECONDS = metrics.REGISTRY.histogram(
+    "branch_fanout_flush_seconds", "Time to serialize one frame and queue it for every subscriber."
+)
+FRAME_EVENTS = metrics.REGISTRY.histogram(
+    "branch_fanout_frame_events", "Events coalesced into one frame.", buckets=(1, 2, 5, 10, 20, 50, 100)
+)
+SEND_SECONDS = metrics.REGISTRY.histogram(
+    "branch_fanout_send_seconds", "Time from queueing a frame to writing it to a socket."
+)
+SLOW_CONSUMERS = metrics.REGISTRY.counter(
+    "branch_fanout_slow_consumers_total", "Frames dropped or sockets closed for slow consumers.", ("action",)
+)
+
+
+PROTOCOL_V2 = "branch.v2"
+COMPACT_KINDS = {"message": "m", "reaction": "r", "edit": "e", "resync": "x"}
+COMPACT_UPDATES = {
+    "reaction": (("l", "likes"), ("d", "dislikes")),
+    "edit": (("b", "body"), ("l", "likes"), ("d", "dislikes")),
+}
+COMPACT_COUNTERS = (("l", "likes"), ("d", "dislikes"), ("r", "replies"))
+
+
+def encode_frame(events: list[dict[str, Any]]) -> str:
+    if len(events) == 1:
+        return json.dumps(events[0], ensure_ascii=False)
+    return json.dumps({"type": "batch", "events": events}, ensure_ascii=False)
+
+
+def compact_event(event: dict[str, Any]) -> tuple[dict[str, Any], Optional[str]]:
+    kind = event["type"]
+    compact: dict[str, Any] = {"t": COMPACT_KINDS[kind]}
+    message = event.get("message")
+    if message is None:
+        return compact, None
+    compact["i"] = message["id"]
+    compact["s"] = message["seq"]
+    if kind != "message":
+        for key, field in COMPACT_UPDATES[kind]:
+            compact[key] = message[field]
+        return compact, None
+    compact["p"] = message["parent_id"]
+    compact["b"] = message["body"]
+    compact["c"] = message["created_at"]
+    for key, field in COMPACT_COUNTERS:
+        if message[field]:
+            compact[key] = message[field]
+    return compact, message["username"]
+
+
+class JsonCodec:
+    def encode(self, events: list[dict[str, Any]], shared: Optional[dict[str, Any]] = None) -> str:
+        if shared is None:
+            return encode_frame(events)
+        frame = shared.get("json")
+        if frame is None:
+            frame = shared["json"] = encode_frame(events)
+        return frame
+
+    def reset(self) -> None:
+        pass
+
+
+class CompactCodec:
+    def __init__(self, capacity: int = FANOUT_USERNAMES) -> None:
+        self.capacity = max(1, capacity)
+        self.names: dict[str, int] = {}
+
+    def encode(self, events: list[dict[str, Any]], shared: Optional[dict[str, Any]] = None) -> str:
+        if shared is None:
+            shared = {}
+        items = shared.get("compact")
+        if items is None:
+            items = shared["compact"] = []
+            for event in events:
+                item, username = compact_event(event)
+                items.append((json.dumps(item, ensure_ascii=False, separators=(",", ":")), username))
+        fresh = {username for _, username in items if username is not None and username not in self.names}
+        if fresh and len(self.names) + len(fresh) > self.capacity:
+            self.names.clear()
+        declare, parts = [], []
+        for text, username in items:
+            if username is None:
+                parts.append(text)
+                continue
+            index = self.names.get(username)
+            if index is None:
+                index = self.names[username] = len(self.names)
+                declare.append([index, username])
+            parts.append(f'{text[:-1]},"u":{index}}}')
+        body = "[" + ",".join(parts) + "]"
+        if not declare:
+            return '{"e":' + body + "}"
+        users = json.dumps(declare, ensure_ascii=False, separators=(",", ":"))
+        return '{"u":' + users + ',"e":' + body + "}"
+
+    def reset(self) -> None:
+        self.names.clear()
+
+
+Codec = JsonCodec | CompactCodec
+
+
+def codec_for(protocol: Optional[str]) -> Codec:
+    return CompactCodec() if protocol == PROTOCOL_V2 else JsonCodec()
+
+
+_CLOSING: set[asyncio.Task[bool]] = set()
+
+
+class Subscriber:
+    def __init__(self, room: "Room", ws: web.WebSocketResponse, codec: Codec) -> None:
+        self.room = room
+        self.ws = ws
+        self.codec = codec
+        self.queue: asyncio.Queue[tuple[str, float]] = asyncio.Queue(FANOUT_QUEUE_SIZE)
+        self.task = asyncio.create_task(self._run())
+
+    def offer(self, frame: str) -> bool:
+        try:
+            self.queue.put_nowait((frame, time.perf_counter()))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            frame, queued_at = await self.queue.get()
+            try:
+                await self.ws.send_str(frame)
+            except Exception:
+                self.room.discard(self.ws)
+                return
+            self.room.record_send(time.perf_counter() - queued_at)
+
+
+class Room:
+    def __init__(self, topic_id: int) -> None:
+        self.topic_id = topic_id
+        self.subscribers: dict[web.WebSocketResponse, Subscriber] = {}
+        self.pending: list[dict[str, Any]] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.frames = 0
+        self.sends = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.send_latency_total = 0.0
+        self.send_latency_max = 0.0
+
+    def add(self, ws: web.WebSocketResponse, codec: Codec) -> None:
+        self.subscribers[ws] = Subscriber(self, ws, codec)
+
+    def discard(self, ws: web.WebSocketResponse) -> None:
+        subscriber = self.subscribers.pop(ws, None)
+        if subscriber is not None and subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+
+    def publish(self, payload: dict[str, Any]) -> None:
+        self.pending.append(payload)
+        if FANOUT_FLUSH_INTERVAL <= 0:
+            self.flush()
+        elif self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(FANOUT_FLUSH_INTERVAL, self.flush)
+
+    def flush(self) -> None:
+        self.flush_handle = None
+        events, self.pending = self.pending, []
+        if not events or not self.subscribers:
+            return
+        started = time.perf_counter()
+        shared: dict[str, Any] = {}
+        self.frames += 1
+        for ws, subscriber in list(self.subscribers.items()):
+            if subscriber.offer(subscriber.codec.encode(events, shared)):
+                continue
+            SLOW_CONSUMERS.inc(FANOUT_SLOW_POLICY)
+            if FANOUT_SLOW_POLICY == "drop":
+                self.dropped += 1
+                subscriber.codec.reset()
+                continue
+            self.disconnected += 1
+            self.discard(ws)
+            task = asyncio.create_task(ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"slow consumer"))
+            _CLOSING.add(task)
+            task.add_done_callback(_CLOSING.discard)
+        if metrics.METRICS_ENABLED:
+            FLUSH_SECONDS.observe(time.perf_counter() - started)
+            FRAME_EVENTS.observe(len(events))
+
+    def record_send(self, latency: float) -> None:
+        if metrics.METRICS_ENABLED:
+            SEND_SECONDS.observe(latency)
+        self.sends += 1
+        self.send_latency_total += latency
+        if latency > self.send_latency_max:
+            self.send_latency_max = latency
+
+    def stats(self) -> dict[str, Any]:
+        depths = [sub.queue.qsize() for sub in self.subscribers.values()]
+        return {
+            "topic_id": self.topic_id,
+            "subscribers": len(self.subscribers),
+            "queue_depth": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "frames": self.frames,
+            "sends": self.sends,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "send_latency_avg_ms": 1000 * self.send_latency_total / self.sends if self.sends else 0.0,
+            "send_latency_max_ms": 1000 * self.send_latency_max,
+        }
+
+
+class FanOut:
+    def __init__(self) -> None:
+        self.rooms: dict[int, Room] = {}
+
+    def subscribe(self, topic_id: int, ws: web.WebSocketResponse, codec: Optional[Codec] = None) -> None:
+        room = self.rooms.get(topic_id)
+        if room is None:
+            room = self.rooms[topic_id] = Room(topic_id)
+        room.add(ws, codec or JsonCodec())
+
+    def unsubscribe(self, topic_id: int, ws: web.WebSocketResponse) -> None:
+        room = self.rooms.get(topic_id)
+        if room is None:
+            return
+        room.discard(ws)
+        if not room.subscribers:
+            if room.flush_handle is not None:
+                room.flush_handle.cancel()
+            del self.rooms[topic_id]
+
+    def publish(self, topic_id: int, payload: dict[str, Any]) -> None:
+        room = self.rooms.get(topic_id)
+        if room is not None:
+            room.publish(payload)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [room.stats() for room in self.rooms.values()]
+
+    async def close(self) -> None:
+        sockets = [ws for room in self.rooms.values() for ws in room.subscribers]
+        for room in list(self.rooms.values()):
+            for ws in list(room.subscribers):
+                room.discard(ws)
+            if room.flush_handle is not None:
+                room.flush_handle.cancel()
+        self.rooms.clear()
+        for ws in sockets:
+            await ws.close(code=WSCloseCode.GOING_AWAY, message=b"server shutdown")
+        if _CLOSING:
+            await asyncio.gather(*_CLOSING, return_exceptions=True)
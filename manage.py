@@ -1,10 +1,48 @@
 import argparse
+import contextlib
+import datetime
 import getpass
+import json
+import os
+import sqlite3
 import sys
+import time
+from typing import IO, ContextManager, Iterator
 
+import assets
 import storage
 
 
+def _report(label: str, count: int, started: float, end: str = "\r") -> None:
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"{label} {count} rows, {count / elapsed:.0f} rows/s", end=end, file=sys.stderr, flush=True)
+
+
+def _open(path: str, mode: str) -> ContextManager[IO[str]]:
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin if "r" in mode else sys.stdout)
+    return open(path, mode, encoding="utf-8")
+
+
+def _read_records(fh: IO[str]) -> Iterator[storage.Record]:
+    for line in fh:
+        if line.strip():
+            record = json.loads(line)
+            yield record["table"], record["row"]
+
+
+def _schema_ready() -> bool:
+    storage.init_db()
+    if not storage.pending_migrations():
+        return True
+    print(
+        f"Database schema is at version {storage.schema_version()}, latest {storage.SCHEMA_VERSION}."
+        " Run python manage.py migrate first.",
+        file=sys.stderr,
+    )
+    return False
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Admin utilities")
     sub = parser.add_subparsers(dest="command", required=True)
@@ -17,6 +55,43 @@ def main() -> int:
     create_admin = sub.add_parser("create-admin", help="Create a new admin user")
     create_admin.add_argument("username")
 
+    check = sub.add_parser("check-counters", help="Verify denormalized reaction counters")
+    check.add_argument("--fix", action="store_true", help="Recompute counters from reactions")
+
+    sub.add_parser("build-assets", help="Fingerprint and precompress static assets")
+
+    sub.add_parser("rebuild-search-index", help="Rebuild the full-text message index")
+
+    export = sub.add_parser("export", help="Stream users, topics, messages and reactions as NDJSON")
+    export.add_argument("path", nargs="?", default="-", help="Output file (default: stdout)")
+    export.add_argument("--batch", type=int, default=storage.EXPORT_BATCH, help="Rows per fetch")
+
+    load = sub.add_parser("import", help="Load an NDJSON export into an empty database")
+    load.add_argument("path", nargs="?", default="-", help="Input file (default: stdin)")
+    load.add_argument("--batch", type=int, default=storage.IMPORT_BATCH, help="Rows per transaction")
+
+    backup = sub.add_parser("backup", help="Copy the live database to a file")
+    backup.add_argument("path")
+    backup.add_argument("--pages", type=int, default=storage.BACKUP_PAGES, help="Pages per step")
+
+    archive = sub.add_parser("archive", help="Compress message bodies of inactive topics")
+    archive.add_argument("--days", type=int, default=90, help="Topics idle for this many days")
+    archive.add_argument("--topic", type=int, action="append", help="Archive this topic instead")
+    archive.add_argument("--batch", type=int, default=storage.ARCHIVE_BATCH, help="Messages per transaction")
+    archive.add_argument("--vacuum", action="store_true", help="Run VACUUM afterwards to shrink the file")
+
+    gc = sub.add_parser("gc", help="Delete idle sessions, used invites and old changes, then optimize")
+    gc.add_argument("--session-days", type=float, default=storage.SESSION_IDLE_DAYS, help="Idle days")
+    gc.add_argument("--invite-days", type=float, default=storage.INVITE_RETAIN_DAYS, help="Days since use")
+    gc.add_argument("--changes-days", type=float, default=storage.CHANGES_RETAIN_DAYS, help="Change log days")
+    gc.add_argument("--batch", type=int, default=storage.GC_BATCH, help="Rows per transaction")
+    gc.add_argument("--vacuum", action="store_true", help="Run VACUUM to enable incremental vacuum")
+
+    migrate = sub.add_parser("migrate", help="Apply pending schema migrations")
+    migrate.add_argument("--dry-run", action="store_true", help="Print query plan changes only")
+    migrate.add_argument("--batch", type=int, default=storage.MIGRATE_BATCH, help="Rows per transaction")
+    migrate.add_argument("--pause", type=float, default=storage.MIGRATE_PAUSE, help="Seconds between batches")
+
     args = parser.parse_args()
 
     if args.command == "init-db":
@@ -47,6 +122,176 @@ def main() -> int:
         print("Remember to add this username to ADMIN_USERS in /etc/branch.env.")
         return 0
 
+    if args.command == "check-counters":
+        if not _schema_ready():
+            return 1
+        mismatches = storage.check_reaction_counters()
+        for row in mismatches:
+            print(
+                f"message {row['id']}: likes {row['likes']} != {row['actual_likes']}"
+                f" or dislikes {row['dislikes']} != {row['actual_dislikes']}"
+            )
+        if not mismatches:
+            print("Reaction counters are consistent.")
+            return 0
+        if args.fix:
+            storage.backfill_reaction_counters()
+            print(f"Fixed {len(mismatches)} messages.")
+            return 0
+        return 1
+
+    if args.command == "build-assets":
+        manifest = assets.build()
+        for name, hashed in manifest.items():
+            print(f"{name} -> {hashed}")
+        return 0
+
+    if args.command == "rebuild-search-index":
+        if not _schema_ready():
+            return 1
+        started = time.perf_counter()
+        storage.rebuild_search_index()
+        print(f"Search index rebuilt in {time.perf_counter() - started:.1f}s.")
+        return 0
+
+    if args.command == "export":
+        if not _schema_ready():
+            return 1
+        started = time.perf_counter()
+        count = 0
+        with _open(args.path, "w") as fh:
+            for table, row in storage.export_rows(args.batch):
+                fh.write(json.dumps({"table": table, "row": row}, ensure_ascii=False) + "\n")
+                count += 1
+                if count % args.batch == 0:
+                    _report("exported", count, started)
+        _report("exported", count, started, end="\n")
+        return 0
+
+    if args.command == "import":
+        if not _schema_ready():
+            return 1
+        started = time.perf_counter()
+        count = 0
+        try:
+            with _open(args.path, "r") as fh:
+                for count in storage.import_rows(_read_records(fh), args.batch):
+                    _report("imported", count, started)
+        except (ValueError, KeyError, sqlite3.IntegrityError) as exc:
+            print(f"\nImport failed after {count} rows: {exc}", file=sys.stderr)
+            return 1
+        _report("imported", count, started, end="\n")
+        return 0
+
+    if args.command == "backup":
+        started = time.perf_counter()
+
+        def progress(status: int, remaining: int, total: int) -> None:
+            print(f"backup {total - remaining}/{total} pages", end="\r", file=sys.stderr, flush=True)
+
+        storage.backup(args.path, args.pages, progress)
+        elapsed = time.perf_counter() - started
+        size = os.path.getsize(args.path)
+        print(f"\nBacked up {size / 1e6:.1f} MB to {args.path} in {elapsed:.1f}s.", file=sys.stderr)
+        return 0
+
+    if args.command == "archive":
+        if not _schema_ready():
+            return 1
+        started = time.perf_counter()
+        size_before, free_before = storage.database_size()
+        if args.topic:
+            topic_ids = args.topic
+        else:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=args.days)
+            topic_ids = storage.cold_topics(cutoff.isoformat(timespec="seconds") + "Z")
+        count = raw = stored = 0
+        for topic_id in topic_ids:
+            for archived, raw_bytes, stored_bytes in storage.archive_topic(topic_id, args.batch):
+                count += archived
+                raw += raw_bytes
+                stored += stored_bytes
+                _report("archived", count, started)
+        _report("archived", count, started, end="\n")
+        if args.vacuum:
+            storage.vacuum()
+        size_after, free_after = storage.database_size()
+        print(
+            f"Archived {count} messages from {len(topic_ids)} topics: bodies {raw / 1e6:.1f} MB"
+            f" -> {stored / 1e6:.1f} MB compressed ({raw - stored} bytes saved)."
+        )
+        print(
+            f"Database {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB,"
+            f" free pages {free_before / 1e6:.1f} MB -> {free_after / 1e6:.1f} MB."
+        )
+        return 0
+
+    if args.command == "gc":
+        if not _schema_ready():
+            return 1
+        size_before, free_before = storage.database_size()
+        sweeps = (
+            ("sessions", storage.expire_sessions, args.session_days),
+            ("invites", storage.expire_invites, args.invite_days),
+            ("changes", storage.expire_changes, args.changes_days),
+        )
+        for table, sweep, days in sweeps:
+            if days <= 0:
+                continue
+            started = time.perf_counter()
+            cutoff = storage.days_ago(days)
+            count = 0
+            while True:
+                deleted = sweep(cutoff, args.batch)
+                count += deleted
+                _report(f"{table} deleted", count, started)
+                if deleted < args.batch:
+                    break
+            _report(f"{table} deleted", count, started, end="\n")
+        storage.optimize()
+        if args.vacuum:
+            storage.vacuum()
+        else:
+            storage.incremental_vacuum(0)
+        size_after, free_after = storage.database_size()
+        print(
+            f"Database {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB,"
+            f" free pages {free_before / 1e6:.1f} MB -> {free_after / 1e6:.1f} MB."
+        )
+        return 0
+
+    if args.command == "migrate":
+        storage.init_db()
+        pending = storage.pending_migrations()
+        print(f"Schema version {storage.schema_version()}, latest {storage.SCHEMA_VERSION}.")
+        for migration in pending:
+            print(f"  pending {migration.version}: {migration.name}")
+        if args.dry_run:
+            for name, before, after in storage.explain_migrations():
+                if before == after:
+                    print(f"{name}: unchanged")
+                    continue
+                print(f"{name}:")
+                print("  before:")
+                for line in before:
+                    print(f"    {line}")
+                print("  after:")
+                for line in after:
+                    print(f"    {line}")
+            return 0
+        current = None
+        started = time.perf_counter()
+        for migration, rows in storage.migrate(args.batch, args.pause):
+            if migration is not current:
+                if current is not None:
+                    print(file=sys.stderr)
+                current, started = migration, time.perf_counter()
+            _report(f"migration {migration.version}", rows, started)
+        if current is not None:
+            print(file=sys.stderr)
+        print(f"Schema at version {storage.schema_version()}.")
+        return 0
+
     return 0
 
 
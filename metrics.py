@@ -0,0 +1,153 @@
+import bisect
+import os
+import threading
+from typing import Callable, Iterable, Optional, TypeVar
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+Labels = tuple[str, ...]
+M = TypeVar("M", bound="Metric")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[tuple[str, str, float]]:
+        return ()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        super().__init__(name, help, labels)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[tuple[str, str, float]]:
+        with self._lock:
+            items = list(self.values.items())
+        for labels, value in sorted(items):
+            yield "", _format_labels(self.labels, labels), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: Labels = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    def samples(self) -> Iterable[tuple[str, str, float]]:
+        with self._lock:
+            items = [(labels, list(counts), total[0]) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield "_bucket", _format_labels(self.labels, labels, le), cumulative
+            yield "_sum", _format_labels(self.labels, labels), total
+            yield "_count", _format_labels(self.labels, labels), cumulative
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], dict[Labels, float]],
+        labels: Labels = (),
+        kind: Optional[str] = None,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.collect = collect
+        if kind is not None:
+            self.kind = kind
+
+    def samples(self) -> Iterable[tuple[str, str, float]]:
+        for labels, value in sorted(self.collect().items()):
+            yield "", _format_labels(self.labels, labels), value
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Labels = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(
+        self, name: str, help: str, labels: Labels = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], dict[Labels, float]],
+        labels: Labels = (),
+        kind: Optional[str] = None,
+    ) -> Gauge:
+        return self.register(Gauge(name, help, collect, labels, kind))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
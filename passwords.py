@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import secrets
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+ALGORITHM = "pbkdf2_sha256"
+LEGACY_ITERATIONS = 200_000
+PASSWORD_ITERATIONS = int(os.getenv("PASSWORD_ITERATIONS", str(LEGACY_ITERATIONS)))
+HASH_EXECUTOR = os.getenv("HASH_EXECUTOR", "process")
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "16"))
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _pbkdf2(password: str, salt_hex: str, iterations: int) -> str:
+    salt = bytes.fromhex(salt_hex)
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations).hex()
+
+
+def parse(encoded: str, legacy_salt: str = "") -> tuple[str, int, str, str]:
+    if "$" not in encoded:
+        return ALGORITHM, LEGACY_ITERATIONS, legacy_salt, encoded
+    algorithm, iterations, salt, digest = encoded.split("$")
+    return algorithm, int(iterations), salt, digest
+
+
+def hash_password(password: str, iterations: Optional[int] = None) -> str:
+    iterations = iterations or PASSWORD_ITERATIONS
+    salt = secrets.token_bytes(16).hex()
+    return f"{ALGORITHM}${iterations}${salt}${_pbkdf2(password, salt, iterations)}"
+
+
+def verify_password(password: str, encoded: str, legacy_salt: str = "") -> tuple[bool, bool]:
+    algorithm, iterations, salt, digest = parse(encoded, legacy_salt)
+    if algorithm != ALGORITHM:
+        return False, False
+    if not secrets.compare_digest(_pbkdf2(password, salt, iterations), digest):
+        return False, False
+    needs_rehash = "$" not in encoded or iterations != PASSWORD_ITERATIONS
+    return True, needs_rehash
+
+
+class Hasher:
+    def __init__(
+        self,
+        kind: str = HASH_EXECUTOR,
+        workers: int = HASH_WORKERS,
+        queue_limit: int = HASH_QUEUE_LIMIT,
+    ) -> None:
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.capacity = self.workers + max(0, queue_limit)
+        self.inflight = 0
+        self._executor: Optional[Executor] = None
+
+    def _pool(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="hasher")
+        return self._executor
+
+    async def _run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.inflight >= self.capacity:
+            raise HasherBusy()
+        self.inflight += 1
+        try:
+            for attempt in range(2):
+                pool = self._pool()
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+                except BrokenProcessPool:
+                    self._discard(pool)
+            raise HasherBusy()
+        finally:
+            self.inflight -= 1
+
+    def _discard(self, pool: Executor) -> None:
+        if self._executor is pool:
+            self._executor = None
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, encoded: str, legacy_salt: str = "") -> tuple[bool, bool]:
+        return await self._run(verify_password, password, encoded, legacy_salt)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
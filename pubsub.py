@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Callable, Optional
+
+log = logging.getLogger("branch.pubsub")
+
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "local")
+PUBSUB_SOCKET = os.getenv("PUBSUB_SOCKET", "")
+PUBSUB_RECONNECT_DELAY = float(os.getenv("PUBSUB_RECONNECT_DELAY", "0.5"))
+MAX_LINE = 4 * 1024 * 1024
+MAX_BUFFERED = 16 * 1024 * 1024
+
+Deliver = Callable[[str, dict[str, Any]], None]
+
+
+class LocalBackend:
+    def __init__(self) -> None:
+        self.deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        self.deliver = deliver
+
+    def publish(self, channel: str, data: dict[str, Any]) -> None:
+        if self.deliver is not None:
+            self.deliver(channel, data)
+
+    async def stop(self) -> None:
+        self.deliver = None
+
+
+class UnixSocketBackend(LocalBackend):
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        await super().start(deliver)
+        self.task = asyncio.create_task(self._run())
+
+    def publish(self, channel: str, data: dict[str, Any]) -> None:
+        super().publish(channel, data)
+        if self.writer is None or self.writer.is_closing():
+            log.warning("pub/sub hub unavailable, %s event delivered locally only", channel)
+            return
+        line = json.dumps({"channel": channel, "data": data}, ensure_ascii=False)
+        self.writer.write(line.encode("utf-8") + b"\n")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=MAX_LINE)
+            except OSError:
+                await asyncio.sleep(PUBSUB_RECONNECT_DELAY)
+                continue
+            try:
+                while line := await reader.readline():
+                    message = json.loads(line)
+                    if self.deliver is not None:
+                        self.deliver(message["channel"], message["data"])
+            except (OSError, ValueError, asyncio.LimitOverrunError):
+                log.exception("pub/sub hub connection failed")
+            finally:
+                self.writer.close()
+                self.writer = None
+            await asyncio.sleep(PUBSUB_RECONNECT_DELAY)
+
+    async def stop(self) -> None:
+        await super().stop()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.writer is not None:
+            self.writer.close()
+
+
+def create_backend() -> LocalBackend:
+    if PUBSUB_BACKEND == "local":
+        return LocalBackend()
+    if PUBSUB_BACKEND == "unix":
+        if not PUBSUB_SOCKET:
+            raise RuntimeError("Set PUBSUB_SOCKET when PUBSUB_BACKEND=unix.")
+        return UnixSocketBackend(PUBSUB_SOCKET)
+    raise RuntimeError("PUBSUB_BACKEND must be 'local' or 'unix'.")
+
+
+async def start_hub(path: str) -> asyncio.AbstractServer:
+    clients: set[asyncio.StreamWriter] = set()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        clients.add(writer)
+        try:
+            while line := await reader.readline():
+                for client in list(clients):
+                    if client is writer:
+                        continue
+                    if client.transport.get_write_buffer_size() > MAX_BUFFERED:
+                        log.warning("dropping slow pub/sub client")
+                        clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(line)
+        except (OSError, asyncio.LimitOverrunError, ValueError):
+            log.exception("pub/sub client failed")
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle, path, limit=MAX_LINE)
@@ -1,5 +1,8 @@
 (() => {
-  const ws = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws/topic/${topicId}`);
+  const wsUrl = `${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws/topic/${topicId}`;
+  const reconnectBaseMs = 500;
+  const reconnectMaxMs = 30000;
+  const compactProtocol = "branch.v2";
   const threadEl = document.getElementById("thread");
   const inputEl = document.getElementById("message-input");
   const sendBtn = document.getElementById("send-message");
@@ -7,6 +10,7 @@
   const clearReply = document.getElementById("clear-reply");
   const emojiButton = document.getElementById("emoji-button");
   const emojiPanel = document.getElementById("emoji-panel");
+  const loadEarlierBtn = document.getElementById("load-earlier");
 
   const storageKey = "branch.lastSeen";
   let messages = new Map();
@@ -14,6 +18,13 @@
   let openReplyId = null;
   let lastSeen = {};
   let lastSeenAt = null;
+  let rootCursor = threadConfig.rootCursor;
+  let lastSeenCandidate = null;
+  let lastSeq = threadConfig.seq;
+  let ws = null;
+  let usernames = new Map();
+  let reconnectAttempts = 0;
+  let started = false;
 
   const emojis = ["😀", "😂", "😊", "😉", "😍", "🤔", "😢", "😡", "👍", "👎", "❤️", "🔥"];
 
@@ -35,13 +46,7 @@
   }
 
   function latestMessageTime() {
-    let latest = null;
-    messages.forEach((msg) => {
-      if (!latest || new Date(msg.created_at) > new Date(latest)) {
-        latest = msg.created_at;
-      }
-    });
-    return latest;
+    return lastSeenCandidate;
   }
 
   function isAtBottom() {
@@ -126,20 +131,98 @@
     });
   }
 
-  function buildTree() {
-    const nodes = new Map();
-    messages.forEach((msg) => {
-      nodes.set(msg.id, { ...msg, children: [] });
-    });
-    const roots = [];
-    nodes.forEach((node) => {
-      if (node.parent_id && nodes.has(node.parent_id)) {
-        nodes.get(node.parent_id).children.push(node);
-      } else {
-        roots.push(node);
-      }
+  const views = new Map();
+  let pending = [];
+  let frameRequested = false;
+
+  function byCreated(a, b) {
+    if (a.created_at !== b.created_at) return a.created_at < b.created_at ? -1 : 1;
+    return a.id - b.id;
+  }
+
+  function cursorOf(msg) {
+    return `${msg.created_at}|${msg.id}`;
+  }
+
+  function childContainer(parentId) {
+    const parent = parentId ? views.get(parentId) : null;
+    return parent ? parent.children : threadEl;
+  }
+
+  function loadedReplies(parentId) {
+    const view = views.get(parentId);
+    if (!view) return 0;
+    let count = 0;
+    for (let el = view.children.firstElementChild; el; el = el.nextElementSibling) {
+      if (!el.classList.contains("context")) count += 1;
+    }
+    return count;
+  }
+
+  function lastLoadedReply(parentId) {
+    const view = views.get(parentId);
+    let last = view && view.children.lastElementChild;
+    while (last && last.classList.contains("context")) {
+      last = last.previousElementSibling;
+    }
+    return last ? messages.get(Number(last.dataset.id)) : null;
+  }
+
+  async function fetchThread(params) {
+    const query = new URLSearchParams(params);
+    const resp = await fetch(`/topic/${topicId}/messages?${query}`, { credentials: "same-origin" });
+    if (!resp.ok) throw new Error(`thread fetch failed: ${resp.status}`);
+    const data = await resp.json();
+    data.messages.forEach((msg) => {
+      upsertMessage(msg);
+      views.get(msg.id).wrapper.classList.remove("context");
     });
-    return roots;
+    return data;
+  }
+
+  async function focusMessage(id) {
+    if (!views.has(id)) {
+      const resp = await fetch(`/topic/${topicId}/messages/${id}/context`, { credentials: "same-origin" });
+      if (!resp.ok) return;
+      const data = await resp.json();
+      data.messages.forEach((msg) => {
+        if (views.has(msg.id)) return;
+        upsertMessage(msg);
+        views.get(msg.id).wrapper.classList.add("context");
+      });
+    }
+    const view = views.get(id);
+    if (!view) return;
+    document.querySelectorAll(".message.focused").forEach((el) => el.classList.remove("focused"));
+    view.wrapper.classList.add("focused");
+    view.wrapper.scrollIntoView({ block: "center" });
+  }
+
+  function focusFromHash() {
+    const match = /^#m(\d+)$/.exec(location.hash);
+    if (match) focusMessage(Number(match[1])).catch(() => {});
+  }
+
+  async function loadEarlier() {
+    if (!rootCursor) return;
+    loadEarlierBtn.disabled = true;
+    try {
+      const data = await fetchThread({ cursor: rootCursor, limit: threadConfig.rootPageSize });
+      rootCursor = data.next_cursor;
+      loadEarlierBtn.hidden = !rootCursor;
+    } finally {
+      loadEarlierBtn.disabled = false;
+    }
+  }
+
+  async function loadReplies(id) {
+    const params = { parent_id: id, limit: threadConfig.replyPageSize, depth: threadConfig.depth };
+    const last = lastLoadedReply(id);
+    if (last) {
+      params.cursor = cursorOf(last);
+    }
+    await fetchThread(params);
+    updateReplyControls(id);
   }
 
   function isUnread(node) {
@@ -167,13 +250,17 @@
 
     const meta = document.createElement("span");
     meta.className = "message-meta";
-    meta.textContent = `· ${node.created_at} · #${node.id}`;
+    meta.textContent = `· ${node.created_at} · `;
+    const permalink = document.createElement("a");
+    permalink.className = "message-permalink";
+    permalink.href = `/topic/${topicId}/branch/${node.id}`;
+    permalink.textContent = `#${node.id}`;
+    meta.appendChild(permalink);
     header.appendChild(meta);
     wrapper.appendChild(header);
 
     const body = document.createElement("div");
     body.className = "message-body";
-    renderBody(node.body).forEach((part) => body.appendChild(part));
     wrapper.appendChild(body);
 
     const replyBox = document.createElement("div");
@@ -186,32 +273,29 @@
     const reply = document.createElement("span");
     reply.className = "reaction";
     reply.textContent = "reply";
-    reply.addEventListener("click", () => showReplyEditor(wrapper, node));
+    reply.addEventListener("click", () => showReplyEditor(wrapper, messages.get(node.id)));
     actions.appendChild(reply);
 
     if (node.username === currentUser.username) {
       const edit = document.createElement("span");
       edit.className = "reaction";
       edit.textContent = "edit";
-      edit.addEventListener("click", () => showEditor(wrapper, node));
+      edit.addEventListener("click", () => showEditor(wrapper, messages.get(node.id)));
       actions.appendChild(edit);
     }
 
     const like = document.createElement("span");
     like.className = "reaction";
-    like.textContent = `+${node.likes}`;
     like.addEventListener("click", () => sendReaction(node.id, 1));
     actions.appendChild(like);
 
     const dislike = document.createElement("span");
     dislike.className = "reaction";
-    dislike.textContent = `-${node.dislikes}`;
     dislike.addEventListener("click", () => sendReaction(node.id, -1));
     actions.appendChild(dislike);
 
     const toggle = document.createElement("span");
     toggle.className = "collapse-toggle";
-    toggle.textContent = node.children.length ? "collapse" : "";
     toggle.addEventListener("click", () => {
       wrapper.classList.toggle("collapsed");
       toggle.textContent = wrapper.classList.contains("collapsed") ? "expand" : "collapse";
@@ -225,28 +309,134 @@
     editor.dataset.open = "false";
     wrapper.appendChild(editor);
 
-    if (node.children.length) {
-      const childWrap = document.createElement("div");
-      childWrap.className = "children";
-      node.children.forEach((child) => childWrap.appendChild(renderMessage(child)));
-      wrapper.appendChild(childWrap);
+    const childWrap = document.createElement("div");
+    childWrap.className = "children";
+    wrapper.appendChild(childWrap);
+
+    const more = document.createElement("span");
+    more.className = "more-replies";
+    more.hidden = true;
+    more.addEventListener("click", () => {
+      more.textContent = "loading...";
+      loadReplies(node.id).catch(() => {
+        more.textContent = "failed to load, retry";
+      });
+    });
+    wrapper.appendChild(more);
+
+    const view = { wrapper, body, like, dislike, toggle, children: childWrap, more };
+    patchView(view, node);
+    return view;
+  }
+
+  function patchView(view, node) {
+    view.body.replaceChildren(...renderBody(node.body));
+    view.like.textContent = `+${node.likes}`;
+    view.dislike.textContent = `-${node.dislikes}`;
+  }
+
+  function updateReplyControls(id) {
+    const view = views.get(id);
+    const node = messages.get(id);
+    if (!view || !node) return;
+    const replies = node.replies || 0;
+    if (!replies) {
+      view.toggle.textContent = "";
+    } else if (!view.toggle.textContent) {
+      view.toggle.textContent = "collapse";
+    }
+    const loaded = loadedReplies(id);
+    const remaining = replies - loaded;
+    view.more.hidden = remaining <= 0;
+    if (remaining > 0) {
+      const noun = remaining === 1 ? "reply" : "replies";
+      view.more.textContent = loaded
+        ? `show ${remaining} more ${noun}`
+        : `show ${remaining} ${noun}`;
+    }
+  }
+
+  function insertView(node, view) {
+    const container = childContainer(node.parent_id);
+    let before = null;
+    for (let el = container.lastElementChild; el; el = el.previousElementSibling) {
+      const sibling = messages.get(Number(el.dataset.id));
+      if (!sibling || byCreated(sibling, node) < 0) break;
+      before = el;
     }
-    return wrapper;
+    container.insertBefore(view.wrapper, before);
   }
 
-  function renderAll(shouldScroll = false) {
-    threadEl.innerHTML = "";
-    const roots = buildTree();
-    roots.forEach((root) => threadEl.appendChild(renderMessage(root)));
-    if (shouldScroll) {
+  function upsertMessage(msg) {
+    const existing = messages.get(msg.id);
+    const node = existing ? { ...existing, ...msg } : { replies: 0, ...msg };
+    messages.set(node.id, node);
+    if (!lastSeenCandidate || node.created_at > lastSeenCandidate) {
+      lastSeenCandidate = node.created_at;
+    }
+    const view = views.get(node.id);
+    if (view) {
+      patchView(view, node);
+    } else {
+      const created = renderMessage(node);
+      views.set(node.id, created);
+      insertView(node, created);
+    }
+    updateReplyControls(node.id);
+    if (node.parent_id) {
+      updateReplyControls(node.parent_id);
+    }
+  }
+
+  function applyEvent(data) {
+    const msg = data.message;
+    const existing = messages.get(msg.id);
+    if (existing && existing.seq && msg.seq && msg.seq < existing.seq) return;
+    if (data.type !== "message") {
+      if (messages.has(msg.id)) upsertMessage(msg);
+      return;
+    }
+    if (messages.has(msg.id)) {
+      upsertMessage(msg);
+      return;
+    }
+    if (!msg.parent_id && threadConfig.branch) return;
+    if (msg.parent_id) {
+      const parent = messages.get(msg.parent_id);
+      if (!parent) return;
+      const complete = loadedReplies(parent.id) >= (parent.replies || 0);
+      parent.replies = (parent.replies || 0) + 1;
+      if (!complete) {
+        updateReplyControls(parent.id);
+        return;
+      }
+    }
+    upsertMessage(msg);
+  }
+
+  function flushEvents() {
+    frameRequested = false;
+    const batch = pending;
+    pending = [];
+    const wasAtBottom = isAtBottom();
+    batch.forEach(applyEvent);
+    if (wasAtBottom) {
       scrollToBottom();
+      saveLastSeen(latestMessageTime());
+    }
+  }
+
+  function queueEvent(data) {
+    pending.push(data);
+    if (!frameRequested) {
+      frameRequested = true;
+      requestAnimationFrame(flushEvents);
     }
   }
 
   function sendMessage() {
     const body = inputEl.value.trim();
-    if (!body) return;
-    ws.send(JSON.stringify({ type: "new_message", body, parent_id: replyTo }));
+    if (!body || !send({ type: "new_message", body, parent_id: replyTo })) return;
     inputEl.value = "";
   }
 
@@ -290,16 +480,17 @@
     panel.className = "emoji-panel";
     actions.appendChild(panel);
 
-    const send = document.createElement("button");
-    send.textContent = "Send";
-    send.addEventListener("click", () => {
+    const sendReply = document.createElement("button");
+    sendReply.className = "send-button";
+    sendReply.textContent = "Send";
+    sendReply.disabled = !isConnected();
+    sendReply.addEventListener("click", () => {
       const body = area.value.trim();
-      if (!body) return;
-      ws.send(JSON.stringify({ type: "new_message", body, parent_id: node.id }));
+      if (!body || !send({ type: "new_message", body, parent_id: node.id })) return;
       area.value = "";
       closeReplyEditors();
     });
-    actions.appendChild(send);
+    actions.appendChild(sendReply);
 
     const cancel = document.createElement("button");
     cancel.textContent = "Cancel";
@@ -317,7 +508,7 @@
         return;
       }
       event.preventDefault();
-      send.click();
+      sendReply.click();
     });
   }
 
@@ -341,11 +532,12 @@
     actions.className = "editor-actions";
 
     const save = document.createElement("button");
+    save.className = "send-button";
     save.textContent = "Save";
+    save.disabled = !isConnected();
     save.addEventListener("click", () => {
       const body = area.value.trim();
-      if (!body) return;
-      ws.send(JSON.stringify({ type: "edit_message", message_id: node.id, body }));
+      if (!body || !send({ type: "edit_message", message_id: node.id, body })) return;
       editor.dataset.open = "false";
       editor.innerHTML = "";
     });
@@ -362,11 +554,28 @@
     editor.appendChild(actions);
   }
 
+  function isConnected() {
+    return Boolean(ws && ws.readyState === WebSocket.OPEN);
+  }
+
+  function setConnected(connected) {
+    document.querySelectorAll("#send-message, .send-button").forEach((button) => {
+      button.disabled = !connected;
+    });
+  }
+
+  function send(data) {
+    if (!isConnected()) return false;
+    ws.send(JSON.stringify(data));
+    return true;
+  }
+
   function sendReaction(messageId, value) {
-    ws.send(JSON.stringify({ type: "react", message_id: messageId, value }));
+    send({ type: "react", message_id: messageId, value });
   }
 
   attachEmojiPicker(emojiButton, inputEl, emojiPanel);
+  loadEarlierBtn.addEventListener("click", loadEarlier);
 
   sendBtn.addEventListener("click", sendMessage);
   inputEl.addEventListener("keydown", (event) => {
@@ -380,22 +589,83 @@
     sendMessage();
   });
 
-  ws.onmessage = (event) => {
-    const data = JSON.parse(event.data);
-    if (data.type === "message" || data.type === "reaction" || data.type === "edit") {
-      const wasAtBottom = isAtBottom();
-      messages.set(data.message.id, data.message);
-      renderAll(wasAtBottom);
-      if (wasAtBottom) {
-        saveLastSeen(latestMessageTime());
-      }
+  function handleEvent(data) {
+    if (data.type === "batch") {
+      data.events.forEach(handleEvent);
+    } else if (data.type === "resync") {
+      location.reload();
+    } else if (data.type === "message" || data.type === "reaction" || data.type === "edit") {
+      if (data.message.seq > lastSeq) lastSeq = data.message.seq;
+      queueEvent(data);
+    }
+  }
+
+  function expandEvent(event) {
+    if (event.t === "x") return { type: "resync" };
+    const message = { id: event.i, seq: event.s };
+    if (event.t === "m") {
+      Object.assign(message, {
+        topic_id: topicId,
+        parent_id: event.p,
+        body: event.b,
+        created_at: event.c,
+        username: usernames.get(event.u),
+        likes: event.l || 0,
+        dislikes: event.d || 0,
+        replies: event.r || 0,
+      });
+      return { type: "message", message };
     }
-  };
+    if ("b" in event) message.body = event.b;
+    if ("l" in event) message.likes = event.l;
+    if ("d" in event) message.dislikes = event.d;
+    return { type: event.t === "r" ? "reaction" : "edit", message };
+  }
+
+  function handleFrame(socket, data) {
+    if (socket.protocol !== compactProtocol) {
+      handleEvent(data);
+      return;
+    }
+    if (data.u) data.u.forEach(([index, name]) => usernames.set(index, name));
+    data.e.forEach((event) => handleEvent(expandEvent(event)));
+  }
+
+  function scheduleReconnect() {
+    const ceiling = Math.min(reconnectMaxMs, reconnectBaseMs * 2 ** reconnectAttempts);
+    reconnectAttempts += 1;
+    setTimeout(connect, ceiling / 2 + Math.random() * ceiling / 2);
+  }
+
+  function connect() {
+    const socket = new WebSocket(`${wsUrl}?since=${lastSeq}`, [compactProtocol]);
+    ws = socket;
+    usernames = new Map();
+    socket.onmessage = (event) => {
+      handleFrame(socket, JSON.parse(event.data));
+    };
+    socket.onopen = () => {
+      reconnectAttempts = 0;
+      setConnected(true);
+      if (started) return;
+      started = true;
+      initialMessages.forEach(upsertMessage);
+      loadEarlierBtn.hidden = !rootCursor;
+      scrollToBottom();
+      if (threadConfig.branch) {
+        focusMessage(threadConfig.branch).catch(() => {});
+      }
+      focusFromHash();
+    };
+    socket.onclose = () => {
+      setConnected(false);
+      scheduleReconnect();
+    };
+  }
+
+  connect();
 
-  ws.onopen = () => {
-    initialMessages.forEach((msg) => messages.set(msg.id, msg));
-    renderAll(true);
-  };
+  window.addEventListener("hashchange", focusFromHash);
 
   window.addEventListener("scroll", () => {
     if (isAtBottom()) {
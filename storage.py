@@ -1,29 +1,339 @@
+import contextlib
 import datetime
-import hashlib
+import itertools
 import os
+import queue
 import secrets
 import sqlite3
-from typing import Optional
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
+
+import passwords
+from cache import LRUCache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+Cursor = tuple[str, int]
+SearchCursor = tuple[int, int, int]
 
 BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "data.db"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_WAL = os.getenv("DB_WAL", "0") == "1"
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").upper()
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-65536"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "10000"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "1024"))
+SEARCH_SNIPPET_TOKENS = int(os.getenv("SEARCH_SNIPPET_TOKENS", "16"))
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "5000"))
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "zlib")
+ARCHIVE_LEVEL = int(os.getenv("ARCHIVE_LEVEL", "9"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "1000"))
+ARCHIVE_CACHE_SIZE = int(os.getenv("ARCHIVE_CACHE_SIZE", "10000"))
+SESSION_IDLE_DAYS = float(os.getenv("SESSION_IDLE_DAYS", "30"))
+INVITE_RETAIN_DAYS = float(os.getenv("INVITE_RETAIN_DAYS", "30"))
+CHANGES_RETAIN_DAYS = float(os.getenv("CHANGES_RETAIN_DAYS", "7"))
+GC_BATCH = int(os.getenv("GC_BATCH", "500"))
+GC_VACUUM_PAGES = int(os.getenv("GC_VACUUM_PAGES", "2048"))
+MIGRATE_BATCH = int(os.getenv("MIGRATE_BATCH", "1000"))
+MIGRATE_PAUSE = float(os.getenv("MIGRATE_PAUSE", "0.01"))
+
+if DB_SYNCHRONOUS not in {"OFF", "NORMAL", "FULL", "EXTRA"}:
+    raise RuntimeError("DB_SYNCHRONOUS must be one of OFF, NORMAL, FULL, EXTRA.")
+if ARCHIVE_CODEC not in {"zlib", "zstd"}:
+    raise RuntimeError("ARCHIVE_CODEC must be 'zlib' or 'zstd'.")
+if ARCHIVE_CODEC == "zstd" and zstandard is None:
+    raise RuntimeError("ARCHIVE_CODEC=zstd needs the zstandard package.")
+
+ARCHIVED_BODIES = LRUCache(ARCHIVE_CACHE_SIZE)
 
 
 def _now() -> str:
     return datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
 
+def days_ago(days: float) -> str:
+    then = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    return then.isoformat(timespec="seconds") + "Z"
+
+
+def compress_body(body: str) -> bytes:
+    raw = body.encode("utf-8")
+    if ARCHIVE_CODEC == "zstd":
+        packed = b"s" + zstandard.ZstdCompressor(level=ARCHIVE_LEVEL).compress(raw)
+    else:
+        packed = b"z" + zlib.compress(raw, ARCHIVE_LEVEL)
+    return packed if len(packed) <= len(raw) else b"r" + raw
+
+
+def decompress_body(blob: bytes) -> str:
+    codec, data = blob[:1], blob[1:]
+    if codec == b"z":
+        data = zlib.decompress(data)
+    elif codec == b"s":
+        if zstandard is None:
+            raise RuntimeError("Archived body needs the zstandard package.")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return data.decode("utf-8")
+
+
+def _archived_body(message_id: int, blob: Optional[bytes]) -> str:
+    if blob is None:
+        return ""
+    key = (message_id, zlib.crc32(blob))
+    body = ARCHIVED_BODIES.get(key)
+    if body is None:
+        body = decompress_body(blob)
+        ARCHIVED_BODIES.set(key, body)
+    return body
+
+
+def _body_sql(alias: str) -> str:
+    return (
+        f"CASE WHEN {alias}.archived THEN archived_body({alias}.id, "
+        f"(SELECT a.body FROM message_archive a WHERE a.message_id = {alias}.id)) "
+        f"ELSE {alias}.body END"
+    )
+
+
 def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
+    conn.create_function("archived_body", 2, _archived_body, deterministic=True)
     conn.execute("PRAGMA foreign_keys = ON;")
+    if DB_WAL:
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS};")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE};")
+        conn.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE};")
     return conn
 
 
+class ConnectionPool:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return _connect()
+                except Exception:
+                    self._opened -= 1
+                    raise
+        return self._idle.get()
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        with self._lock:
+            self._opened = 0
+
+
+_POOL: Optional[ConnectionPool] = None
+_POOL_LOCK = threading.Lock()
+_PINNED = threading.local()
+
+
+def pin_connection() -> None:
+    _PINNED.conn = _connect()
+
+
+def unpin_connection() -> None:
+    conn = getattr(_PINNED, "conn", None)
+    _PINNED.conn = None
+    if conn is not None:
+        conn.close()
+
+
+def _pool() -> ConnectionPool:
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ConnectionPool(DB_POOL_SIZE)
+    return _POOL
+
+
+@contextlib.contextmanager
+def _pooled() -> Iterator[sqlite3.Connection]:
+    pinned = getattr(_PINNED, "conn", None)
+    if pinned is not None:
+        try:
+            yield pinned
+        finally:
+            if pinned.in_transaction:
+                pinned.rollback()
+        return
+    if DB_POOL_SIZE <= 0:
+        conn = _connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+    pool = _pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+class Writer:
+    def __init__(self, batch_size: int) -> None:
+        self.batch_size = max(1, batch_size)
+        self._jobs: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        future: Future = Future()
+        self._jobs.put((future, fn, args))
+        return future
+
+    def stop(self) -> None:
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        conn = _connect()
+        conn.isolation_level = None
+        stopping = False
+        while not stopping:
+            job = self._jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: list) -> None:
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = fn(conn, *args)
+                except Exception as exc:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    outcomes.append((future, exc, False))
+                else:
+                    conn.execute("RELEASE job")
+                    outcomes.append((future, result, True))
+            conn.execute("COMMIT")
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, _, _ in batch:
+                future.set_exception(exc)
+            return
+        for future, value, ok in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+_WRITER: Optional[Writer] = None
+
+
+def _writer() -> Writer:
+    global _WRITER
+    if _WRITER is None:
+        with _POOL_LOCK:
+            if _WRITER is None:
+                _WRITER = Writer(DB_WRITE_BATCH)
+    return _WRITER
+
+
+def _write(fn: Callable[..., Any], *args: Any) -> Any:
+    if DB_WAL:
+        return _writer().submit(fn, *args).result()
+    with _pooled() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, *args)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        return result
+
+
+def shutdown() -> None:
+    global _POOL, _WRITER
+    with _POOL_LOCK:
+        writer, _WRITER = _WRITER, None
+        if _POOL is not None:
+            _POOL.close()
+            _POOL = None
+    if writer is not None:
+        writer.stop()
+
+
+_MESSAGE_PATH_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS trg_messages_path AFTER INSERT ON messages
+    BEGIN
+        UPDATE messages
+        SET path = CASE WHEN NEW.parent_id IS NULL THEN ''
+                        ELSE (SELECT path FROM messages WHERE id = NEW.parent_id) END
+                   || printf('%016x/', NEW.id),
+            depth = COALESCE((SELECT depth + 1 FROM messages WHERE id = NEW.parent_id), 0)
+        WHERE id = NEW.id;
+    END
+"""
+
+
 def init_db() -> None:
     conn = _connect()
-    cur = conn.cursor()
-    cur.executescript(
+    if not _has_table(conn, "users"):
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    if DB_WAL:
+        conn.execute("PRAGMA journal_mode = WAL;")
+    conn.executescript(
         """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -79,36 +389,119 @@ def init_db() -> None:
             FOREIGN KEY (used_by) REFERENCES users(id) ON DELETE SET NULL
         );
 
-        CREATE INDEX IF NOT EXISTS idx_messages_topic ON messages(topic_id);
         CREATE INDEX IF NOT EXISTS idx_messages_parent ON messages(parent_id);
         """
     )
-    conn.commit()
     conn.close()
+    if not has_messages():
+        for _ in migrate():
+            pass
 
 
-def _hash_password(password: str, salt_hex: str) -> str:
-    salt = bytes.fromhex(salt_hex)
-    hashed = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 200_000)
-    return hashed.hex()
+def _has_table(conn: sqlite3.Connection, name: str) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row is not None
 
 
-def create_user(username: str, password: str) -> None:
-    salt = secrets.token_bytes(16).hex()
-    pwd_hash = _hash_password(password, salt)
-    conn = _connect()
+def _rebuild_search_index_in_tx(conn: sqlite3.Connection) -> None:
+    conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+
+
+def rebuild_search_index() -> None:
+    _write(_rebuild_search_index_in_tx)
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> bool:
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return True
+
+
+_LAST_ID = 2**63 - 1
+
+
+def _backfill_reaction_counters_in_tx(
+    conn: sqlite3.Connection, after: int = 0, last: int = _LAST_ID
+) -> None:
     conn.execute(
-        "INSERT INTO users (username, password_hash, password_salt, created_at) "
-        "VALUES (?, ?, ?, ?)",
-        (username, pwd_hash, salt, _now()),
+        """
+        UPDATE messages
+        SET likes = (
+                SELECT COUNT(*) FROM reactions r
+                WHERE r.message_id = messages.id AND r.value = 1
+            ),
+            dislikes = (
+                SELECT COUNT(*) FROM reactions r
+                WHERE r.message_id = messages.id AND r.value = -1
+            )
+        WHERE id > ? AND id <= ?
+        """,
+        (after, last),
     )
-    conn.commit()
-    conn.close()
 
 
-def _create_user_in_tx(conn: sqlite3.Connection, username: str, password: str) -> int:
-    salt = secrets.token_bytes(16).hex()
-    pwd_hash = _hash_password(password, salt)
+def _backfill_topic_activity_in_tx(
+    conn: sqlite3.Connection, after: int = 0, last: int = _LAST_ID
+) -> None:
+    conn.execute(
+        """
+        UPDATE topics
+        SET last_message_id = (
+                SELECT id FROM messages
+                WHERE topic_id = topics.id
+                ORDER BY created_at DESC, id DESC
+                LIMIT 1
+            ),
+            message_count = (SELECT COUNT(*) FROM messages WHERE topic_id = topics.id)
+        WHERE id > ? AND id <= ?
+        """,
+        (after, last),
+    )
+    conn.execute(
+        """
+        UPDATE topics
+        SET last_activity_at = COALESCE(
+            (SELECT created_at FROM messages WHERE id = topics.last_message_id),
+            created_at
+        )
+        WHERE id > ? AND id <= ?
+        """,
+        (after, last),
+    )
+
+
+def backfill_reaction_counters() -> None:
+    _write(_backfill_reaction_counters_in_tx)
+
+
+def check_reaction_counters() -> list[sqlite3.Row]:
+    with _pooled() as conn:
+        return conn.execute(
+            """
+            SELECT m.id,
+                   m.likes,
+                   m.dislikes,
+                   COALESCE(SUM(r.value = 1), 0) AS actual_likes,
+                   COALESCE(SUM(r.value = -1), 0) AS actual_dislikes
+            FROM messages m
+            LEFT JOIN reactions r ON r.message_id = m.id
+            GROUP BY m.id
+            HAVING m.likes != actual_likes OR m.dislikes != actual_dislikes
+            ORDER BY m.id
+            """
+        ).fetchall()
+
+
+def create_user(username: str, password: str) -> None:
+    _write(_create_user_in_tx, username, passwords.hash_password(password))
+
+
+def _create_user_in_tx(conn: sqlite3.Connection, username: str, pwd_hash: str) -> int:
+    _, _, salt, _ = passwords.parse(pwd_hash)
     cur = conn.execute(
         "INSERT INTO users (username, password_hash, password_salt, created_at) "
         "VALUES (?, ?, ?, ?)",
@@ -118,265 +511,1243 @@ def _create_user_in_tx(conn: sqlite3.Connection, username: str, password: str) -
 
 
 def user_exists(username: str) -> bool:
-    conn = _connect()
-    row = conn.execute(
-        "SELECT 1 FROM users WHERE username = ?",
-        (username,),
-    ).fetchone()
-    conn.close()
+    with _pooled() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM users WHERE username = ?",
+            (username,),
+        ).fetchone()
     return row is not None
 
 
+def get_credentials(username: str) -> Optional[sqlite3.Row]:
+    with _pooled() as conn:
+        return conn.execute(
+            "SELECT id, username, password_hash, password_salt FROM users WHERE username = ?",
+            (username,),
+        ).fetchone()
+
+
+def _set_password_hash_in_tx(conn: sqlite3.Connection, user_id: int, pwd_hash: str) -> None:
+    _, _, salt, _ = passwords.parse(pwd_hash)
+    conn.execute(
+        "UPDATE users SET password_hash = ?, password_salt = ? WHERE id = ?",
+        (pwd_hash, salt, user_id),
+    )
+
+
+def set_password_hash(user_id: int, pwd_hash: str) -> None:
+    _write(_set_password_hash_in_tx, user_id, pwd_hash)
+
+
 def verify_user(username: str, password: str) -> Optional[sqlite3.Row]:
-    conn = _connect()
-    row = conn.execute(
-        "SELECT id, username, password_hash, password_salt FROM users WHERE username = ?",
-        (username,),
-    ).fetchone()
-    conn.close()
+    row = get_credentials(username)
     if not row:
         return None
-    pwd_hash = _hash_password(password, row["password_salt"])
-    if secrets.compare_digest(pwd_hash, row["password_hash"]):
-        return row
-    return None
+    ok, needs_rehash = passwords.verify_password(password, row["password_hash"], row["password_salt"])
+    if not ok:
+        return None
+    if needs_rehash:
+        set_password_hash(row["id"], passwords.hash_password(password))
+    return row
 
 
-def create_session(user_id: int) -> str:
-    token = secrets.token_urlsafe(32)
-    conn = _connect()
+def _create_session_in_tx(conn: sqlite3.Connection, token: str, user_id: int) -> None:
     conn.execute(
         "INSERT INTO sessions (token, user_id, created_at, last_seen) VALUES (?, ?, ?, ?)",
         (token, user_id, _now(), _now()),
     )
-    conn.commit()
-    conn.close()
+
+
+def create_session(user_id: int) -> str:
+    token = secrets.token_urlsafe(32)
+    _write(_create_session_in_tx, token, user_id)
     return token
 
 
-def get_user_by_session(token: str) -> Optional[sqlite3.Row]:
-    conn = _connect()
-    row = conn.execute(
-        "SELECT u.id, u.username FROM sessions s JOIN users u ON u.id = s.user_id "
-        "WHERE s.token = ?",
-        (token,),
-    ).fetchone()
-    if row:
-        conn.execute("UPDATE sessions SET last_seen = ? WHERE token = ?", (_now(), token))
-        conn.commit()
-    conn.close()
+def _touch_session_in_tx(conn: sqlite3.Connection, token: str, seen_at: str) -> None:
+    conn.execute("UPDATE sessions SET last_seen = ? WHERE token = ?", (seen_at, token))
+
+
+def get_user_by_session(token: str, touch: bool = True) -> Optional[sqlite3.Row]:
+    idle_before = days_ago(SESSION_IDLE_DAYS) if SESSION_IDLE_DAYS > 0 else ""
+    with _pooled() as conn:
+        row = conn.execute(
+            "SELECT u.id, u.username FROM sessions s JOIN users u ON u.id = s.user_id "
+            "WHERE s.token = ? AND s.last_seen >= ?",
+            (token, idle_before),
+        ).fetchone()
+    if row and touch:
+        _write(_touch_session_in_tx, token, _now())
     return row
 
 
-def delete_session(token: str) -> None:
-    conn = _connect()
+def _touch_sessions_in_tx(conn: sqlite3.Connection, tokens: list[str], seen_at: str) -> None:
+    conn.executemany(
+        "UPDATE sessions SET last_seen = ? WHERE token = ?",
+        [(seen_at, token) for token in tokens],
+    )
+
+
+def touch_sessions(tokens: list[str]) -> None:
+    if tokens:
+        _write(_touch_sessions_in_tx, tokens, _now())
+
+
+def _delete_session_in_tx(conn: sqlite3.Connection, token: str) -> None:
     conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
 
 
-def list_topics() -> list[sqlite3.Row]:
-    conn = _connect()
-    rows = conn.execute(
-        """
-        SELECT t.id,
-               t.title,
-               t.created_at,
-               u.username as author,
-               COALESCE(mu.username, u.username) as last_author,
-               COALESCE(m.created_at, t.created_at) as last_activity_at
-        FROM topics t
-        JOIN users u ON u.id = t.created_by
-        LEFT JOIN messages m ON m.id = (
-            SELECT id
-            FROM messages
-            WHERE topic_id = t.id
-            ORDER BY created_at DESC, id DESC
-            LIMIT 1
-        )
-        LEFT JOIN users mu ON mu.id = m.user_id
-        ORDER BY last_activity_at DESC
-        """
-    ).fetchall()
-    conn.close()
-    return rows
+def delete_session(token: str) -> None:
+    _write(_delete_session_in_tx, token)
+
+
+def _expire_sessions_in_tx(conn: sqlite3.Connection, idle_before: str, limit: int) -> int:
+    return conn.execute(
+        "DELETE FROM sessions WHERE token IN "
+        "(SELECT token FROM sessions WHERE last_seen < ? LIMIT ?)",
+        (idle_before, limit),
+    ).rowcount
+
+
+def expire_sessions(idle_before: str, limit: int = GC_BATCH) -> int:
+    return _write(_expire_sessions_in_tx, idle_before, limit)
+
+
+def list_topics(before: Optional[Cursor] = None, limit: int = 50) -> tuple[list[sqlite3.Row], Optional[Cursor]]:
+    where = ""
+    params: tuple = (limit + 1,)
+    if before is not None:
+        where = "WHERE (t.last_activity_at, t.id) < (?, ?)"
+        params = (before[0], before[1], limit + 1)
+    with _pooled() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT t.id,
+                   t.title,
+                   t.created_at,
+                   u.username as author,
+                   COALESCE(mu.username, u.username) as last_author,
+                   t.last_activity_at,
+                   t.message_count
+            FROM topics t
+            JOIN users u ON u.id = t.created_by
+            LEFT JOIN messages m ON m.id = t.last_message_id
+            LEFT JOIN users mu ON mu.id = m.user_id
+            {where}
+            ORDER BY t.last_activity_at DESC, t.id DESC
+            LIMIT ?
+            """,
+            params,
+        ).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]["last_activity_at"], rows[-1]["id"])
 
 
 def get_topic(topic_id: int) -> Optional[sqlite3.Row]:
-    conn = _connect()
-    row = conn.execute(
-        "SELECT t.id, t.title, t.created_at, u.username as author "
-        "FROM topics t JOIN users u ON u.id = t.created_by "
-        "WHERE t.id = ?",
-        (topic_id,),
-    ).fetchone()
-    conn.close()
-    return row
+    with _pooled() as conn:
+        return conn.execute(
+            "SELECT t.id, t.title, t.created_at, u.username as author "
+            "FROM topics t JOIN users u ON u.id = t.created_by "
+            "WHERE t.id = ?",
+            (topic_id,),
+        ).fetchone()
 
 
-def create_topic(title: str, user_id: int) -> int:
-    conn = _connect()
+def _create_topic_in_tx(conn: sqlite3.Connection, title: str, user_id: int) -> int:
+    created_at = _now()
     cur = conn.execute(
-        "INSERT INTO topics (title, created_by, created_at) VALUES (?, ?, ?)",
-        (title, user_id, _now()),
+        "INSERT INTO topics (title, created_by, created_at, last_activity_at) VALUES (?, ?, ?, ?)",
+        (title, user_id, created_at, created_at),
     )
-    conn.commit()
-    topic_id = cur.lastrowid
-    conn.close()
-    return int(topic_id)
+    return int(cur.lastrowid)
+
+
+def create_topic(title: str, user_id: int) -> int:
+    return _write(_create_topic_in_tx, title, user_id)
+
+
+_MESSAGE_SELECT = f"""
+    SELECT m.id,
+           m.topic_id,
+           m.parent_id,
+           {_body_sql("m")} AS body,
+           m.created_at,
+           u.username,
+           m.likes,
+           m.dislikes,
+           m.depth,
+           (SELECT COUNT(*) FROM messages c WHERE c.parent_id = m.id) AS replies,
+           (SELECT MAX(seq) FROM changes ch WHERE ch.message_id = m.id) AS seq
+    FROM messages m
+    JOIN users u ON u.id = m.user_id
+"""
 
 
 def list_messages(topic_id: int) -> list[sqlite3.Row]:
-    conn = _connect()
-    rows = conn.execute(
-        """
-        SELECT m.id,
-               m.topic_id,
-               m.parent_id,
-               m.body,
-               m.created_at,
-               u.username,
-               COALESCE(SUM(CASE WHEN r.value = 1 THEN 1 END), 0) AS likes,
-               COALESCE(SUM(CASE WHEN r.value = -1 THEN 1 END), 0) AS dislikes
-        FROM messages m
-        JOIN users u ON u.id = m.user_id
-        LEFT JOIN reactions r ON r.message_id = m.id
-        WHERE m.topic_id = ?
-        GROUP BY m.id
-        ORDER BY m.created_at ASC
-        """,
-        (topic_id,),
-    ).fetchall()
-    conn.close()
+    with _pooled() as conn:
+        return conn.execute(
+            _MESSAGE_SELECT + "WHERE m.topic_id = ? ORDER BY m.created_at ASC",
+            (topic_id,),
+        ).fetchall()
+
+
+def _list_roots(
+    conn: sqlite3.Connection, topic_id: int, before: Optional[Cursor], limit: int
+) -> list[sqlite3.Row]:
+    if before is None:
+        rows = conn.execute(
+            _MESSAGE_SELECT + "WHERE m.topic_id = ? AND m.parent_id IS NULL "
+            "ORDER BY m.created_at DESC, m.id DESC LIMIT ?",
+            (topic_id, limit),
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            _MESSAGE_SELECT + "WHERE m.topic_id = ? AND m.parent_id IS NULL "
+            "AND (m.created_at, m.id) < (?, ?) "
+            "ORDER BY m.created_at DESC, m.id DESC LIMIT ?",
+            (topic_id, before[0], before[1], limit),
+        ).fetchall()
+    rows.reverse()
     return rows
 
 
-def get_message(message_id: int) -> Optional[sqlite3.Row]:
-    conn = _connect()
+def _list_children(
+    conn: sqlite3.Connection, topic_id: int, parent_id: int, after: Optional[Cursor], limit: int
+) -> list[sqlite3.Row]:
+    if after is None:
+        return conn.execute(
+            _MESSAGE_SELECT + "WHERE m.parent_id = ? AND m.topic_id = ? "
+            "ORDER BY m.created_at ASC, m.id ASC LIMIT ?",
+            (parent_id, topic_id, limit),
+        ).fetchall()
+    return conn.execute(
+        _MESSAGE_SELECT + "WHERE m.parent_id = ? AND m.topic_id = ? "
+        "AND (m.created_at, m.id) > (?, ?) "
+        "ORDER BY m.created_at ASC, m.id ASC LIMIT ?",
+        (parent_id, topic_id, after[0], after[1], limit),
+    ).fetchall()
+
+
+def _load_thread(
+    conn: sqlite3.Connection,
+    topic_id: int,
+    parent_id: Optional[int],
+    cursor: Optional[Cursor],
+    limit: int,
+    depth: int,
+    max_nodes: int,
+) -> tuple[list[sqlite3.Row], Optional[Cursor]]:
+    if parent_id is None:
+        level = _list_roots(conn, topic_id, cursor, limit + 1)
+        has_more = len(level) > limit
+        if has_more:
+            level = level[1:]
+        next_cursor = (level[0]["created_at"], level[0]["id"]) if has_more else None
+    else:
+        level = _list_children(conn, topic_id, parent_id, cursor, limit + 1)
+        has_more = len(level) > limit
+        if has_more:
+            level = level[:-1]
+        next_cursor = (level[-1]["created_at"], level[-1]["id"]) if has_more else None
+
+    rows = list(level)
+    for _ in range(depth - 1):
+        next_level = []
+        for row in level:
+            if not row["replies"] or len(rows) >= max_nodes:
+                continue
+            children = _list_children(
+                conn, topic_id, row["id"], None, min(limit, max_nodes - len(rows))
+            )
+            rows.extend(children)
+            next_level.extend(children)
+        if not next_level:
+            break
+        level = next_level
+    return rows, next_cursor
+
+
+def load_thread(
+    topic_id: int,
+    parent_id: Optional[int],
+    cursor: Optional[Cursor],
+    limit: int,
+    depth: int,
+    max_nodes: int,
+) -> tuple[list[sqlite3.Row], Optional[Cursor]]:
+    with _pooled() as conn:
+        return _load_thread(conn, topic_id, parent_id, cursor, limit, depth, max_nodes)
+
+
+def topic_snapshot(
+    topic_id: int, limit: int, depth: int, max_nodes: int
+) -> tuple[list[sqlite3.Row], Optional[Cursor], int]:
+    with _pooled() as conn:
+        conn.execute("BEGIN")
+        try:
+            seq = conn.execute("SELECT MAX(seq) AS seq FROM changes").fetchone()["seq"] or 0
+            rows, cursor = _load_thread(conn, topic_id, None, None, limit, depth, max_nodes)
+        finally:
+            conn.rollback()
+    return rows, cursor, seq
+
+
+def latest_seq() -> int:
+    with _pooled() as conn:
+        row = conn.execute("SELECT MAX(seq) AS seq FROM changes").fetchone()
+    return row["seq"] or 0
+
+
+def oldest_seq() -> int:
+    with _pooled() as conn:
+        row = conn.execute("SELECT MIN(seq) AS seq FROM changes").fetchone()
+    return row["seq"] or 0
+
+
+def changes_since(
+    topic_id: int, since: int, limit: int
+) -> Optional[list[tuple[sqlite3.Row, bool]]]:
+    with _pooled() as conn:
+        oldest = conn.execute("SELECT MIN(seq) AS seq FROM changes").fetchone()["seq"]
+        if oldest is not None and since < oldest - 1:
+            return None
+        changed = conn.execute(
+            """
+            SELECT message_id, MAX(kind = 'message') AS created
+            FROM changes
+            WHERE topic_id = ? AND seq > ?
+            GROUP BY message_id
+            LIMIT ?
+            """,
+            (topic_id, since, limit + 1),
+        ).fetchall()
+        if len(changed) > limit:
+            return None
+        created = {row["message_id"]: bool(row["created"]) for row in changed}
+        if not created:
+            return []
+        placeholders = ",".join("?" * len(created))
+        rows = conn.execute(
+            _MESSAGE_SELECT + f"WHERE m.id IN ({placeholders}) ORDER BY m.created_at ASC, m.id ASC",
+            tuple(created),
+        ).fetchall()
+    return [(row, created[row["id"]]) for row in rows]
+
+
+def _subtree_bounds(path: str) -> tuple[str, str]:
+    return path, path + "g"
+
+
+def _message_path(conn: sqlite3.Connection, message_id: int) -> Optional[str]:
+    row = conn.execute("SELECT path FROM messages WHERE id = ?", (message_id,)).fetchone()
+    return row["path"] if row else None
+
+
+def get_ancestors(message_id: int) -> list[sqlite3.Row]:
+    with _pooled() as conn:
+        path = _message_path(conn, message_id)
+        if path is None:
+            return []
+        ids = [int(part, 16) for part in path.split("/") if part]
+        return conn.execute(
+            _MESSAGE_SELECT + f"WHERE m.id IN ({','.join('?' * len(ids))}) ORDER BY m.depth",
+            ids,
+        ).fetchall()
+
+
+def get_subtree(message_id: int, max_nodes: int) -> list[sqlite3.Row]:
+    with _pooled() as conn:
+        path = _message_path(conn, message_id)
+        if path is None:
+            return []
+        return conn.execute(
+            _MESSAGE_SELECT + "WHERE m.path >= ? AND m.path < ? ORDER BY m.path LIMIT ?",
+            (*_subtree_bounds(path), max_nodes),
+        ).fetchall()
+
+
+def count_descendants(message_id: int) -> int:
+    with _pooled() as conn:
+        path = _message_path(conn, message_id)
+        if path is None:
+            return 0
+        row = conn.execute(
+            "SELECT COUNT(*) AS total FROM messages WHERE path > ? AND path < ?",
+            _subtree_bounds(path),
+        ).fetchone()
+    return row["total"]
+
+
+def _match_query(text: str, topic_id: Optional[int] = None) -> str:
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        return ""
+    match = f"body : ({' '.join(terms)})"
+    if topic_id is not None:
+        match += f' AND topic_id : "{int(topic_id)}"'
+    return match
+
+
+def _search_window(
+    conn: sqlite3.Connection, match: str, newest: int = _LAST_ID
+) -> Optional[SearchCursor]:
     row = conn.execute(
         """
-        SELECT m.id,
-               m.topic_id,
-               m.parent_id,
-               m.body,
-               m.created_at,
-               u.username,
-               COALESCE(SUM(CASE WHEN r.value = 1 THEN 1 END), 0) AS likes,
-               COALESCE(SUM(CASE WHEN r.value = -1 THEN 1 END), 0) AS dislikes
-        FROM messages m
-        JOIN users u ON u.id = m.user_id
-        LEFT JOIN reactions r ON r.message_id = m.id
-        WHERE m.id = ?
-        GROUP BY m.id
+        SELECT MAX(id) AS newest, MIN(id) AS oldest, COUNT(*) AS total
+        FROM (
+            SELECT rowid AS id FROM messages_fts
+            WHERE messages_fts MATCH ? AND rowid <= ?
+            ORDER BY rowid DESC
+            LIMIT ?
+        )
         """,
-        (message_id,),
+        (match, newest, SEARCH_RANK_WINDOW + 1),
     ).fetchone()
-    conn.close()
-    return row
+    if not row["total"]:
+        return None
+    floor = row["oldest"] + 1 if row["total"] > SEARCH_RANK_WINDOW else 0
+    return row["newest"], floor, 0
 
 
-def create_message(topic_id: int, parent_id: Optional[int], user_id: int, body: str) -> sqlite3.Row:
-    conn = _connect()
+def search_messages(
+    query: str,
+    topic_id: Optional[int] = None,
+    after: Optional[SearchCursor] = None,
+    limit: int = 20,
+) -> tuple[list[sqlite3.Row], Optional[SearchCursor], bool]:
+    match = _match_query(query, topic_id)
+    if not match:
+        return [], None, False
+    with _pooled() as conn:
+        window = _search_window(conn, match, after[0] if after else _LAST_ID)
+        if window is None:
+            return [], None, False
+        newest, floor, offset = window
+        if after is not None:
+            if after[1] < floor:
+                raise ValueError("Search cursor reaches past its window.")
+            floor, offset = after[1], after[2]
+        rows = conn.execute(
+            """
+            WITH hits AS (
+                SELECT messages_fts.rowid AS id, messages_fts.rank AS rank
+                FROM messages_fts
+                WHERE messages_fts MATCH :match
+                  AND messages_fts.rowid BETWEEN :floor AND :newest
+                ORDER BY rank, id
+                LIMIT :limit OFFSET :offset
+            )
+            SELECT m.id,
+                   m.topic_id,
+                   m.parent_id,
+                   m.created_at,
+                   u.username,
+                   t.title AS topic_title,
+                   (
+                       SELECT snippet(messages_fts, 0, char(2), char(3), '…', :tokens)
+                       FROM messages_fts
+                       WHERE messages_fts MATCH :match AND messages_fts.rowid = hits.id
+                   ) AS snippet,
+                   hits.rank
+            FROM hits
+            JOIN messages m ON m.id = hits.id
+            JOIN users u ON u.id = m.user_id
+            JOIN topics t ON t.id = m.topic_id
+            ORDER BY hits.rank, hits.id
+            """,
+            {
+                "match": match,
+                "tokens": SEARCH_SNIPPET_TOKENS,
+                "floor": floor,
+                "newest": newest,
+                "limit": limit + 1,
+                "offset": offset,
+            },
+        ).fetchall()
+    truncated = floor > 0
+    if len(rows) <= limit:
+        return rows, None, truncated
+    return rows[:limit], (newest, floor, offset + limit), truncated
+
+
+def get_message(message_id: int) -> Optional[sqlite3.Row]:
+    with _pooled() as conn:
+        return conn.execute(_MESSAGE_SELECT + "WHERE m.id = ?", (message_id,)).fetchone()
+
+
+def _create_message_in_tx(
+    conn: sqlite3.Connection, topic_id: int, parent_id: Optional[int], user_id: int, body: str
+) -> int:
     cur = conn.execute(
         "INSERT INTO messages (topic_id, parent_id, user_id, body, created_at) "
         "VALUES (?, ?, ?, ?, ?)",
         (topic_id, parent_id, user_id, body, _now()),
     )
-    conn.commit()
-    message_id = cur.lastrowid
-    conn.close()
-    row = get_message(int(message_id))
+    return int(cur.lastrowid)
+
+
+def create_message(topic_id: int, parent_id: Optional[int], user_id: int, body: str) -> sqlite3.Row:
+    message_id = _write(_create_message_in_tx, topic_id, parent_id, user_id, body)
+    row = get_message(message_id)
     if not row:
         raise RuntimeError("Message insert failed")
     return row
 
 
-def set_reaction(message_id: int, user_id: int, value: int) -> sqlite3.Row:
-    conn = _connect()
-    conn.execute(
-        """
-        INSERT INTO reactions (message_id, user_id, value, created_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(message_id, user_id)
-        DO UPDATE SET value = excluded.value, created_at = excluded.created_at
-        """,
-        (message_id, user_id, value, _now()),
+_UPSERT_REACTION = """
+    INSERT INTO reactions (message_id, user_id, value, created_at)
+    SELECT ?, ?, ?, ?
+    WHERE EXISTS (SELECT 1 FROM messages WHERE id = ?1)
+    ON CONFLICT(message_id, user_id)
+    DO UPDATE SET value = excluded.value, created_at = excluded.created_at
+"""
+
+
+def _set_reactions_in_tx(conn: sqlite3.Connection, reactions: list[tuple[int, int, int]]) -> None:
+    now = _now()
+    conn.executemany(
+        _UPSERT_REACTION,
+        ((message_id, user_id, value, now) for message_id, user_id, value in reactions),
     )
-    conn.commit()
-    conn.close()
-    row = get_message(message_id)
-    if not row:
-        raise RuntimeError("Reaction update failed")
-    return row
 
 
-def update_message(message_id: int, user_id: int, body: str) -> Optional[sqlite3.Row]:
-    conn = _connect()
+def set_reactions(reactions: list[tuple[int, int, int]]) -> list[sqlite3.Row]:
+    if not reactions:
+        return []
+    _write(_set_reactions_in_tx, reactions)
+    ids = sorted({message_id for message_id, _, _ in reactions})
+    with _pooled() as conn:
+        return conn.execute(
+            _MESSAGE_SELECT + f"WHERE m.id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+
+
+def _restore_in_tx(conn: sqlite3.Connection, message_id: int) -> None:
+    restored = conn.execute(
+        f"UPDATE messages SET body = {_body_sql('messages')}, archived = 0 "
+        "WHERE id = ? AND archived = 1",
+        (message_id,),
+    ).rowcount
+    if restored:
+        conn.execute("DELETE FROM message_archive WHERE message_id = ?", (message_id,))
+
+
+def _update_message_in_tx(conn: sqlite3.Connection, message_id: int, user_id: int, body: str) -> int:
+    owned = conn.execute(
+        "SELECT 1 FROM messages WHERE id = ? AND user_id = ?", (message_id, user_id)
+    ).fetchone()
+    if owned is None:
+        return 0
+    _restore_in_tx(conn, message_id)
     cur = conn.execute(
         "UPDATE messages SET body = ? WHERE id = ? AND user_id = ?",
         (body, message_id, user_id),
     )
-    conn.commit()
-    conn.close()
-    if cur.rowcount == 0:
+    return cur.rowcount
+
+
+def update_message(message_id: int, user_id: int, body: str) -> Optional[sqlite3.Row]:
+    if _write(_update_message_in_tx, message_id, user_id, body) == 0:
         return None
-    row = get_message(message_id)
-    return row
+    return get_message(message_id)
 
 
-def create_invite() -> str:
-    token = secrets.token_urlsafe(24)
-    conn = _connect()
+def _create_invite_in_tx(conn: sqlite3.Connection, token: str) -> None:
     conn.execute(
         "INSERT INTO invites (token, created_at) VALUES (?, ?)",
         (token, _now()),
     )
-    conn.commit()
-    conn.close()
+
+
+def create_invite() -> str:
+    token = secrets.token_urlsafe(24)
+    _write(_create_invite_in_tx, token)
     return token
 
 
 def get_invite(token: str) -> Optional[sqlite3.Row]:
-    conn = _connect()
+    with _pooled() as conn:
+        return conn.execute(
+            "SELECT token, created_at, used_at FROM invites WHERE token = ?",
+            (token,),
+        ).fetchone()
+
+
+def _create_user_with_invite_in_tx(
+    conn: sqlite3.Connection, token: str, username: str, pwd_hash: str
+) -> Optional[int]:
     row = conn.execute(
-        "SELECT token, created_at, used_at FROM invites WHERE token = ?",
+        "SELECT token, used_at FROM invites WHERE token = ?",
         (token,),
     ).fetchone()
-    conn.close()
-    return row
+    if not row or row["used_at"] is not None:
+        return None
+
+    exists = conn.execute(
+        "SELECT 1 FROM users WHERE username = ?",
+        (username,),
+    ).fetchone()
+    if exists:
+        return None
+
+    user_id = _create_user_in_tx(conn, username, pwd_hash)
+    conn.execute(
+        "UPDATE invites SET used_at = ?, used_by = ? WHERE token = ?",
+        (_now(), user_id, token),
+    )
+    return user_id
+
+
+def create_user_with_invite(token: str, username: str, pwd_hash: str) -> Optional[int]:
+    return _write(_create_user_with_invite_in_tx, token, username, pwd_hash)
+
+
+def _expire_invites_in_tx(conn: sqlite3.Connection, used_before: str, limit: int) -> int:
+    return conn.execute(
+        "DELETE FROM invites WHERE token IN "
+        "(SELECT token FROM invites WHERE used_at < ? LIMIT ?)",
+        (used_before, limit),
+    ).rowcount
+
+
+def expire_invites(used_before: str, limit: int = GC_BATCH) -> int:
+    return _write(_expire_invites_in_tx, used_before, limit)
+
+
+def _expire_changes_in_tx(conn: sqlite3.Connection, created_before: str, limit: int) -> int:
+    return conn.execute(
+        """
+        DELETE FROM changes WHERE seq IN (
+            SELECT seq FROM changes
+            WHERE created_at < ? AND seq < (SELECT MAX(seq) FROM changes)
+            ORDER BY seq LIMIT ?
+        )
+        """,
+        (created_before, limit),
+    ).rowcount
+
+
+def expire_changes(created_before: str, limit: int = GC_BATCH) -> int:
+    return _write(_expire_changes_in_tx, created_before, limit)
+
 
+def cold_topics(inactive_before: str) -> list[int]:
+    with _pooled() as conn:
+        rows = conn.execute(
+            """
+            SELECT t.id FROM topics t
+            WHERE t.last_activity_at < ?
+              AND EXISTS (SELECT 1 FROM messages m WHERE m.topic_id = t.id AND m.archived = 0)
+            ORDER BY t.id
+            """,
+            (inactive_before,),
+        ).fetchall()
+    return [row["id"] for row in rows]
 
-def create_user_with_invite(token: str, username: str, password: str) -> Optional[int]:
+
+def _archive_batch_in_tx(conn: sqlite3.Connection, topic_id: int, limit: int) -> tuple[int, int, int]:
+    rows = conn.execute(
+        "SELECT id, body FROM messages WHERE topic_id = ? AND archived = 0 LIMIT ?",
+        (topic_id, limit),
+    ).fetchall()
+    packed = [(row["id"], compress_body(row["body"])) for row in rows]
+    conn.executemany(
+        "INSERT OR REPLACE INTO message_archive (message_id, body) VALUES (?, ?)", packed
+    )
+    conn.executemany(
+        "UPDATE messages SET body = '', archived = 1 WHERE id = ?",
+        ((message_id,) for message_id, _ in packed),
+    )
+    raw = sum(len(row["body"].encode("utf-8")) for row in rows)
+    return len(rows), raw, sum(len(blob) for _, blob in packed)
+
+
+def archive_topic(topic_id: int, batch_size: int = ARCHIVE_BATCH) -> Iterator[tuple[int, int, int]]:
+    while True:
+        count, raw, stored = _write(_archive_batch_in_tx, topic_id, batch_size)
+        if not count:
+            return
+        yield count, raw, stored
+
+
+def database_size() -> tuple[int, int]:
+    with _pooled() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * page_size, free * page_size
+
+
+def vacuum() -> None:
     conn = _connect()
     try:
-        conn.execute("BEGIN")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def _optimize_in_tx(conn: sqlite3.Connection) -> None:
+    conn.execute("PRAGMA analysis_limit = 400")
+    conn.execute("PRAGMA optimize").fetchall()
+
+
+def optimize() -> None:
+    _write(_optimize_in_tx)
+
+
+def _incremental_vacuum_in_tx(conn: sqlite3.Connection, pages: int) -> int:
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    count = min(pages, free) if pages > 0 else free
+    for _ in range(count):
+        conn.execute("PRAGMA incremental_vacuum(1)")
+    return count
+
+
+def incremental_vacuum(pages: int = GC_VACUUM_PAGES) -> int:
+    return _write(_incremental_vacuum_in_tx, pages)
+
+
+Backfill = Callable[[sqlite3.Connection, int, int], Optional[tuple[int, int]]]
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    schema: Callable[[sqlite3.Connection], None]
+    backfill: Optional[Backfill] = None
+
+
+def _execute_script(conn: sqlite3.Connection, script: str) -> None:
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+
+def _batch_ids(conn: sqlite3.Connection, table: str, after: int, limit: int) -> Optional[tuple[int, int]]:
+    row = conn.execute(
+        f"SELECT MAX(id) AS last, COUNT(*) AS count "
+        f"FROM (SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?)",
+        (after, limit),
+    ).fetchone()
+    return (row["last"], row["count"]) if row["count"] else None
+
+
+def _index_messages_in_tx(conn: sqlite3.Connection) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_topic_parent_created
+            ON messages(topic_id, parent_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_parent_created
+            ON messages(parent_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_topic_created
+            ON messages(topic_id, created_at, id);
+        DROP INDEX IF EXISTS idx_messages_topic;
+        """
+    )
+
+
+def _add_reaction_counters_in_tx(conn: sqlite3.Connection) -> None:
+    _add_column(conn, "messages", "likes", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "messages", "dislikes", "INTEGER NOT NULL DEFAULT 0")
+    _execute_script(
+        conn,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_reactions_insert AFTER INSERT ON reactions
+        BEGIN
+            UPDATE messages
+            SET likes = likes + (NEW.value = 1),
+                dislikes = dislikes + (NEW.value = -1)
+            WHERE id = NEW.message_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_reactions_update AFTER UPDATE OF value ON reactions
+        BEGIN
+            UPDATE messages
+            SET likes = likes - (OLD.value = 1) + (NEW.value = 1),
+                dislikes = dislikes - (OLD.value = -1) + (NEW.value = -1)
+            WHERE id = NEW.message_id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_reactions_delete AFTER DELETE ON reactions
+        BEGIN
+            UPDATE messages
+            SET likes = likes - (OLD.value = 1),
+                dislikes = dislikes - (OLD.value = -1)
+            WHERE id = OLD.message_id;
+        END;
+        """
+    )
+
+
+def _backfill_reaction_counters_batch_in_tx(
+    conn: sqlite3.Connection, after: int, limit: int
+) -> Optional[tuple[int, int]]:
+    batch = _batch_ids(conn, "messages", after, limit)
+    if batch is not None:
+        _backfill_reaction_counters_in_tx(conn, after, batch[0])
+    return batch
+
+
+def _add_topic_activity_in_tx(conn: sqlite3.Connection) -> None:
+    _add_column(conn, "topics", "last_message_id", "INTEGER")
+    _add_column(conn, "topics", "last_activity_at", "TEXT")
+    _add_column(conn, "topics", "message_count", "INTEGER NOT NULL DEFAULT 0")
+    _execute_script(
+        conn,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_messages_topic_activity AFTER INSERT ON messages
+        BEGIN
+            UPDATE topics
+            SET last_message_id = NEW.id,
+                last_activity_at = NEW.created_at,
+                message_count = message_count + 1
+            WHERE id = NEW.topic_id;
+        END;
+
+        CREATE INDEX IF NOT EXISTS idx_topics_activity
+            ON topics(last_activity_at DESC, id DESC);
+        """
+    )
+
+
+def _backfill_topic_activity_batch_in_tx(
+    conn: sqlite3.Connection, after: int, limit: int
+) -> Optional[tuple[int, int]]:
+    batch = _batch_ids(conn, "topics", after, limit)
+    if batch is not None:
+        _backfill_topic_activity_in_tx(conn, after, batch[0])
+    return batch
+
+
+def _add_message_archive_in_tx(conn: sqlite3.Connection) -> None:
+    if _add_column(conn, "messages", "archived", "INTEGER NOT NULL DEFAULT 0"):
+        for trigger in ("trg_changes_edit", "trg_messages_fts_update", "trg_messages_fts_delete"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("DROP TABLE IF EXISTS messages_fts")
+    _execute_script(
+        conn,
+        f"""
+        CREATE TABLE IF NOT EXISTS message_archive (
+            message_id INTEGER PRIMARY KEY,
+            body BLOB NOT NULL,
+            FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
+        );
+
+        CREATE VIEW IF NOT EXISTS message_bodies AS
+        SELECT m.id, {_body_sql("m")} AS body, m.topic_id FROM messages m;
+        """
+    )
+
+
+def _add_change_log_in_tx(conn: sqlite3.Connection) -> None:
+    _execute_script(
+        conn,
+        """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_changes_topic_seq ON changes(topic_id, seq);
+        CREATE INDEX IF NOT EXISTS idx_changes_message_seq ON changes(message_id, seq);
+
+        CREATE TRIGGER IF NOT EXISTS trg_changes_message AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO changes (topic_id, message_id, kind, created_at)
+            VALUES (NEW.topic_id, NEW.id, 'message', NEW.created_at);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_changes_edit AFTER UPDATE OF body ON messages
+        WHEN OLD.body IS NOT NEW.body AND OLD.archived = NEW.archived
+        BEGIN
+            INSERT INTO changes (topic_id, message_id, kind, created_at)
+            VALUES (NEW.topic_id, NEW.id, 'edit', strftime('%Y-%m-%dT%H:%M:%SZ', 'now'));
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_changes_reaction AFTER UPDATE OF likes, dislikes ON messages
+        WHEN OLD.likes != NEW.likes OR OLD.dislikes != NEW.dislikes
+        BEGIN
+            INSERT INTO changes (topic_id, message_id, kind, created_at)
+            VALUES (NEW.topic_id, NEW.id, 'reaction', strftime('%Y-%m-%dT%H:%M:%SZ', 'now'));
+        END;
+        """
+    )
+
+
+def _add_search_index_in_tx(conn: sqlite3.Connection) -> None:
+    created = not _has_table(conn, "messages_fts")
+    _execute_script(
+        conn,
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            body,
+            topic_id,
+            content = 'message_bodies',
+            content_rowid = 'id',
+            prefix = '2 3',
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, body, topic_id) VALUES (NEW.id, NEW.body, NEW.topic_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF body ON messages
+        WHEN OLD.archived = NEW.archived
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, body, topic_id)
+            VALUES ('delete', OLD.id, OLD.body, OLD.topic_id);
+            INSERT INTO messages_fts (rowid, body, topic_id) VALUES (NEW.id, NEW.body, NEW.topic_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, body, topic_id)
+            VALUES ('delete', OLD.id, {_body_sql("OLD")}, OLD.topic_id);
+        END;
+        """
+    )
+    if created:
+        _rebuild_search_index_in_tx(conn)
+
+
+def _add_message_paths_in_tx(conn: sqlite3.Connection) -> None:
+    _add_column(conn, "messages", "path", "TEXT")
+    _add_column(conn, "messages", "depth", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_path ON messages(path)")
+    conn.execute("DROP TRIGGER IF EXISTS trg_messages_path")
+    conn.execute(_MESSAGE_PATH_TRIGGER)
+
+
+def _index_expiry_in_tx(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions(last_seen)")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_invites_used_at ON invites(used_at) WHERE used_at IS NOT NULL"
+    )
+
+
+def _compute_path(
+    conn: sqlite3.Connection, message_id: int, parent_id: Optional[int], known: dict[int, tuple[str, int]]
+) -> tuple[str, int]:
+    segment = f"{message_id:016x}/"
+    if parent_id is None:
+        return segment, 0
+    parent = known.get(parent_id)
+    if parent is None:
         row = conn.execute(
-            "SELECT token, used_at FROM invites WHERE token = ?",
-            (token,),
+            "SELECT parent_id, path, depth FROM messages WHERE id = ?", (parent_id,)
         ).fetchone()
-        if not row or row["used_at"] is not None:
-            conn.execute("ROLLBACK")
-            conn.close()
-            return None
+        if row["path"] is not None:
+            parent = (row["path"], row["depth"])
+        else:
+            parent = _compute_path(conn, parent_id, row["parent_id"], known)
+        known[parent_id] = parent
+    return parent[0] + segment, parent[1] + 1
 
-        exists = conn.execute(
-            "SELECT 1 FROM users WHERE username = ?",
-            (username,),
-        ).fetchone()
-        if exists:
-            conn.execute("ROLLBACK")
-            conn.close()
-            return None
 
-        user_id = _create_user_in_tx(conn, username, password)
-        conn.execute(
-            "UPDATE invites SET used_at = ?, used_by = ? WHERE token = ?",
-            (_now(), user_id, token),
+def _backfill_message_paths_in_tx(
+    conn: sqlite3.Connection, after: int, limit: int
+) -> Optional[tuple[int, int]]:
+    rows = conn.execute(
+        "SELECT id, parent_id FROM messages WHERE path IS NULL AND id > ? ORDER BY id LIMIT ?",
+        (after, limit),
+    ).fetchall()
+    if not rows:
+        return None
+    known: dict[int, tuple[str, int]] = {}
+    updates = []
+    for row in rows:
+        path, depth = known[row["id"]] = _compute_path(conn, row["id"], row["parent_id"], known)
+        updates.append((path, depth, row["id"]))
+    conn.executemany("UPDATE messages SET path = ?, depth = ? WHERE id = ?", updates)
+    return rows[-1]["id"], len(rows)
+
+
+def _widen_path(path: str) -> str:
+    return "".join(f"{int(segment, 16):016x}/" for segment in path.split("/")[:-1])
+
+
+def _widen_message_paths_in_tx(conn: sqlite3.Connection) -> None:
+    conn.execute("DROP TRIGGER IF EXISTS trg_messages_path")
+    conn.execute(_MESSAGE_PATH_TRIGGER)
+
+
+def _backfill_wide_paths_in_tx(
+    conn: sqlite3.Connection, after: int, limit: int
+) -> Optional[tuple[int, int]]:
+    rows = conn.execute(
+        "SELECT id, path FROM messages WHERE id > ? ORDER BY id LIMIT ?", (after, limit)
+    ).fetchall()
+    if not rows:
+        return None
+    updates = [
+        (_widen_path(row["path"]), row["id"])
+        for row in rows
+        if row["path"] and _widen_path(row["path"]) != row["path"]
+    ]
+    conn.executemany("UPDATE messages SET path = ? WHERE id = ?", updates)
+    return rows[-1]["id"], len(rows)
+
+
+MIGRATIONS = (
+    Migration(1, "index messages by topic, parent and creation time", _index_messages_in_tx),
+    Migration(
+        2, "reaction counters", _add_reaction_counters_in_tx, _backfill_reaction_counters_batch_in_tx
+    ),
+    Migration(
+        3, "topic activity", _add_topic_activity_in_tx, _backfill_topic_activity_batch_in_tx
+    ),
+    Migration(4, "archived message bodies", _add_message_archive_in_tx),
+    Migration(5, "change log", _add_change_log_in_tx),
+    Migration(6, "full-text search", _add_search_index_in_tx),
+    Migration(
+        7, "materialized paths for messages", _add_message_paths_in_tx,
+        _backfill_message_paths_in_tx,
+    ),
+    Migration(8, "session and invite expiry indexes", _index_expiry_in_tx),
+    Migration(
+        9, "64-bit message path segments", _widen_message_paths_in_tx, _backfill_wide_paths_in_tx
+    ),
+)
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def _set_schema_version_in_tx(conn: sqlite3.Connection, version: int) -> None:
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def schema_version() -> int:
+    with _pooled() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def pending_migrations() -> list[Migration]:
+    version = schema_version()
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def has_messages() -> bool:
+    with _pooled() as conn:
+        return conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None
+
+
+def migrate(
+    batch_size: int = MIGRATE_BATCH, pause: float = MIGRATE_PAUSE
+) -> Iterator[tuple[Migration, int]]:
+    for migration in pending_migrations():
+        _write(migration.schema)
+        rows = 0
+        after = 0
+        while migration.backfill is not None:
+            result = _write(migration.backfill, after, batch_size)
+            if result is None:
+                break
+            after, count = result
+            rows += count
+            yield migration, rows
+            time.sleep(pause)
+        _write(_set_schema_version_in_tx, migration.version)
+        yield migration, rows
+
+
+HOT_QUERIES: dict[str, tuple[str, tuple]] = {
+    "session": (
+        "SELECT u.id, u.username FROM sessions s JOIN users u ON u.id = s.user_id "
+        "WHERE s.token = ? AND s.last_seen >= ?",
+        ("", ""),
+    ),
+    "lobby": (
+        """
+        SELECT t.id, t.title, COALESCE(mu.username, u.username) AS last_author
+        FROM topics t
+        JOIN users u ON u.id = t.created_by
+        LEFT JOIN messages m ON m.id = t.last_message_id
+        LEFT JOIN users mu ON mu.id = m.user_id
+        WHERE (t.last_activity_at, t.id) < (?, ?)
+        ORDER BY t.last_activity_at DESC, t.id DESC
+        LIMIT ?
+        """,
+        ("", 0, 50),
+    ),
+    "topic roots": (
+        _MESSAGE_SELECT + "WHERE m.topic_id = ? AND m.parent_id IS NULL "
+        "ORDER BY m.created_at DESC, m.id DESC LIMIT ?",
+        (1, 50),
+    ),
+    "replies": (
+        _MESSAGE_SELECT + "WHERE m.parent_id = ? AND m.topic_id = ? "
+        "AND (m.created_at, m.id) > (?, ?) ORDER BY m.created_at ASC, m.id ASC LIMIT ?",
+        (1, 1, "", 0, 20),
+    ),
+    "topic messages": (
+        _MESSAGE_SELECT + "WHERE m.topic_id = ? ORDER BY m.created_at ASC", (1,)
+    ),
+    "subtree": (
+        _MESSAGE_SELECT + "WHERE m.path >= ? AND m.path < ? ORDER BY m.path LIMIT ?", ("", "", 1000)
+    ),
+    "changes since": (
+        "SELECT message_id, MAX(kind = 'message') AS created FROM changes "
+        "WHERE topic_id = ? AND seq > ? GROUP BY message_id LIMIT ?",
+        (1, 0, 501),
+    ),
+    "last message": (
+        "SELECT id FROM messages WHERE topic_id = ? ORDER BY created_at DESC, id DESC LIMIT 1", (1,)
+    ),
+    "archive batch": (
+        "SELECT id, body FROM messages WHERE topic_id = ? AND archived = 0 LIMIT ?",
+        (1, ARCHIVE_BATCH),
+    ),
+    "expire sessions": (
+        "SELECT token FROM sessions WHERE last_seen < ? LIMIT ?", ("", GC_BATCH)
+    ),
+}
+
+
+def _schema_copy() -> sqlite3.Connection:
+    copy = sqlite3.connect(":memory:")
+    copy.row_factory = sqlite3.Row
+    copy.create_function("archived_body", 2, _archived_body, deterministic=True)
+    with _pooled() as conn:
+        objects = conn.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+        ).fetchall()
+        stats = []
+        if _has_table(conn, "sqlite_stat1"):
+            stats = conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1").fetchall()
+    virtual = [row["name"] for row in objects if row["sql"].startswith("CREATE VIRTUAL TABLE")]
+    for kind in ("table", "index", "view", "trigger"):
+        for row in objects:
+            if row["type"] != kind or any(row["name"].startswith(name + "_") for name in virtual):
+                continue
+            copy.execute(row["sql"])
+    copy.execute("ANALYZE")
+    copy.execute("DELETE FROM sqlite_stat1")
+    copy.executemany("INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)", stats)
+    copy.execute("ANALYZE sqlite_schema")
+    return copy
+
+
+def _query_plan(conn: sqlite3.Connection, sql: str, params: tuple) -> list[str]:
+    try:
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.OperationalError as exc:
+        return [f"error: {exc}"]
+    depth: dict[int, int] = {}
+    lines = []
+    for row in plan:
+        depth[row[0]] = depth.get(row[1], -1) + 1
+        lines.append("  " * depth[row[0]] + row[3])
+    return lines
+
+
+def explain_migrations() -> list[tuple[str, list[str], list[str]]]:
+    copy = _schema_copy()
+    try:
+        before = {name: _query_plan(copy, sql, params) for name, (sql, params) in HOT_QUERIES.items()}
+        for migration in pending_migrations():
+            migration.schema(copy)
+        return [
+            (name, before[name], _query_plan(copy, sql, params))
+            for name, (sql, params) in HOT_QUERIES.items()
+        ]
+    finally:
+        copy.close()
+
+
+EXPORT_TABLES = {
+    "users": ("id", "username", "password_hash", "password_salt", "created_at"),
+    "topics": ("id", "title", "created_by", "created_at"),
+    "messages": ("id", "topic_id", "parent_id", "user_id", "body", "created_at"),
+    "reactions": ("message_id", "user_id", "value", "created_at"),
+    "invites": ("token", "created_at", "used_at", "used_by"),
+}
+
+Record = tuple[str, dict[str, Any]]
+
+
+def export_rows(batch_size: int = EXPORT_BATCH) -> Iterator[Record]:
+    conn = _connect()
+    try:
+        conn.execute("BEGIN")
+        for table, columns in EXPORT_TABLES.items():
+            selected = ", ".join(
+                f"{_body_sql(table)} AS body" if (table, column) == ("messages", "body") else column
+                for column in columns
+            )
+            cursor = conn.execute(f"SELECT {selected} FROM {table} ORDER BY rowid")
+            while rows := cursor.fetchmany(batch_size):
+                for row in rows:
+                    yield table, dict(row)
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def _insert_records(conn: sqlite3.Connection, records: list[Record]) -> None:
+    for table, group in itertools.groupby(records, key=lambda record: record[0]):
+        columns = EXPORT_TABLES.get(table)
+        if columns is None:
+            raise ValueError(f"Unknown table in import: {table}")
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            ([row.get(column) for column in columns] for _, row in group),
         )
+
+
+def import_rows(records: Iterable[Record], batch_size: int = IMPORT_BATCH) -> Iterator[int]:
+    conn = _connect()
+    try:
+        for table in EXPORT_TABLES:
+            if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                raise ValueError(f"Refusing to import into a database with existing {table}.")
+        total = 0
+        records = iter(records)
+        while batch := list(itertools.islice(records, batch_size)):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("PRAGMA defer_foreign_keys = ON")
+                _insert_records(conn, batch)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            total += len(batch)
+            yield total
+        conn.execute("BEGIN IMMEDIATE")
+        _backfill_topic_activity_in_tx(conn)
         conn.commit()
+    finally:
         conn.close()
-        return user_id
-    except Exception:
-        conn.execute("ROLLBACK")
-        conn.close()
-        raise
+
+
+def backup(
+    target: str,
+    pages: int = BACKUP_PAGES,
+    progress: Optional[Callable[[int, int, int], object]] = None,
+) -> None:
+    source = _connect()
+    dest = sqlite3.connect(target)
+    try:
+        source.backup(dest, pages=pages, progress=progress)
+    finally:
+        dest.close()
+        source.close()
@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("DOOR_PATH", "door")
+os.environ.setdefault("HASH_EXECUTOR", "thread")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "branch.db")
+os.environ["GC_INTERVAL"] = "0"
+os.environ["TEMPLATE_CACHE_DIR"] = tempfile.mkdtemp()
+os.environ["ASSET_BUILD_DIR"] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    storage.shutdown()
+    monkeypatch.setattr(storage, "DB_PATH", str(tmp_path / "branch.db"))
+    storage.init_db()
+    yield
+    storage.shutdown()
+
+
+@pytest.fixture
+def author(db):
+    storage.create_user("alice", "secret")
+    return storage.get_credentials("alice")["id"]
@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def archived(author):
+    storage.create_user("bob", "secret")
+    other = storage.get_credentials("bob")["id"]
+    topic_id = storage.create_topic("old", author)
+    message = storage.create_message(topic_id, None, author, "original words " * 20)
+    reply = storage.create_message(topic_id, message["id"], other, "a reply")
+    for _ in storage.archive_topic(topic_id):
+        pass
+    return message["id"], reply["id"], author, other
+
+
+def _stored(message_id):
+    conn = sqlite3.connect(storage.DB_PATH)
+    try:
+        archived = conn.execute("SELECT archived FROM messages WHERE id = ?", (message_id,)).fetchone()[0]
+        kept = conn.execute(
+            "SELECT COUNT(*) FROM message_archive WHERE message_id = ?", (message_id,)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+    return archived, kept
+
+
+def test_archived_bodies_read_back(archived):
+    message_id, reply_id, _, _ = archived
+    assert _stored(message_id) == (1, 1)
+    assert storage.get_message(message_id)["body"] == "original words " * 20
+    assert storage.get_message(reply_id)["body"] == "a reply"
+
+
+def test_edit_by_another_user_leaves_the_archive_alone(archived):
+    message_id, _, _, other = archived
+    assert storage.update_message(message_id, other, "hijacked") is None
+    assert _stored(message_id) == (1, 1)
+    assert storage.get_message(message_id)["body"] == "original words " * 20
+
+
+def test_owner_edit_restores_the_message(archived):
+    message_id, _, author, _ = archived
+    edited = storage.update_message(message_id, author, "fresh text")
+    assert edited["body"] == "fresh text"
+    assert _stored(message_id) == (0, 0)
+    hits, _, _ = storage.search_messages("fresh", None, None, 10)
+    assert [row["id"] for row in hits] == [message_id]
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import assets
+
+
+def test_default_build_dir_is_outside_the_checkout():
+    default = os.path.abspath(assets.ASSET_BUILD_DIR)
+    assert not default.startswith(os.path.abspath(assets.BASE_DIR) + os.sep)
+
+
+def test_build_writes_only_into_the_target(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "app.js").write_text("console.log('hi');\n" * 50)
+    target = tmp_path / "dist"
+    manifest = assets.build(source=str(source), target=str(target))
+    hashed = manifest["app.js"]
+    expected = {"manifest.json", hashed, hashed + ".gz"}
+    if assets.brotli is not None:
+        expected.add(hashed + ".br")
+    assert set(os.listdir(target)) == expected
+    assert os.stat(target).st_mode & 0o777 == 0o700
+    assert sorted(os.listdir(source)) == ["app.js"]
+
+
+def test_build_refuses_a_shared_target(tmp_path):
+    target = tmp_path / "dist"
+    target.mkdir()
+    os.chmod(target, 0o777)
+    with pytest.raises(RuntimeError):
+        assets.build(source=str(tmp_path), target=str(target))
@@ -0,0 +1,59 @@
+import json
+
+from cache import TopicCache, TopicView
+
+
+def _row(message_id, parent_id=None, depth=0, replies=0, seq=1):
+    return {
+        "id": message_id,
+        "parent_id": parent_id,
+        "depth": depth,
+        "replies": replies,
+        "likes": 0,
+        "dislikes": 0,
+        "seq": seq,
+    }
+
+
+def _view(rows, seq=1):
+    return TopicView(rows, None, seq, root_limit=10, depth=3, max_nodes=100)
+
+
+def test_unsettled_events_stay_out_of_the_served_page():
+    view = _view([_row(1, replies=2)])
+    view.apply("message", _row(7, parent_id=1, depth=1, seq=5), now=0.0)
+
+    assert view.settled_seq(0.5, 1.0) == 1
+    assert view.rows[1]["replies"] == 2
+
+    assert view.settled_seq(1.0, 1.0) == 5
+    assert view.rows[1]["replies"] == 3
+    assert 7 not in view.rows
+
+
+def test_settled_events_apply_in_seq_order():
+    view = _view([_row(1)])
+    view.apply("reaction", dict(_row(1, seq=9), likes=4), now=0.0)
+    view.apply("reaction", dict(_row(1, seq=8), likes=3), now=0.0)
+
+    assert view.settled_seq(1.0, 1.0) == 9
+    assert view.rows[1]["likes"] == 4
+
+
+def test_cache_serves_json_matching_its_seq():
+    cache = TopicCache(1 << 20, json.dumps, settle=60.0)
+    assert cache.begin(1)
+    cache.fill(1, _view([_row(1, replies=1)]))
+    cache.apply(1, "message", _row(2, parent_id=1, depth=1, seq=4))
+
+    body, _, seq = cache.get(1)
+    assert seq == 1
+    assert json.loads(body)[0]["replies"] == 1
+
+
+def test_events_at_or_below_the_snapshot_are_ignored():
+    view = _view([_row(1)], seq=5)
+    view.apply("message", _row(2, parent_id=1, depth=1, seq=5), now=0.0)
+
+    assert view.settled_seq(10.0, 1.0) == 5
+    assert view.rows[1]["replies"] == 0
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+import pytest
+
+from executor import INTERACTIVE, NORMAL, Lane, StorageBusy
+
+
+def _noop():
+    return "done"
+
+
+def test_cancelled_calls_hold_their_slot_until_a_worker_takes_them():
+    lane = Lane("test", workers=1, queue_limit=2)
+    release = threading.Event()
+
+    async def main():
+        blocker = lane.submit(release.wait, (), NORMAL)
+        queued = lane.submit(_noop, (), NORMAL)
+        queued.cancel()
+        await asyncio.sleep(0.05)
+        assert lane.pending == 2
+        with pytest.raises(StorageBusy):
+            lane.submit(_noop, (), NORMAL)
+        release.set()
+        await blocker
+        for _ in range(100):
+            if lane.pending == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert lane.pending == 0
+        assert await lane.submit(_noop, (), NORMAL) == "done"
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        lane.stop()
+    assert lane.rejected == 1
+
+
+def test_interactive_calls_get_extra_headroom():
+    lane = Lane("test", workers=1, queue_limit=1)
+    release = threading.Event()
+
+    async def main():
+        blocker = lane.submit(release.wait, (), NORMAL)
+        with pytest.raises(StorageBusy):
+            lane.submit(_noop, (), NORMAL)
+        interactive = lane.submit(_noop, (), INTERACTIVE)
+        release.set()
+        await blocker
+        assert await interactive == "done"
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        lane.stop()
@@ -0,0 +1,116 @@
+import asyncio
+import json
+
+from aiohttp import WSCloseCode
+
+import fanout
+from fanout import CompactCodec, JsonCodec
+
+
+def _message(message_id, username, seq):
+    return {
+        "type": "message",
+        "message": {
+            "id": message_id,
+            "seq": seq,
+            "parent_id": None,
+            "body": f"hello {message_id}",
+            "created_at": "2026-01-01T00:00:00Z",
+            "username": username,
+            "likes": 0,
+            "dislikes": 0,
+            "replies": 0,
+        },
+    }
+
+
+class Client:
+    def __init__(self):
+        self.usernames = {}
+
+    def read(self, frame):
+        data = json.loads(frame)
+        for index, name in data.get("u", []):
+            self.usernames[index] = name
+        return [(event["i"], self.usernames.get(event.get("u"))) for event in data["e"]]
+
+
+def test_connections_keep_their_own_username_tables():
+    first, second = CompactCodec(), CompactCodec()
+    left, right = Client(), Client()
+    shared = {}
+    events = [_message(1, "ann", 1)]
+    assert left.read(first.encode(events, shared)) == [(1, "ann")]
+
+    shared = {}
+    events = [_message(2, "bob", 2), _message(3, "ann", 3)]
+    assert left.read(first.encode(events, shared)) == [(2, "bob"), (3, "ann")]
+    assert right.read(second.encode(events, shared)) == [(2, "bob"), (3, "ann")]
+    assert first.names == {"ann": 0, "bob": 1}
+    assert second.names == {"bob": 0, "ann": 1}
+
+
+def test_full_table_starts_over_and_redeclares():
+    codec, client = CompactCodec(capacity=2), Client()
+    client.read(codec.encode([_message(1, "ann", 1), _message(2, "bob", 2)]))
+    frame = codec.encode([_message(3, "cat", 3), _message(4, "ann", 4)])
+    assert json.loads(frame)["u"] == [[0, "cat"], [1, "ann"]]
+    assert client.read(frame) == [(3, "cat"), (4, "ann")]
+    assert len(codec.names) == 2
+
+
+def test_known_names_are_not_redeclared_until_reset():
+    codec, client = CompactCodec(), Client()
+    client.read(codec.encode([_message(1, "ann", 1)]))
+    frame = codec.encode([_message(2, "ann", 2), {"type": "reaction", "message": {
+        "id": 1, "seq": 3, "likes": 1, "dislikes": 0}}])
+    assert "u" not in json.loads(frame)
+    assert client.read(frame) == [(2, "ann"), (1, None)]
+    codec.reset()
+    assert json.loads(codec.encode([_message(5, "ann", 5)]))["u"] == [[0, "ann"]]
+
+
+def test_json_codec_shares_one_frame():
+    shared = {}
+    events = [_message(1, "ann", 1)]
+    frame = JsonCodec().encode(events, shared)
+    assert JsonCodec().encode(events, shared) is frame
+    assert json.loads(frame)["message"]["username"] == "ann"
+
+
+class SlowSocket:
+    def __init__(self):
+        self.closed = asyncio.Event()
+        self.release = asyncio.Event()
+        self.close_code = None
+
+    async def send_str(self, frame):
+        await self.release.wait()
+
+    async def close(self, code=None, message=b""):
+        await asyncio.sleep(0)
+        self.close_code = code
+        self.closed.set()
+        return True
+
+
+def test_slow_consumer_close_is_tracked_until_done(monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_SLOW_POLICY", "disconnect")
+    monkeypatch.setattr(fanout, "FANOUT_FLUSH_INTERVAL", 0)
+
+    async def run():
+        hub = fanout.FanOut()
+        ws = SlowSocket()
+        hub.subscribe(1, ws)
+        for seq in range(fanout.FANOUT_QUEUE_SIZE + 2):
+            hub.publish(1, _message(seq + 1, "ann", seq + 1))
+            await asyncio.sleep(0)
+        assert len(fanout._CLOSING) == 1
+        await ws.closed.wait()
+        await asyncio.sleep(0)
+        assert not fanout._CLOSING
+        assert ws.close_code == WSCloseCode.TRY_AGAIN_LATER
+        assert hub.rooms[1].disconnected == 1
+        await hub.close()
+
+    asyncio.run(run())
@@ -0,0 +1,172 @@
+import random
+import sqlite3
+
+import pytest
+
+import storage
+
+
+def _objects(path):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(
+            conn.execute(
+                "SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+        )
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def baseline(tmp_path, monkeypatch):
+    path = str(tmp_path / "baseline.db")
+    storage.shutdown()
+    monkeypatch.setattr(storage, "DB_PATH", path)
+    with monkeypatch.context() as patch:
+        patch.setattr(storage, "has_messages", lambda: True)
+        storage.init_db()
+    rng = random.Random(7)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (id, username, password_hash, password_salt, created_at)"
+            " VALUES (?, ?, 'x', 'y', '2023-01-01T00:00:00Z')",
+            [(user_id, f"user{user_id}") for user_id in range(1, 6)],
+        )
+        conn.executemany(
+            "INSERT INTO topics (id, title, created_by, created_at)"
+            " VALUES (?, ?, 1, '2023-01-01T00:00:00Z')",
+            [(topic_id, f"topic {topic_id}") for topic_id in range(1, 5)],
+        )
+        ids: dict[int, list[int]] = {1: [], 2: [], 3: []}
+        for message_id in range(1, 121):
+            topic_id = rng.choice((1, 2, 3))
+            parent_id = rng.choice(ids[topic_id]) if ids[topic_id] and rng.random() < 0.7 else None
+            conn.execute(
+                "INSERT INTO messages (id, topic_id, parent_id, user_id, body, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    message_id,
+                    topic_id,
+                    parent_id,
+                    rng.randint(1, 5),
+                    f"message {message_id} lantern" if message_id % 10 == 0 else f"message {message_id}",
+                    f"2023-02-01T00:{message_id // 60:02d}:{message_id % 60:02d}Z",
+                ),
+            )
+            ids[topic_id].append(message_id)
+        conn.executemany(
+            "INSERT OR IGNORE INTO reactions (message_id, user_id, value, created_at)"
+            " VALUES (?, ?, ?, '2023-03-01T00:00:00Z')",
+            [(rng.randint(1, 120), rng.randint(1, 5), rng.choice((1, -1))) for _ in range(300)],
+        )
+    conn.close()
+    yield path
+    storage.shutdown()
+
+
+def test_baseline_starts_unmigrated(baseline):
+    assert storage.schema_version() == 0
+    assert [migration.version for migration in storage.pending_migrations()] == list(range(1, storage.SCHEMA_VERSION + 1))
+
+
+def test_migrations_backfill_a_baseline_database(baseline):
+    applied = [migration.version for migration, _ in storage.migrate(batch_size=7, pause=0)]
+    assert sorted(set(applied)) == list(range(1, storage.SCHEMA_VERSION + 1))
+    assert storage.schema_version() == storage.SCHEMA_VERSION
+    assert storage.pending_migrations() == []
+
+    conn = sqlite3.connect(baseline)
+    conn.row_factory = sqlite3.Row
+    counters = conn.execute(
+        """
+        SELECT m.id, m.likes, m.dislikes,
+               (SELECT COUNT(*) FROM reactions r WHERE r.message_id = m.id AND r.value = 1) AS up,
+               (SELECT COUNT(*) FROM reactions r WHERE r.message_id = m.id AND r.value = -1) AS down
+        FROM messages m
+        """
+    ).fetchall()
+    assert all((row["likes"], row["dislikes"]) == (row["up"], row["down"]) for row in counters)
+
+    topics = conn.execute(
+        """
+        SELECT t.id, t.message_count, t.last_message_id, t.last_activity_at, t.created_at,
+               (SELECT COUNT(*) FROM messages WHERE topic_id = t.id) AS expected_count,
+               (SELECT MAX(id) FROM messages WHERE topic_id = t.id) AS expected_last
+        FROM topics t
+        """
+    ).fetchall()
+    for row in topics:
+        assert row["message_count"] == row["expected_count"]
+        assert row["last_message_id"] == row["expected_last"]
+        if row["expected_last"] is None:
+            assert row["last_activity_at"] == row["created_at"]
+
+    rows = {row["id"]: row for row in conn.execute("SELECT id, parent_id, path, depth FROM messages")}
+    for row in rows.values():
+        assert len(row["path"]) == 17 * (row["depth"] + 1)
+        if row["parent_id"] is None:
+            assert row["depth"] == 0
+        else:
+            parent = rows[row["parent_id"]]
+            assert row["path"].startswith(parent["path"])
+            assert row["depth"] == parent["depth"] + 1
+    assert len({row["path"] for row in rows.values()}) == len(rows)
+    conn.close()
+
+    hits, _, _ = storage.search_messages("lantern", None, None, 50)
+    assert sorted(row["id"] for row in hits) == list(range(10, 121, 10))
+
+
+def test_migrated_schema_matches_a_fresh_database(baseline, tmp_path, monkeypatch):
+    for _ in storage.migrate(batch_size=50, pause=0):
+        pass
+    seq = storage.latest_seq()
+    message = storage.create_message(1, None, 1, "after the upgrade")
+    assert storage.latest_seq() > seq
+    assert [row["id"] for row in storage.get_subtree(message["id"], 10)] == [message["id"]]
+    storage.shutdown()
+
+    fresh = str(tmp_path / "fresh.db")
+    monkeypatch.setattr(storage, "DB_PATH", fresh)
+    storage.init_db()
+    assert storage.schema_version() == storage.SCHEMA_VERSION
+    assert _objects(baseline) == _objects(fresh)
+
+
+def test_paths_keep_id_order_past_32_bits(db, author):
+    topic_id = storage.create_topic("wide", author)
+    root = storage.create_message(topic_id, None, author, "root")["id"]
+    conn = sqlite3.connect(storage.DB_PATH)
+    with conn:
+        conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'messages'", (2**32 - 2,))
+    conn.close()
+    replies = [storage.create_message(topic_id, root, author, f"reply {i}")["id"] for i in range(3)]
+    assert replies[-1] > 2**32
+    assert [row["id"] for row in storage.get_subtree(root, 10)] == [root] + replies
+
+
+def test_narrow_paths_are_widened(db, author):
+    topic_id = storage.create_topic("narrow", author)
+    root = storage.create_message(topic_id, None, author, "root")["id"]
+    child = storage.create_message(topic_id, root, author, "child")["id"]
+    storage.shutdown()
+    conn = sqlite3.connect(storage.DB_PATH)
+    with conn:
+        conn.execute("DROP TRIGGER trg_messages_path")
+        conn.execute(storage._MESSAGE_PATH_TRIGGER.replace("%016x", "%08x"))
+        conn.execute("UPDATE messages SET path = printf('%08x/', id) WHERE parent_id IS NULL")
+        conn.execute("UPDATE messages SET path = printf('%08x/%08x/', parent_id, id) WHERE parent_id IS NOT NULL")
+        conn.execute("PRAGMA user_version = 8")
+    conn.close()
+    late = storage.create_message(topic_id, child, author, "during the upgrade")["id"]
+
+    for _ in storage.migrate(batch_size=1, pause=0):
+        pass
+
+    conn = sqlite3.connect(storage.DB_PATH)
+    paths = dict(conn.execute("SELECT id, path FROM messages"))
+    conn.close()
+    assert paths[late] == f"{root:016x}/{child:016x}/{late:016x}/"
+    assert [row["id"] for row in storage.get_subtree(root, 10)] == [root, child, late]
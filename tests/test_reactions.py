@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import app
+import storage
+from executor import StorageBusy
+
+
+@pytest.fixture
+def messages(author):
+    storage.create_user("bob", "secret")
+    other = storage.get_credentials("bob")["id"]
+    topic_id = storage.create_topic("votes", author)
+    first = storage.create_message(topic_id, None, author, "first")["id"]
+    second = storage.create_message(topic_id, None, author, "second")["id"]
+    yield first, second, author, other
+    app.PENDING_REACTIONS.clear()
+    app.REACTION_FAILURES = 0
+    app.STORAGE.shutdown()
+
+
+def _counts(message_id):
+    row = storage.get_message(message_id)
+    return row["likes"], row["dislikes"]
+
+
+def _run(coro):
+    async def main():
+        result = await coro
+        if app.REACTION_FLUSH is not None:
+            app.REACTION_FLUSH.cancel()
+            app.REACTION_FLUSH = None
+        return result
+
+    return asyncio.run(main())
+
+
+def test_flush_writes_the_latest_vote_per_user(messages):
+    first, second, author, other = messages
+
+    async def vote():
+        app.queue_reaction(first, author, 1)
+        app.queue_reaction(first, other, 1)
+        app.queue_reaction(first, other, -1)
+        app.queue_reaction(second, other, 1)
+        await app.flush_reactions()
+
+    _run(vote())
+    assert _counts(first) == (1, 1)
+    assert _counts(second) == (1, 0)
+    assert app.PENDING_REACTIONS == {}
+
+
+def test_busy_storage_requeues_without_counting_a_failure(messages, monkeypatch):
+    first, _, author, _ = messages
+
+    async def busy(*args, **kwargs):
+        raise StorageBusy()
+
+    async def vote():
+        app.queue_reaction(first, author, 1)
+        monkeypatch.setattr(app, "db_write", busy)
+        await app.flush_reactions()
+
+    _run(vote())
+    assert app.PENDING_REACTIONS == {first: {author: 1}}
+    assert app.REACTION_FAILURES == 0
+
+
+def test_failed_flush_is_retried_then_dropped(messages, monkeypatch):
+    first, _, author, other = messages
+    monkeypatch.setattr(app, "REACTION_RETRIES", 2)
+    dropped = app.REACTIONS_DROPPED.values.get((), 0)
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("disk I/O error")
+
+    async def vote():
+        app.queue_reaction(first, author, 1)
+        monkeypatch.setattr(app, "db_write", broken)
+        for _ in range(2):
+            await app.flush_reactions()
+            assert app.PENDING_REACTIONS == {first: {author: 1}}
+        app.queue_reaction(first, author, -1)
+        app.queue_reaction(first, other, 1)
+        await app.flush_reactions()
+
+    _run(vote())
+    assert app.PENDING_REACTIONS == {}
+    assert app.REACTION_FAILURES == 0
+    assert app.REACTIONS_DROPPED.values.get((), 0) == dropped + 2
+    assert _counts(first) == (0, 0)
+
+
+def test_requeued_votes_do_not_override_newer_ones(messages, monkeypatch):
+    first, _, author, _ = messages
+    calls = []
+
+    async def flaky(fn, batch, **kwargs):
+        calls.append(list(batch))
+        if len(calls) == 1:
+            app.queue_reaction(first, author, -1)
+            raise RuntimeError("disk I/O error")
+        return await original(fn, batch, **kwargs)
+
+    original = app.db_write
+
+    async def vote():
+        app.queue_reaction(first, author, 1)
+        monkeypatch.setattr(app, "db_write", flaky)
+        await app.flush_reactions()
+        await app.flush_reactions()
+
+    _run(vote())
+    assert calls == [[(first, author, 1)], [(first, author, -1)]]
+    assert _counts(first) == (0, 1)
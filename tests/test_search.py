@@ -0,0 +1,71 @@
+import pytest
+from aiohttp import web
+
+import storage
+from app import decode_search_cursor, encode_search_cursor
+
+
+@pytest.fixture
+def corpus(author, monkeypatch):
+    monkeypatch.setattr(storage, "SEARCH_RANK_WINDOW", 10)
+    topic_id = storage.create_topic("search", author)
+    for i in range(30):
+        storage.create_message(topic_id, None, author, "needle " * (1 + i % 4) + f"hay{i}")
+    return topic_id, author
+
+
+def _all_pages(query, limit=4):
+    ids, cursor, truncated = [], None, False
+    while True:
+        rows, cursor, truncated = storage.search_messages(query, None, cursor, limit)
+        ids += [row["id"] for row in rows]
+        if cursor is None:
+            return ids, truncated
+
+
+def test_pages_cover_the_newest_window_once(corpus):
+    ids, truncated = _all_pages("needle")
+    assert truncated
+    assert len(ids) == len(set(ids)) == 10
+    assert min(ids) == 21
+
+
+def test_new_matches_do_not_shift_later_pages(corpus):
+    topic_id, author = corpus
+    expected, _ = _all_pages("needle")
+    rows, cursor, _ = storage.search_messages("needle", None, None, 4)
+    for _ in range(5):
+        storage.create_message(topic_id, None, author, "needle needle needle needle")
+    ids = [row["id"] for row in rows]
+    while cursor is not None:
+        rows, cursor, _ = storage.search_messages("needle", None, cursor, 4)
+        ids += [row["id"] for row in rows]
+    assert ids == expected
+
+
+def test_untruncated_search(corpus):
+    rows, cursor, truncated = storage.search_messages("hay7", None, None, 4)
+    assert len(rows) == 1
+    assert "\x02hay7\x03" in rows[0]["snippet"]
+    assert cursor is None
+    assert not truncated
+
+
+def test_forged_cursor_cannot_widen_the_window(corpus):
+    with pytest.raises(ValueError):
+        storage.search_messages("needle", None, (10**9, 0, 0), 4)
+    _, cursor, _ = storage.search_messages("needle", None, None, 4)
+    with pytest.raises(ValueError):
+        storage.search_messages("needle", None, (cursor[0], cursor[1] - 5, 4), 4)
+
+
+def test_cursor_round_trip():
+    assert decode_search_cursor(encode_search_cursor((42, 7, 20))) == (42, 7, 20)
+    assert encode_search_cursor(None) is None
+    assert decode_search_cursor("") is None
+
+
+@pytest.mark.parametrize("value", ["1|2", "a|b|c", "1|2|-1", "1|2|999999"])
+def test_malformed_cursor_is_rejected(value):
+    with pytest.raises(web.HTTPBadRequest):
+        decode_search_cursor(value)